@@ -26,6 +26,31 @@ class ReadRecallStack(Stack):
             f"arn:aws:sqs:{Stack.of(self).region}:{Stack.of(self).account}:summarize-character-queue"
         )
         
+        summary_on_demand_queue = sqs.Queue.from_queue_arn(
+            self, "SummaryOnDemandQueue",
+            f"arn:aws:sqs:{Stack.of(self).region}:{Stack.of(self).account}:summary-on-demand-queue"
+        )
+        
+        summary_priority_queue = sqs.Queue.from_queue_arn(
+            self, "SummaryPriorityQueue",
+            f"arn:aws:sqs:{Stack.of(self).region}:{Stack.of(self).account}:summary-priority-queue"
+        )
+        
+        character_retry_queue = sqs.Queue.from_queue_arn(
+            self, "CharacterRetryQueue",
+            f"arn:aws:sqs:{Stack.of(self).region}:{Stack.of(self).account}:character-retry-queue"
+        )
+        
+        book_progress_events_queue = sqs.Queue.from_queue_arn(
+            self, "BookProgressEventsQueue",
+            f"arn:aws:sqs:{Stack.of(self).region}:{Stack.of(self).account}:book-progress-events-queue"
+        )
+        
+        book_cleanup_queue = sqs.Queue.from_queue_arn(
+            self, "BookCleanupQueue",
+            f"arn:aws:sqs:{Stack.of(self).region}:{Stack.of(self).account}:book-cleanup-queue"
+        )
+        
         # ▼ S3 Buckets
         normalized_books_bucket = s3.Bucket.from_bucket_name(
             self, "NormalizedBooksBucket",
@@ -103,6 +128,41 @@ class ReadRecallStack(Stack):
             "getBookCharacters"
         )
         
+        ask_book_question_lambda = _lambda.Function.from_function_name(
+            self, "AskBookQuestionFunction",
+            "askBookQuestion"
+        )
+
+        update_reading_progress_lambda = _lambda.Function.from_function_name(
+            self, "UpdateReadingProgressFunction",
+            "updateReadingProgress"
+        )
+
+        fair_dispatcher_lambda = _lambda.Function.from_function_name(
+            self, "FairDispatcherFunction",
+            "fairDispatcher"
+        )
+
+        book_progress_notifier_lambda = _lambda.Function.from_function_name(
+            self, "BookProgressNotifierFunction",
+            "bookProgressNotifier"
+        )
+
+        websocket_connections_lambda = _lambda.Function.from_function_name(
+            self, "WebsocketConnectionsFunction",
+            "websocketConnections"
+        )
+
+        delete_book_lambda = _lambda.Function.from_function_name(
+            self, "DeleteBookFunction",
+            "deleteBook"
+        )
+
+        cleanup_book_lambda = _lambda.Function.from_function_name(
+            self, "CleanupBookFunction",
+            "cleanupBook"
+        )
+
         api_endpoint_authorizer_lambda = _lambda.Function.from_function_name(
             self, "ApiEndpointAuthorizerFunction", 
             "apiEndpointAuthorizer"
@@ -129,6 +189,36 @@ class ReadRecallStack(Stack):
             "users"
         )
         
+        gemini_rate_limits_table = dynamodb.Table.from_table_name(
+            self, "GeminiRateLimitsTable",
+            "gemini_rate_limits"
+        )
+        
+        book_jobs_table = dynamodb.Table.from_table_name(
+            self, "BookJobsTable",
+            "book_jobs"
+        )
+        
+        user_scheduling_table = dynamodb.Table.from_table_name(
+            self, "UserSchedulingTable",
+            "user_scheduling"
+        )
+        
+        pipeline_idempotency_table = dynamodb.Table.from_table_name(
+            self, "PipelineIdempotencyTable",
+            "pipeline_idempotency"
+        )
+        
+        websocket_connections_table = dynamodb.Table.from_table_name(
+            self, "WebsocketConnectionsTable",
+            "websocket_connections"
+        )
+        
+        token_usage_table = dynamodb.Table.from_table_name(
+            self, "TokenUsageTable",
+            "token_usage"
+        )
+        
         # ▼ API Gateway
         read_recall_api = apigw.RestApi.from_rest_api_id(
             self, "ReadRecallApi", 
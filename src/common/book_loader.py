@@ -0,0 +1,91 @@
+"""
+Shared by the Python lambdas: tools/vendor_common.py copies it into every
+function package that imports it.
+
+Loads normalized book JSON from S3 within a memory budget, for the
+summarizers that process several books per invocation.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+
+class NormalizedBookLoader:
+    """
+    A parsed book takes about `memory_factor` times its JSON size and stays in
+    memory while it is processed; each book in flight gets `share_bytes`.
+    `timed` is the handler's EmfMetrics.timed.
+    """
+
+    def __init__(self, s3, timed, share_bytes, memory_factor):
+        self.s3 = s3
+        self.timed = timed
+        self.share_bytes = share_bytes
+        self.memory_factor = memory_factor
+        # Held by a book too large to share memory with another large one
+        self._large_book_slot = threading.Semaphore(1)
+
+    def plan(self, size):
+        """
+        Execution plan for a normalized book of `size` bytes:
+          memory    - body read into memory and parsed from there
+          spill     - body downloaded to /tmp and parsed from the file, so the raw
+                      bytes and the decoded text are not held next to each other
+          exclusive - as spill, and only one such book per invocation at a time
+        """
+        need = size * self.memory_factor
+        if need + 2 * size <= self.share_bytes:
+            return "memory"
+        if shutil.disk_usage(tempfile.gettempdir()).free < 2 * size:
+            logger.warning(f"/tmp has no room for a {size} byte book; parsing it in memory")
+            return "memory"
+        return "spill" if need + size <= self.share_bytes else "exclusive"
+
+    @contextmanager
+    def open(self, s3_bucket, s3_key, size=None):
+        """
+        Downloads and parses the normalized book following plan(), and holds
+        the large-book slot for the whole block when the plan is "exclusive".
+        `size` comes from the normalize-books payload; without it S3 is asked (HEAD).
+        """
+        if size is None:
+            size = self.s3.head_object(Bucket=s3_bucket, Key=s3_key)["ContentLength"]
+        plan = self.plan(int(size))
+        if plan != "exclusive":
+            yield self.download_json(s3_bucket, s3_key, spill=plan == "spill")
+            return
+        with self._large_book_slot:
+            yield self.download_json(s3_bucket, s3_key, spill=True)
+
+    def download_json(self, s3_bucket, s3_key, spill=False):
+        """Downloads and parses a JSON file from S3, through /tmp if `spill`."""
+        logger.info(f"Downloading JSON from s3://{s3_bucket}/{s3_key}")
+        try:
+            with self.timed("download_json", plan="spill" if spill else "memory") as span:
+                if spill:
+                    fd, path = tempfile.mkstemp(suffix=".json")
+                    os.close(fd)
+                    try:
+                        self.s3.download_file(s3_bucket, s3_key, path)
+                        span["bytes"] = os.path.getsize(path)
+                        with open(path, encoding="utf-8") as f:
+                            book_json = json.load(f)
+                    finally:
+                        os.remove(path)
+                else:
+                    obj = self.s3.get_object(Bucket=s3_bucket, Key=s3_key)
+                    body = obj["Body"].read()
+                    span["bytes"] = len(body)
+                    book_json = json.loads(body.decode("utf-8"))
+            logger.info("Successfully downloaded and parsed JSON.")
+            return book_json
+        except Exception as e:
+            logger.error(f"Failed to download or parse JSON from s3://{s3_bucket}/{s3_key}: {e}")
+            raise
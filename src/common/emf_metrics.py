@@ -0,0 +1,121 @@
+"""
+Shared by the Python lambdas: tools/vendor_common.py copies it into every
+function package that imports it.
+
+Metrics go to stdout as CloudWatch embedded metric format (EMF) lines, which
+CloudWatch Logs turns into metrics with no API calls. book_id is always a
+property; with per_book it is also a dimension (one metric series per book:
+load tests only).
+"""
+
+import functools
+import json
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+MB = 1024 * 1024
+UNITS = {"duration_ms": "Milliseconds", "peak_rss_mb": "Megabytes", "traced_peak_mb": "Megabytes"}
+
+
+class EmfMetrics:
+    """
+    EMF writer for one function. `current_book`, if given, returns the book the
+    calling thread is working on, for lines that are not given a book_id.
+    """
+
+    def __init__(self, function_name, namespace, per_book=False, current_book=None):
+        self.function_name = function_name
+        self.namespace = namespace
+        self.per_book = per_book
+        self.current_book = current_book
+
+    def emit(self, stage, metrics, book_id=None, **properties):
+        """Prints one EMF line with `metrics` (name -> value, units from UNITS) for `stage`."""
+        if book_id is None and self.current_book is not None:
+            book_id = self.current_book()
+        dimensions = [["function", "stage"]]
+        if book_id and self.per_book:
+            dimensions.append(["function", "stage", "book_id"])
+        line = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": dimensions,
+                    "Metrics": [{"Name": name, "Unit": UNITS.get(name, "None")} for name in metrics],
+                }],
+            },
+            "function": self.function_name,
+            "stage": stage,
+            "book_id": book_id,
+            **metrics,
+            **properties,
+        }
+        # A single write per line: several threads may be emitting
+        sys.stdout.write(json.dumps(line, default=str) + "\n")
+        sys.stdout.flush()
+
+    @contextmanager
+    def timed(self, stage, book_id=None, **properties):
+        """
+        Times the block as `stage` (see emit). The yielded dict takes properties
+        only known inside the block, such as sizes or item counts; a block that
+        raises has outcome "error".
+        """
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            yield properties
+            outcome = "ok"
+        finally:
+            self.emit(stage, {"duration_ms": round((time.perf_counter() - started) * 1000, 3)}, book_id,
+                      outcome=outcome, **properties)
+
+    def memory_profiled(self, memory_limit_mb, trace_sample_rate):
+        """
+        Decorator for a handler: reports the peak RSS of every invocation and, for
+        `trace_sample_rate` of them, the tracemalloc peak of Python allocations,
+        to right-size the function.
+        """
+        def decorate(handler):
+            @functools.wraps(handler)
+            def wrapper(event, context):
+                _reset_peak_rss()
+                traced = random.random() < trace_sample_rate and not tracemalloc.is_tracing()
+                if traced:
+                    tracemalloc.start()
+                try:
+                    return handler(event, context)
+                finally:
+                    metrics = {"peak_rss_mb": round(_peak_rss_mb(), 1)}
+                    if traced:
+                        metrics["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / MB, 1)
+                        tracemalloc.stop()
+                    self.emit("invocation", metrics, memory_limit_mb=memory_limit_mb,
+                              records=len(event.get("Records", [])))
+            return wrapper
+        return decorate
+
+
+def _reset_peak_rss():
+    """Starts a new peak-RSS window (VmHWM), so each invocation reports its own peak."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass  # peak_rss_mb is then the container's peak so far
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
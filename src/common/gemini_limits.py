@@ -0,0 +1,200 @@
+"""
+Shared by the Python lambdas: tools/vendor_common.py copies it into every
+function package that imports it.
+
+Guards around Gemini calls: the per-invocation circuit breaker and the
+distributed token-bucket rate limiter shared by all summarizer containers.
+"""
+
+import logging
+import random
+import threading
+import time
+from decimal import Decimal
+from typing import Dict
+
+logger = logging.getLogger()
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling Gemini once the circuit breaker has tripped."""
+
+
+class DeadlineExceeded(CircuitOpenError):
+    """
+    Raised instead of calling Gemini once the record's share of the invocation
+    time is used up. Handled like an open breaker, but resumed without delay.
+    """
+
+
+class RateLimitedError(CircuitOpenError):
+    """Raised when the shared Gemini rate limiter has no capacity soon enough."""
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive Gemini failures (429s, 5xx and timeouts) across all
+    calls made during one invocation. After `threshold` failures in a row it
+    opens, and every further call fails fast so the remaining work can be
+    re-enqueued with an SQS delay instead of sleeping inside the Lambda.
+    The records of an invocation share it from separate threads, so every
+    update holds a lock.
+    """
+
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.is_open = False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+
+    def trip(self):
+        with self._lock:
+            self.is_open = True
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.threshold and not self.is_open:
+                logger.warning(f"Gemini circuit breaker opened after {self.consecutive_failures} consecutive failures.")
+                self.is_open = True
+
+
+class InMemoryTokenBucketStore:
+    """Process-local stand-in for DynamoTokenBucketStore (tests and local runs)."""
+
+    def __init__(self):
+        self._items: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def load(self, bucket_id: str):
+        with self._lock:
+            item = self._items.get(bucket_id)
+            return dict(item) if item else None
+
+    def compare_and_set(self, bucket_id: str, expected_version, state: dict) -> bool:
+        with self._lock:
+            current = self._items.get(bucket_id)
+            if (current["version"] if current else None) != expected_version:
+                return False
+            self._items[bucket_id] = dict(state)
+            return True
+
+
+class DynamoTokenBucketStore:
+    """
+    Token bucket state in DynamoDB, one item per bucket. Updates are
+    optimistic: a write only succeeds if nobody else wrote since our read.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def load(self, bucket_id: str):
+        item = self.table.get_item(Key={"bucket_id": bucket_id}, ConsistentRead=True).get("Item")
+        return {k: float(v) if isinstance(v, Decimal) else v for k, v in item.items()} if item else None
+
+    def compare_and_set(self, bucket_id: str, expected_version, state: dict) -> bool:
+        item = {"bucket_id": bucket_id,
+                **{k: Decimal(str(v)) if isinstance(v, float) else v for k, v in state.items()}}
+        try:
+            if expected_version is None:
+                self.table.put_item(Item=item, ConditionExpression="attribute_not_exists(bucket_id)")
+            else:
+                self.table.put_item(Item=item, ConditionExpression="#v = :v",
+                                    ExpressionAttributeNames={"#v": "version"},
+                                    ExpressionAttributeValues={":v": expected_version})
+            return True
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+
+class RateLimiter:
+    """
+    Distributed token bucket for Gemini requests, one bucket per model.
+
+    Callers reserve a token before every request. The refill rate adapts to
+    the 429s callers report (AIMD): each 429 cuts the shared rate by 30% (at
+    most once per second, so a burst of 429s counts once), and every
+    RATE_INCREASE_INTERVAL without one raises it again towards the quota.
+
+    `quotas` maps models to their requests per second; other models get
+    `default_rps`. acquire() gives up after `max_wait_seconds`.
+    """
+
+    DECREASE_FACTOR = 0.7
+    MIN_RATE = 0.5
+    RATE_INCREASE_INTERVAL = 10.0
+    # Conflicting writes one update tolerates before the bucket counts as saturated
+    MAX_UPDATE_ATTEMPTS = 20
+
+    def __init__(self, store, quotas: Dict[str, float], default_rps: float, max_wait_seconds: float):
+        self.store = store
+        self.quotas = quotas
+        self.default_rps = default_rps
+        self.max_wait_seconds = max_wait_seconds
+
+    def _quota(self, model: str) -> float:
+        return float(self.quotas.get(model, self.default_rps))
+
+    def _refilled(self, model: str, state, now: float) -> dict:
+        quota = self._quota(model)
+        if state is None:
+            return {"tokens": quota, "rate": quota, "updated_at": now,
+                    "rate_changed_at": now, "version": 0}
+        state = dict(state)
+        if now - state["rate_changed_at"] >= self.RATE_INCREASE_INTERVAL and state["rate"] < quota:
+            state["rate"] = min(quota, state["rate"] + quota * 0.1)
+            state["rate_changed_at"] = now
+        state["tokens"] = min(quota, state["tokens"] + (now - state["updated_at"]) * state["rate"])
+        state["updated_at"] = now
+        return state
+
+    def _update(self, model: str, change):
+        """
+        Applies change(state, now) with optimistic concurrency; returns its result.
+        Raises RateLimitedError if MAX_UPDATE_ATTEMPTS writes in a row lose a race.
+        """
+        bucket_id = f"gemini:{model}"
+        for _ in range(self.MAX_UPDATE_ATTEMPTS):
+            current = self.store.load(bucket_id)
+            now = time.time()
+            state = self._refilled(model, current, now)
+            result = change(state, now)
+            state["version"] = int(current["version"]) + 1 if current else 0
+            if self.store.compare_and_set(bucket_id, int(current["version"]) if current else None, state):
+                return result
+            time.sleep(random.uniform(0, 0.02)) # Lost a race with another caller; re-read
+        raise RateLimitedError(f"Gemini rate limit bucket for {model} is too contended to update.")
+
+    def acquire(self, model: str):
+        """Reserves one request; waits briefly or raises RateLimitedError."""
+        deadline = time.monotonic() + self.max_wait_seconds
+        while True:
+            def take(state, now):
+                if state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    return 0.0
+                return (1 - state["tokens"]) / state["rate"]
+            wait = self._update(model, take)
+            if wait == 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitedError(f"No Gemini capacity for {model} within {self.max_wait_seconds}s.")
+            time.sleep(wait)
+
+    def on_throttled(self, model: str):
+        """Reports a 429 so every caller slows down, not just this one."""
+        def decrease(state, now):
+            if now - state["rate_changed_at"] >= 1.0:
+                state["rate"] = max(self.MIN_RATE, state["rate"] * self.DECREASE_FACTOR)
+                state["rate_changed_at"] = now
+                logger.warning(f"Lowered shared Gemini rate for {model} to {state['rate']:.2f} req/s.")
+        self._update(model, decrease)
@@ -0,0 +1,172 @@
+"""
+Shared by the Python lambdas: tools/vendor_common.py copies it into every
+function package that imports it.
+
+Book pipeline bookkeeping in DynamoDB shared by normalize-books and the
+summarizers: idempotency claims, cancellation checks and fair-scheduling
+job slots. Tables are passed in, so each handler keeps its own (lazy) clients.
+"""
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+
+class BookCancelled(Exception):
+    """Raised between steps once the book has been deleted or replaced."""
+
+
+def last_delivery(sqs_record, max_receive_count):
+    """True if the record will not be redelivered should it fail now (the queue's maxReceiveCount)."""
+    receive_count = int(sqs_record.get("attributes", {}).get("ApproximateReceiveCount", 1))
+    return receive_count >= max_receive_count
+
+
+class WorkClaims:
+    """
+    Idempotency claims per (stage, book_id, content version). A claim is an
+    IN_PROGRESS lease until completed; a crashed worker's lease can be
+    retaken once it expires, and every item expires after `ttl_seconds`.
+    """
+
+    def __init__(self, table, lease_seconds, ttl_seconds):
+        self.table = table
+        self.lease_seconds = lease_seconds
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def key(stage, book_id, content_version):
+        return f"{stage}#{book_id}#{content_version}"
+
+    def claim(self, stage, book_id, content_version):
+        """
+        Takes the claim for this stage of this version of the book. False when it is
+        already COMPLETED or another worker holds an unexpired IN_PROGRESS lease.
+        """
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={"idempotency_key": self.key(stage, book_id, content_version),
+                      "status": "IN_PROGRESS",
+                      "lease_expires_at": now + self.lease_seconds,
+                      "expires_at": now + self.ttl_seconds},
+                ConditionExpression="attribute_not_exists(idempotency_key) OR "
+                                    "(#s = :in_progress AND lease_expires_at < :now)",
+                ExpressionAttributeNames={"#s": "status"},
+                ExpressionAttributeValues={":in_progress": "IN_PROGRESS", ":now": now},
+            )
+            return True
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def complete(self, stage, book_id, content_version):
+        self.table.update_item(
+            Key={"idempotency_key": self.key(stage, book_id, content_version)},
+            UpdateExpression="SET #s = :completed REMOVE lease_expires_at",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={":completed": "COMPLETED"},
+        )
+
+    def release(self, stage, book_id, content_version):
+        """Drops an IN_PROGRESS claim so a redelivery or continuation can take it again."""
+        try:
+            self.table.delete_item(
+                Key={"idempotency_key": self.key(stage, book_id, content_version)},
+                ConditionExpression="#s = :in_progress",
+                ExpressionAttributeNames={"#s": "status"},
+                ExpressionAttributeValues={":in_progress": "IN_PROGRESS"},
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+class CancellationChecks:
+    """
+    Deleting or replacing a book sets cancelled_before (epoch ms) on its
+    user_books row; work on a version uploaded before it is dropped. Each
+    book's row is re-read at most every `ttl_seconds`.
+    """
+
+    def __init__(self, user_books, ttl_seconds):
+        self.user_books = user_books
+        self.ttl_seconds = ttl_seconds
+        self._checks = {}  # (user_id, book_id) -> (checked_at, cancelled_before, deleted)
+        self._lock = threading.Lock()
+
+    def state(self, user_id, book_id, fresh=False):
+        """(cancelled_before, deleted) of the book; `fresh` skips the cached answer."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._checks.get((user_id, book_id))
+        if fresh or cached is None or now - cached[0] > self.ttl_seconds:
+            item = self.user_books.get_item(
+                Key={"user_id": user_id, "book_id": book_id},
+                ProjectionExpression="cancelled_before, processing_status",
+            ).get("Item") or {}
+            cached = (now, int(item.get("cancelled_before", 0)), item.get("processing_status") == "DELETED")
+            with self._lock:
+                self._checks[(user_id, book_id)] = cached
+        return cached[1], cached[2]
+
+    def is_cancelled(self, user_id, book_id, issued_at, fresh=False):
+        """
+        True if the book was deleted, or replaced after this version was uploaded
+        (issued_at, epoch ms). `fresh` skips the cached answer (before persisting).
+        """
+        cancelled_before, deleted = self.state(user_id, book_id, fresh)
+        return deleted or int(issued_at or 0) < cancelled_before
+
+
+class JobSlots:
+    """
+    The summarizers' side of per-user fair scheduling: a book scheduled by
+    normalize-books holds one of its user's slots until all `stages_per_book`
+    stages are done, and fair-dispatcher hands the slot to the user's next book.
+    """
+
+    def __init__(self, book_jobs, user_scheduling, lambda_client, stages_per_book, dispatcher_function):
+        self.book_jobs = book_jobs
+        self.user_scheduling = user_scheduling
+        self.lambda_client = lambda_client
+        self.stages_per_book = stages_per_book
+        self.dispatcher_function = dispatcher_function
+
+    def release(self, payload, stage):
+        """
+        Marks this stage of a fairly-scheduled book as finished. The stage that
+        completes the job frees the user's slot and, if they have books waiting,
+        nudges fair-dispatcher instead of waiting for its next scheduled run.
+        Stages are recorded as a set, so a redelivered message is counted once.
+        """
+        job_id, user_id = payload.get("job_id"), payload.get("user_id")
+        if not job_id or not user_id:
+            return  # Sent directly, not through the scheduler
+        key = {"user_id": user_id, "job_id": job_id}
+        try:
+            response = self.book_jobs.update_item(
+                Key=key,
+                UpdateExpression="ADD stages_done :stage",
+                ConditionExpression="attribute_exists(job_id)",
+                ExpressionAttributeValues={":stage": {stage}},
+                ReturnValues="UPDATED_NEW",
+            )
+            if len(response["Attributes"]["stages_done"]) < self.stages_per_book:
+                return
+            # Only the caller whose delete succeeds gives the slot back
+            self.book_jobs.delete_item(Key=key, ConditionExpression="attribute_exists(job_id)")
+        except self.book_jobs.meta.client.exceptions.ConditionalCheckFailedException:
+            return  # Job already completed by another delivery
+
+        response = self.user_scheduling.update_item(
+            Key={"user_id": user_id},
+            UpdateExpression="ADD inflight :minus_one",
+            ExpressionAttributeValues={":minus_one": -1},
+            ReturnValues="ALL_NEW",
+        )
+        logger.info(f"Released scheduling slot of {user_id} held by {job_id}.")
+        if int(response["Attributes"].get("pending", 0)) > 0:
+            self.lambda_client.invoke(FunctionName=self.dispatcher_function, InvocationType="Event",
+                                      Payload=json.dumps({"user_id": user_id}))
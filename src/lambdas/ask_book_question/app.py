@@ -0,0 +1,446 @@
+import json
+import math
+import os
+import re
+import time
+import bisect
+import boto3
+import requests
+from collections import Counter, OrderedDict
+from decimal import Decimal
+from typing import List, Dict
+import logging
+from boto3.dynamodb.conditions import Key
+from emf_metrics import EmfMetrics
+from lazy_resource import LazyResource
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Constants
+# Bucket where normalize-books writes normalized/{user_id}/{book_id}/normalized.json
+NORMALIZED_BUCKET = os.getenv("NORMALIZED_BUCKET", "normalized-books")
+SUMMARY_TABLE_NAME = os.getenv("SUMMARY_TABLE_NAME", "summaries")
+GEMINI_API_KEY_ENV = os.getenv("GEMINI_API_KEY")
+REGION = os.getenv("AWS_REGION", "us-east-1")
+# Base URL of the Gemini REST API (point at a local stand-in server for tests)
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+# Target chunk size in characters. Chunks are built from whole paragraphs, so a
+# chunk only exceeds this when a single paragraph is longer than the target.
+QA_CHUNK_CHARS = int(os.getenv("QA_CHUNK_CHARS", "1500"))
+# Number of chunks sent to Gemini with each question
+QA_TOP_K = int(os.getenv("QA_TOP_K", "6"))
+# Chapters tagged by normalize-books as front/back matter are skipped; progress
+# percentages are measured over the narrative chapters only
+NARRATIVE_CLASS = "narrative"
+# How many books to keep indexed in a warm container
+QA_INDEX_CACHE_SIZE = int(os.getenv("QA_INDEX_CACHE_SIZE", "8"))
+MAX_QUESTION_CHARS = 1000
+# Status of placeholder summary items for buckets still being generated
+PENDING_STATUS = "PENDING"
+# progress = 0 holds the book manifest written by bookSummaryLambda; its issued_at
+# (upload time) tells a replaced book apart, as the normalized JSON keeps its key
+MANIFEST_PROGRESS = 0
+# Model that answers questions
+QA_MODEL = os.getenv("QA_MODEL", "gemini-2.0-flash")
+# Gemini usage of every answer is added to TOKEN_USAGE_TABLE (stage "qa"), per book and
+# per user and calendar month, next to what the summarizers spent on the book
+TOKEN_USAGE_TABLE = os.getenv("TOKEN_USAGE_TABLE", "token_usage")
+# USD per million tokens as (fresh prompt, cached prompt, output); models not listed
+# are counted at 0. GEMINI_PRICING='{"model": [0.1, 0.025, 0.4]}' overrides entries.
+GEMINI_PRICING = {
+    "gemini-2.0-flash-lite": (0.075, 0.01875, 0.30),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+}
+GEMINI_PRICING.update({model: tuple(price) for model, price in json.loads(os.getenv("GEMINI_PRICING", "{}")).items()})
+# EMF metrics (see emf_metrics); METRICS_PER_BOOK adds a book_id dimension (load tests only)
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ReadRecall/Api")
+METRICS_PER_BOOK = os.getenv("METRICS_PER_BOOK", "false").lower() == "true"
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "askBookQuestion")
+
+# BM25 parameters (standard Okapi defaults)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Small stopword list so that questions like "what did he do" are scored on
+# the words that actually carry meaning.
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "did", "do", "does",
+    "for", "from", "had", "has", "have", "he", "her", "him", "his", "how", "i",
+    "in", "is", "it", "its", "me", "my", "of", "on", "or", "she", "so", "that",
+    "the", "their", "them", "they", "this", "to", "was", "were", "what", "when",
+    "where", "which", "who", "whom", "why", "will", "with", "you", "your",
+}
+
+
+# AWS Clients
+s3 = LazyResource(lambda: boto3.client("s3"))
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+summaries_table = LazyResource(lambda: dynamodb.Table(SUMMARY_TABLE_NAME))
+token_usage_table = LazyResource(lambda: dynamodb.Table(TOKEN_USAGE_TABLE))
+metrics = EmfMetrics(FUNCTION_NAME, METRICS_NAMESPACE, METRICS_PER_BOOK)
+
+# Global variable to store API key (fetched once from env var)
+GEMINI_API_KEY = None
+
+# Per-container cache of built indexes: normalized JSON key -> (book version, index)
+_INDEX_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+# Helpers
+def get_gemini_api_key():
+    """Gets the Gemini API key directly from the environment variable."""
+    global GEMINI_API_KEY
+    if GEMINI_API_KEY is None:
+        if not GEMINI_API_KEY_ENV:
+            logger.error("API_KEY environment variable not set.")
+            raise RuntimeError("API_KEY environment variable not set")
+        GEMINI_API_KEY = GEMINI_API_KEY_ENV
+        logger.info("Successfully retrieved API key from environment variable.")
+    return GEMINI_API_KEY
+
+
+def _tokenize(text: str) -> List[str]:
+    """Lower-cases and splits text into scoring terms, dropping stopwords."""
+    return [t for t in re.findall(r"[a-z0-9']+", text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+def _build_chunks(book_json: dict) -> List[Dict]:
+    """
+    Splits the book into paragraph-aligned chunks in reading order.
+    Each chunk records the character offset where it ends in the same joined
+    text the summarizers use, so progress percentages line up with theirs.
+    """
+    chunks: List[Dict] = []
+    offset = 0
+    current: List[str] = []
+    current_len = 0
+    current_chapter = None
+
+    def flush():
+        nonlocal current, current_len
+        if current:
+            chunks.append({
+                "text": "\n\n".join(current),
+                "chapter_id": current_chapter,
+                "end_offset": offset,
+            })
+        current, current_len = [], 0
+
+    for chap in book_json.get("chapters", []):
+        if chap.get("content_class", NARRATIVE_CLASS) != NARRATIVE_CLASS:
+            continue  # Same text the summarizers use
+        for block in chap.get("content", []):
+            if block.get("type") != "paragraph":
+                continue
+            para = block["text"].strip()
+            if not para:
+                continue
+            # Never let a chunk span two chapters
+            if current and (chap.get("id") != current_chapter or current_len + len(para) > QA_CHUNK_CHARS):
+                flush()
+            current_chapter = chap.get("id")
+            current.append(para)
+            current_len += len(para)
+            offset += len(para)
+    flush()
+    return chunks
+
+
+def _build_index(chunks: List[Dict]) -> dict:
+    """Builds a positional inverted index (term -> sorted chunk ids and tfs)."""
+    postings: Dict[str, List[int]] = {}
+    tfs: Dict[str, List[int]] = {}
+    lengths: List[int] = []
+    for idx, chunk in enumerate(chunks):
+        counts = Counter(_tokenize(chunk["text"]))
+        lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append(idx)
+            tfs.setdefault(term, []).append(tf)
+
+    # Prefix sums of chunk lengths give the average length of any eligible prefix in O(1)
+    length_prefix = [0]
+    for n in lengths:
+        length_prefix.append(length_prefix[-1] + n)
+
+    return {
+        "chunks": chunks,
+        "end_offsets": [c["end_offset"] for c in chunks],
+        "total_chars": chunks[-1]["end_offset"] if chunks else 0,
+        "postings": postings,
+        "tfs": tfs,
+        "lengths": lengths,
+        "length_prefix": length_prefix,
+    }
+
+
+def _bm25_top_k(index: dict, question: str, eligible: int, k: int) -> List[int]:
+    """
+    Scores the first `eligible` chunks against the question with BM25 and
+    returns the ids of the top k. Document frequencies are computed over the
+    eligible prefix only, so later (unread) chapters never influence ranking.
+    """
+    if eligible <= 0:
+        return []
+    avg_len = index["length_prefix"][eligible] / eligible or 1.0
+    scores: Dict[int, float] = {}
+    for term in set(_tokenize(question)):
+        ids = index["postings"].get(term)
+        if not ids:
+            continue
+        # Postings are sorted by chunk id, so the eligible ones are a prefix
+        df = bisect.bisect_left(ids, eligible)
+        if df == 0:
+            continue
+        idf = math.log(1 + (eligible - df + 0.5) / (df + 0.5))
+        tfs = index["tfs"][term]
+        for i in range(df):
+            chunk_id, tf = ids[i], tfs[i]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * index["lengths"][chunk_id] / avg_len)
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+    ranked = sorted(scores, key=lambda cid: scores[cid], reverse=True)[:k]
+    # Hand the chunks to the model in reading order
+    return sorted(ranked)
+
+
+def _book_version(book_id: str) -> int:
+    """Upload time of the book's current version from its manifest (0 for books without one)."""
+    with metrics.timed("get_manifest", book_id):
+        manifest = summaries_table.get_item(
+            Key={"book_id": book_id, "progress": MANIFEST_PROGRESS},
+            ProjectionExpression="issued_at",
+        ).get("Item") or {}
+    return int(manifest.get("issued_at", 0))
+
+
+def get_book_index(user_id: str, book_id: str) -> dict:
+    """
+    Returns the retrieval index for a book, building it on first use in this
+    container, and again once the book has been replaced by a new upload.
+    """
+    s3_key = f"normalized/{user_id}/{book_id}/normalized.json"
+    version = _book_version(book_id)
+    cached = _INDEX_CACHE.get(s3_key)
+    if cached and cached[0] == version:
+        _INDEX_CACHE.move_to_end(s3_key)
+        return cached[1]
+
+    logger.info(f"Building retrieval index from s3://{NORMALIZED_BUCKET}/{s3_key}")
+    with metrics.timed("download_json", book_id) as span:
+        body = s3.get_object(Bucket=NORMALIZED_BUCKET, Key=s3_key)["Body"].read()
+        span["bytes"] = len(body)
+    book_json = json.loads(body.decode("utf-8"))
+    with metrics.timed("build_index", book_id) as span:
+        index = _build_index(_build_chunks(book_json))
+        span["chunks"] = len(index["chunks"])
+    logger.info(f"Indexed {len(index['chunks'])} chunks ({index['total_chars']} characters).")
+
+    _INDEX_CACHE[s3_key] = (version, index)
+    _INDEX_CACHE.move_to_end(s3_key)
+    while len(_INDEX_CACHE) > QA_INDEX_CACHE_SIZE:
+        _INDEX_CACHE.popitem(last=False)
+    return index
+
+
+def get_latest_summary(book_id: str, percentage: int) -> str:
+    """Returns the most recent stored summary at or below the reader's progress."""
+    if percentage < 1:
+        return ""
+    with metrics.timed("query_summaries", book_id):
+        response = summaries_table.query(
+            # progress 0 is the book manifest, chapter recaps live above 100
+            KeyConditionExpression=Key("book_id").eq(book_id) & Key("progress").between(1, percentage),
+            ScanIndexForward=False,  # Highest progress first
+        )
+    for item in response.get("Items", []):
+        # Skip placeholders for buckets that are still being generated on demand
+        if item.get("status") != PENDING_STATUS:
+            return item.get("summary", "")
+    return ""
+
+
+def _call_gemini(prompt: str, text: str) -> tuple:
+    """
+    Calls the Gemini API with the given prompt and text, with retry for 429
+    errors. Returns the generated text and the response's usage metadata.
+    """
+    api_key = get_gemini_api_key()
+    GEMINI_URL = f"{GEMINI_API_BASE}/models/{QA_MODEL}:generateContent?key={api_key}"
+
+    payload = {
+        "contents": [{"parts": [{"text": f"{prompt}{text}"}]}]
+    }
+
+    # This lambda sits behind API Gateway, so keep the retry budget short
+    max_retries = 3
+    base_wait_time = 1 # seconds
+
+    for attempt in range(max_retries):
+        try:
+            logger.info(f"Calling Gemini API for question answering (Attempt {attempt + 1}/{max_retries})...")
+            resp = requests.post(
+                GEMINI_URL,
+                headers={"Content-Type": "application/json"},
+                data=json.dumps(payload),
+                timeout=25, # API Gateway times out at 29 seconds
+            )
+            resp.raise_for_status()
+            data = resp.json()
+            logger.info("Gemini API call successful.")
+            generated_text = (
+                data.get("candidates", [{}])[0]
+                    .get("content", {})
+                    .get("parts", [{}])[0]
+                    .get("text", "")
+                    .strip()
+            )
+            return generated_text, data.get("usageMetadata", {})
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 429 and attempt < max_retries - 1:
+                wait_time = base_wait_time * (2 ** attempt)
+                logger.warning(f"Received 429 Too Many Requests. Retrying in {wait_time:.2f} seconds...")
+                time.sleep(wait_time)
+            else:
+                logger.error(f"HTTP error calling Gemini API: {e}")
+                raise
+
+    raise RuntimeError(f"Gemini API rate limit exceeded after {max_retries} retries.")
+
+
+def record_token_usage(user_id: str, book_id: str, usage: dict):
+    """Adds one answer's tokens and cost to the book's and the user's "qa" totals. Best effort."""
+    cached = usage.get("cachedContentTokenCount", 0)
+    # promptTokenCount includes the cached tokens; keep fresh and cached apart
+    prompt = usage.get("promptTokenCount", 0) - cached
+    output = usage.get("candidatesTokenCount", 0)
+    fresh_price, cached_price, output_price = GEMINI_PRICING.get(QA_MODEL, (0, 0, 0))
+    cost = (prompt * fresh_price + cached * cached_price + output * output_price) / 1_000_000
+    values = {
+        ":prompt": prompt,
+        ":cached": cached,
+        ":output": output,
+        ":calls": 1,
+        ":cost": Decimal(str(round(cost, 6))),
+        ":user": user_id,
+        ":now": int(time.time()),
+    }
+    for usage_key in (f"book#{book_id}", f"user#{user_id}#{time.strftime('%Y-%m', time.gmtime())}"):
+        try:
+            token_usage_table.update_item(
+                Key={"usage_key": usage_key, "stage": "qa"},
+                UpdateExpression="ADD prompt_tokens :prompt, cached_tokens :cached, output_tokens :output, "
+                                 "calls :calls, cost_usd :cost SET user_id = :user, updated_at = :now",
+                ExpressionAttributeValues=values,
+            )
+        except Exception as e:
+            logger.warning(f"Could not record token usage under {usage_key}: {e}")
+
+
+def answer_question(user_id: str, book_id: str, question: str, percentage: int) -> dict:
+    """Answers a question using only the parts of the book the reader has already read."""
+    index = get_book_index(user_id, book_id)
+    cutoff = math.floor(index["total_chars"] * percentage / 100)
+    # Only chunks that end at or before the reader's position are eligible
+    eligible = bisect.bisect_right(index["end_offsets"], cutoff)
+    top_ids = _bm25_top_k(index, question, eligible, QA_TOP_K)
+    summary = get_latest_summary(book_id, percentage)
+    logger.info(f"Selected {len(top_ids)} of {eligible} eligible chunks for bookId {book_id} at {percentage}%.")
+
+    if not top_ids and not summary:
+        return {"answer": "", "sources": []}
+
+    excerpts = "\n\n---\n\n".join(index["chunks"][cid]["text"] for cid in top_ids)
+    prompt = (
+        "You are helping a reader who is part-way through a book. Answer their question using ONLY "
+        "the recap and excerpts below, which cover what they have read so far. Do not reveal or "
+        "speculate about anything that happens later in the book. If the answer is not in the "
+        "provided material, say so briefly.\n\n"
+        f"Recap so far:\n{summary or '(none yet)'}\n\n"
+        f"Excerpts:\n{excerpts}\n\n"
+        "Question: "
+    )
+    with metrics.timed("gemini_answer", book_id, chunks=len(top_ids)):
+        answer, usage = _call_gemini(prompt, question)
+    record_token_usage(user_id, book_id, usage)
+    return {
+        "answer": answer,
+        "sources": [{"chunk": cid, "chapter_id": index["chunks"][cid]["chapter_id"]} for cid in top_ids],
+    }
+
+
+def lambda_handler(event, context):
+    """
+    Answers a spoiler-safe question about a book up to the reader's progress.
+    Triggered by API Gateway POST /books/{bookId}/ask.
+    Expects bookId in path parameters, user_id in request headers and a JSON body
+    of the form {"question": "...", "percentage": 40}.
+    """
+    logger.info(f"Received event: {json.dumps(event)}")
+
+    try:
+        path_parameters = event.get('pathParameters') or {}
+        book_id = path_parameters.get('bookId')
+
+        headers = event.get('headers') or {}
+        user_id = headers.get('user-id') or headers.get('User-Id') or headers.get('user_id')
+
+        try:
+            body = json.loads(event.get("body") or "{}")
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in request body: {e}")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': 'Invalid JSON in request body'})
+            }
+
+        question = (body.get('question') or '').strip()
+        if not book_id or not user_id or not question:
+            logger.warning("Missing bookId, user_id or question.")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': 'Missing bookId, user_id or question'})
+            }
+        if len(question) > MAX_QUESTION_CHARS:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': f'Question must be at most {MAX_QUESTION_CHARS} characters'})
+            }
+
+        try:
+            percentage = int(body.get('percentage'))
+            if not (0 <= percentage <= 100):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'message': 'Percentage must be between 0 and 100'})
+                }
+        except (TypeError, ValueError):
+            logger.warning(f"Invalid percentage format: {body.get('percentage')}.")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': 'Invalid percentage format'})
+            }
+
+        try:
+            result = answer_question(user_id, book_id, question, percentage)
+        except s3.exceptions.NoSuchKey:
+            logger.warning(f"No normalized book found for user {user_id}, bookId {book_id}.")
+            return {
+                'statusCode': 404,
+                'body': json.dumps({'message': 'Book not found or not processed yet'})
+            }
+
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({"book_id": book_id, "percentage": percentage, **result})
+        }
+
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {e}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'message': 'An unexpected error occurred'})
+        }
@@ -0,0 +1,189 @@
+import json
+import os
+import time
+import boto3
+import logging
+from boto3.dynamodb.conditions import Key
+from lazy_resource import LazyResource
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+REGION = os.getenv("AWS_REGION", "us-east-1")
+USER_BOOKS_TABLE_NAME = os.getenv("USER_BOOKS_TABLE_NAME", "user_books")
+# (user_id, connection_id) of every open WebSocket, written by websocketConnections
+CONNECTIONS_TABLE_NAME = os.getenv("CONNECTIONS_TABLE_NAME", "websocket_connections")
+# Management endpoint of the WebSocket API (https://{api-id}.execute-api.{region}.amazonaws.com/{stage}),
+# or tools/local_progress_broker.py in tests. Empty disables pushing; user_books is still updated.
+WEBSOCKET_ENDPOINT = os.getenv("WEBSOCKET_ENDPOINT", "")
+# processing_status only ever moves forward through these
+STATUS_ORDER = ["UPLOADED", "NORMALIZED", "PROCESSING", "READY"]
+# Stages that must report stage_done before a book is READY
+REQUIRED_STAGES = {"summaries", "characters"}
+# Event name -> pipeline stage it reports on. Other events, such as SUMMARY_FAILED and
+# CHARACTERS_FAILED when a stage gives up, are recorded as last_event and pushed as they are.
+EVENT_STAGES = {"SUMMARY_PROGRESS": "summaries", "CHARACTERS_PROGRESS": "characters"}
+STATUS_UPDATE_ATTEMPTS = 3
+
+
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+user_books_table = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE_NAME))
+connections_table = LazyResource(lambda: dynamodb.Table(CONNECTIONS_TABLE_NAME))
+websocket = (LazyResource(lambda: boto3.client("apigatewaymanagementapi", endpoint_url=WEBSOCKET_ENDPOINT,
+                                               region_name=REGION))
+             if WEBSOCKET_ENDPOINT else None)
+
+
+def status_for(item):
+    """The processing_status a user_books item has earned from the events recorded on it."""
+    stages = set(item.get("stages_done") or ())
+    if REQUIRED_STAGES <= stages:
+        return "READY"
+    if item.get("stages_started"):
+        return "PROCESSING"
+    if item.get("normalized_at"):
+        return "NORMALIZED"
+    return "UPLOADED"
+
+
+def record_event(message):
+    """
+    Folds one progress event into the user_books item and returns the item as
+    it is afterwards, or None if the book was deleted, or replaced after the
+    version the event is about was uploaded. Stages are kept as string sets,
+    so redelivered or out-of-order events change nothing.
+    """
+    sets = ["last_event = :event", "last_event_at = :at"]
+    adds = []
+    values = {":event": message["event"], ":at": int(message.get("at") or time.time() * 1000),
+              ":deleted": "DELETED", ":issued": int(message.get("issued_at") or 0)}
+
+    if message["event"] == "NORMALIZED":
+        sets.append("normalized_at = if_not_exists(normalized_at, :at)")
+        # Replace the empty placeholders written by generatePresignedUploadUrl
+        if message.get("title"):
+            sets.append("book_title = :title")
+            values[":title"] = message["title"]
+        if message.get("author"):
+            sets.append("book_author = :author")
+            values[":author"] = message["author"]
+    stage = EVENT_STAGES.get(message["event"])
+    if stage:
+        adds.append("stages_started :stage")
+        values[":stage"] = {stage}
+        if message.get("stage_done"):
+            adds.append("stages_done :stage")
+
+    update = "SET " + ", ".join(sets) + (" ADD " + ", ".join(adds) if adds else "")
+    try:
+        return user_books_table.update_item(
+            Key={"user_id": message["user_id"], "book_id": message["book_id"]},
+            UpdateExpression=update,
+            ConditionExpression="attribute_exists(book_id) AND processing_status <> :deleted AND "
+                                "(attribute_not_exists(cancelled_before) OR cancelled_before <= :issued)",
+            ExpressionAttributeValues=values,
+            ReturnValues="ALL_NEW",
+        )["Attributes"]
+    except user_books_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+
+
+def advance_status(item):
+    """
+    Moves processing_status (and the status_uploaded key of the status index)
+    forward to what the item has earned. Returns the new status, or None if
+    it did not change.
+    """
+    key = {"user_id": item["user_id"], "book_id": item["book_id"]}
+    for _ in range(STATUS_UPDATE_ATTEMPTS):
+        current = item.get("processing_status") or "UPLOADED"
+        if current not in STATUS_ORDER:
+            return None  # DELETED
+        target = status_for(item)
+        if STATUS_ORDER.index(target) <= STATUS_ORDER.index(current):
+            return None
+        try:
+            user_books_table.update_item(
+                Key=key,
+                UpdateExpression="SET processing_status = :new, status_uploaded = :status_key",
+                # Another event for the same book may have moved it in the meantime
+                ConditionExpression="processing_status = :old OR attribute_not_exists(processing_status)",
+                ExpressionAttributeValues={
+                    ":new": target,
+                    ":old": current,
+                    ":status_key": f"{target}#{int(item.get('upload_timestamp') or 0):012d}",
+                },
+            )
+            return target
+        except user_books_table.meta.client.exceptions.ConditionalCheckFailedException:
+            item = user_books_table.get_item(Key=key, ConsistentRead=True).get("Item")
+            if item is None:
+                return None
+    logger.warning(f"Gave up moving processing_status of {key['book_id']} after {STATUS_UPDATE_ATTEMPTS} attempts.")
+    return None
+
+
+def push_to_user(user_id, notification):
+    """Sends a notification to every open connection of the user; returns how many received it."""
+    if websocket is None:
+        return 0
+    response = connections_table.query(KeyConditionExpression=Key("user_id").eq(user_id))
+    data = json.dumps(notification).encode("utf-8")
+    delivered = 0
+    for connection in response.get("Items", []):
+        try:
+            websocket.post_to_connection(ConnectionId=connection["connection_id"], Data=data)
+            delivered += 1
+        except websocket.exceptions.GoneException:
+            # The client went away without $disconnect reaching us
+            connections_table.delete_item(Key={"user_id": user_id, "connection_id": connection["connection_id"]})
+        except Exception as e:
+            logger.warning(f"Could not notify connection {connection['connection_id']} of {user_id}: {e}")
+    return delivered
+
+
+def handle_event(message):
+    item = record_event(message)
+    if item is None:
+        logger.info(f"Dropping {message['event']} for deleted or replaced bookId {message['book_id']}.")
+        return
+    changed = advance_status(item)
+    status = changed or item.get("processing_status") or "UPLOADED"
+
+    notification = {
+        "type": "book_progress",
+        "book_id": message["book_id"],
+        "event": message["event"],
+        "processing_status": status,
+    }
+    for field in ("percent", "title", "author"):
+        if field in message:
+            notification[field] = message[field]
+    delivered = push_to_user(message["user_id"], notification)
+    if changed == "READY":
+        delivered += push_to_user(message["user_id"], {"type": "book_progress", "book_id": message["book_id"],
+                                                       "event": "COMPLETE", "processing_status": "READY"})
+    logger.info(f"{message['event']} for bookId {message['book_id']}: status {status}, {delivered} pushes.")
+
+
+def lambda_handler(event, context):
+    """
+    Trigger source: SQS book-progress-events-queue, fed by normalize-books and
+    the summarizers with {"user_id", "book_id", "event", "at", ...}.
+    Keeps user_books.processing_status (UPLOADED -> NORMALIZED -> PROCESSING
+    -> READY), title and author up to date and pushes each event, plus a
+    final COMPLETE, to the user's open WebSocket connections, so clients do
+    not have to poll getUserBooks while a book is processed.
+    """
+    records = event.get("Records", [])
+    logger.info(f"Received {len(records)} progress events.")
+    failures = []
+    for record in records:
+        try:
+            handle_event(json.loads(record["body"]))
+        except (json.JSONDecodeError, KeyError) as e:
+            logger.error(f"Skipping malformed progress event {record.get('messageId')}: {e}")
+        except Exception as e:
+            logger.exception(f"Failed progress event {record.get('messageId')}: {e}")
+            failures.append({"itemIdentifier": record["messageId"]})
+    return {"status": "ok", "batchItemFailures": failures}
@@ -0,0 +1,28 @@
+# Vendored from src/common/lazy_resource.py by tools/vendor_common.py. Edit it there, not here.
+"""
+Shared by the Python lambdas: tools/vendor_common.py copies it into every
+function package that imports it.
+"""
+
+import threading
+
+
+class LazyResource:
+    """
+    Stands in for a boto3 client, resource or table and creates it on first
+    use, so a cold start only pays for the clients its request path touches.
+    """
+    # Re-entrant: a table's factory resolves the lazy resource it belongs to.
+    # One lock for all of them, as boto3's default session is not thread-safe.
+    _lock = threading.RLock()
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+
+    def __getattr__(self, name):
+        if self._target is None:
+            with LazyResource._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return getattr(self._target, name)
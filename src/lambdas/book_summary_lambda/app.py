@@ -1,11 +1,22 @@
 import json
 import math
 import os
+import random
+import threading
 import time
 import boto3
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 import logging
+from boto3.dynamodb.conditions import Key
+from book_loader import NormalizedBookLoader
+from emf_metrics import EmfMetrics
+from gemini_limits import (CircuitBreaker, CircuitOpenError, DeadlineExceeded, DynamoTokenBucketStore,
+                           InMemoryTokenBucketStore, RateLimitedError, RateLimiter)
+from lazy_resource import LazyResource
+from pipeline_state import BookCancelled, CancellationChecks, JobSlots, WorkClaims, last_delivery
+from token_accounting import BudgetExceeded, TokenAccounting
 
 # Configure logging
 logger = logging.getLogger()
@@ -13,22 +24,213 @@ logger.setLevel(logging.INFO)
 
 # Constants
 PERCENT_STEP = 5
+# Chapters tagged by normalize-books as front/back matter are skipped; progress
+# percentages are measured over the narrative chapters only
+NARRATIVE_CLASS = "narrative"
+# Chapter recaps live in the same table as percentage summaries, under their own
+# sort-key range: progress = CHAPTER_PROGRESS_BASE + chapter id.
+CHAPTER_PROGRESS_BASE = 1000
+# Segments shorter than this are stored verbatim instead of being summarized
+MIN_DELTA_CHARS = int(os.getenv("MIN_DELTA_CHARS", "400"))
+# Summaries generated at upload time; anything later is generated on demand when
+# a reader asks for it through getBookSummary (100 restores full precompute).
+EAGER_PRECOMPUTE_PERCENT = int(os.getenv("EAGER_PRECOMPUTE_PERCENT", "25"))
+# progress = 0 holds the book manifest used for on-demand generation
+MANIFEST_PROGRESS = 0
+# progress = -1 holds the in-flight generation marker getBookSummary writes per book;
+# its "target" is the highest bucket readers have asked for
+GENERATION_MARKER_PROGRESS = -1
+# Status of the generation marker (and of the per-bucket placeholders older versions wrote)
+PENDING_STATUS = "PENDING"
+# Marker statuses of a book whose generation stopped short of its target: the token
+# budget ran out or the book has no text (EXHAUSTED), or the run was given up (FAILED).
+# getBookSummary serves what exists and requests nothing until the marker's retry_after.
+EXHAUSTED_STATUS = "EXHAUSTED"
+FAILED_STATUS = "FAILED"
+GENERATION_RETRY_AFTER_SECONDS = int(os.getenv("GENERATION_RETRY_AFTER_SECONDS", "3600"))
+# Queue consumed by this lambda for on-demand and resumed runs
+SUMMARY_QUEUE_URL = os.getenv("SUMMARY_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/summary-on-demand-queue")
+# Progress events for bookProgressNotifier (user_books status + pushes to clients); empty disables
+PROGRESS_EVENTS_QUEUE_URL = os.getenv("PROGRESS_EVENTS_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/book-progress-events-queue")
 # Environment variable for the summaries table name (matches SAM template)
 DDB_SUMMARIES_TABLE_NAME = os.getenv("DDB_SUMMARIES_TABLE", "summaries") # Ensure this matches your table name
 # Environment variable for the Gemini API Key directly
 GEMINI_API_KEY_ENV = os.getenv("GEMINI_API_KEY") # Renamed to avoid conflict with global var
 REGION = os.getenv("AWS_REGION", "us-east-1")
+# Base URL of the Gemini REST API (point at a local stand-in server for tests)
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+# Model used for each pipeline stage. "latency_budget_s" is the timeout for the
+# primary model; a request that exceeds it is retried once on "fallback", and a
+# model whose recent latency is over budget is skipped in favour of "fallback".
+# Override with GEMINI_MODEL_ROUTING='{"stage": {"model": ...}}' (merged per stage).
+MODEL_ROUTING = {
+    # Small incremental step: summarize a few percent of new text. The fallback is
+    # for latency only; it costs more, so budget degradation keeps the primary.
+    "delta": {"model": "gemini-2.0-flash-lite", "fallback": "gemini-2.0-flash", "latency_budget_s": 30},
+    # Fold new segment summaries into the running recap
+    "merge": {"model": "gemini-2.0-flash", "fallback": "gemini-2.0-flash-lite", "latency_budget_s": 20},
+    # Last merge of a full run (the 100% whole-book recap)
+    "final_merge": {"model": "gemini-2.5-flash", "fallback": "gemini-2.0-flash", "latency_budget_s": 45},
+}
+MODEL_ROUTING.update({
+    stage: {**MODEL_ROUTING.get(stage, {}), **route}
+    for stage, route in json.loads(os.getenv("GEMINI_MODEL_ROUTING", "{}")).items()
+})
+# Every Nth call to a model that is over budget still goes to it, so it can recover
+SLOW_MODEL_PROBE_EVERY = 10
+# Consecutive Gemini failures in one invocation before the circuit breaker opens
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "3"))
+# Longest pause taken inside the Lambda before retrying a 429; anything longer is
+# left to an SQS delay so we are not billed for idle seconds
+MAX_INLINE_BACKOFF_SECONDS = float(os.getenv("MAX_INLINE_BACKOFF_SECONDS", "1"))
+# Requests one call makes before its 429/5xx is raised; the breaker alone does not bound
+# this, as successes on other records' threads keep resetting its count
+MAX_INLINE_ATTEMPTS = int(os.getenv("MAX_INLINE_ATTEMPTS", "4"))
+# SQS delay before resuming after the breaker opens; doubles per attempt (SQS max is 900)
+RETRY_BASE_DELAY_SECONDS = int(os.getenv("RETRY_BASE_DELAY_SECONDS", "60"))
+MAX_RESUME_ATTEMPTS = int(os.getenv("MAX_RESUME_ATTEMPTS", "6"))
+# Cluster-wide Gemini request rate limit shared by every summarizer container.
+# "dynamodb" keeps the token bucket in GEMINI_RATE_LIMIT_TABLE, "memory" keeps it
+# in-process (tests and local runs), "off" disables it.
+RATE_LIMITER_BACKEND = os.getenv("RATE_LIMITER_BACKEND", "dynamodb")
+GEMINI_RATE_LIMIT_TABLE = os.getenv("GEMINI_RATE_LIMIT_TABLE", "gemini_rate_limits")
+# Provider quota in requests per second per model (also the bucket's burst size);
+# GEMINI_RATE_LIMITS='{"gemini-2.5-flash": 5}' overrides individual models
+GEMINI_RATE_LIMIT_RPS = float(os.getenv("GEMINI_RATE_LIMIT_RPS", "30"))
+GEMINI_RATE_LIMITS = json.loads(os.getenv("GEMINI_RATE_LIMITS", "{}"))
+# Longest a caller waits for capacity before giving the work back to SQS
+MAX_RATE_LIMIT_WAIT_SECONDS = float(os.getenv("MAX_RATE_LIMIT_WAIT_SECONDS", "2"))
+# SQS delay before resuming a record the limiter turned away (plus up to as much again
+# as jitter). Being throttled is not a failure: it does not count as a resume attempt.
+RATE_LIMITED_DELAY_SECONDS = int(os.getenv("RATE_LIMITED_DELAY_SECONDS", "30"))
+# SQS records processed at the same time by one invocation
+MAX_CONCURRENT_RECORDS = int(os.getenv("MAX_CONCURRENT_RECORDS", "4"))
+# Gemini requests in flight at once across all of those records
+MAX_INFLIGHT_LLM_REQUESTS = int(os.getenv("MAX_INFLIGHT_LLM_REQUESTS", "8"))
+# Time kept back from the Lambda timeout to save finished steps and enqueue the rest
+DEADLINE_SAFETY_SECONDS = float(os.getenv("DEADLINE_SAFETY_SECONDS", "20"))
+# Per-user fair scheduling (see fair_dispatcher): a book holds one of its user's
+# slots until every stage that consumes it has finished
+BOOK_JOBS_TABLE = os.getenv("BOOK_JOBS_TABLE", "book_jobs")
+USER_SCHEDULING_TABLE = os.getenv("USER_SCHEDULING_TABLE", "user_scheduling")
+STAGES_PER_BOOK = int(os.getenv("STAGES_PER_BOOK", "2"))  # summaries + characters
+# maxReceiveCount of the queue's redrive policy: a record failing on this delivery is
+# dead-lettered, so it frees its slot instead of leaving it taken for good
+MAX_RECEIVE_COUNT = int(os.getenv("MAX_RECEIVE_COUNT", "5"))
+FAIR_DISPATCHER_FUNCTION = os.getenv("FAIR_DISPATCHER_FUNCTION", "fairDispatcher")
+# Idempotency claims per (stage, book_id, content version), shared with normalize-books;
+# duplicate deliveries of a book that is already done (or being done) are skipped
+IDEMPOTENCY_TABLE = os.getenv("IDEMPOTENCY_TABLE", "pipeline_idempotency")
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "900"))
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(30 * 24 * 3600)))
+# Deleting or replacing a book sets cancelled_before (epoch ms) on its user_books row;
+# work on a version uploaded before it stops at the next step. The row is re-read at
+# most every CANCEL_CHECK_TTL_SECONDS per book.
+USER_BOOKS_TABLE_NAME = os.getenv("USER_BOOKS_TABLE_NAME", "user_books")
+CANCEL_CHECK_TTL_SECONDS = float(os.getenv("CANCEL_CHECK_TTL_SECONDS", "5"))
+# Token accounting: each run adds its Gemini tokens and cost to TOKEN_USAGE_TABLE, per
+# (book, stage) and per (user, calendar month). Past TOKEN_BUDGET_DEGRADE_AT of either
+# budget, stages switch to their cheaper fallback model; once a budget is used up the
+# run stops, keeps what it finished and is not resumed. A budget of 0 is unlimited.
+TOKEN_USAGE_TABLE = os.getenv("TOKEN_USAGE_TABLE", "token_usage")
+BOOK_TOKEN_BUDGET = int(os.getenv("BOOK_TOKEN_BUDGET", "3000000"))
+USER_MONTHLY_TOKEN_BUDGET = int(os.getenv("USER_MONTHLY_TOKEN_BUDGET", "30000000"))
+TOKEN_BUDGET_DEGRADE_AT = float(os.getenv("TOKEN_BUDGET_DEGRADE_AT", "0.8"))
+# USD per million tokens as (fresh prompt, cached prompt, output); models not listed
+# are counted at 0. GEMINI_PRICING='{"model": [0.1, 0.025, 0.4]}' overrides entries.
+GEMINI_PRICING = {
+    "gemini-2.0-flash-lite": (0.075, 0.01875, 0.30),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+}
+GEMINI_PRICING.update({model: tuple(price) for model, price in json.loads(os.getenv("GEMINI_PRICING", "{}")).items()})
+# EMF metrics (see emf_metrics); METRICS_PER_BOOK adds a book_id dimension (load tests only)
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ReadRecall/Pipeline")
+METRICS_PER_BOOK = os.getenv("METRICS_PER_BOOK", "false").lower() == "true"
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "bookSummaryLambda")
+# Memory planning (see NormalizedBookLoader.plan): a parsed book takes about BOOK_JSON_MEMORY_FACTOR
+# times its JSON size and stays in memory for the whole record; MAX_CONCURRENT_RECORDS
+# records share MEMORY_USABLE_SHARE of the function's memory.
+MEMORY_LIMIT_MB = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1024"))
+MEMORY_USABLE_SHARE = float(os.getenv("MEMORY_USABLE_SHARE", "0.6"))
+BOOK_JSON_MEMORY_FACTOR = float(os.getenv("BOOK_JSON_MEMORY_FACTOR", "6"))
+# Share of invocations that also trace Python allocations (tracemalloc slows allocation down)
+MEMORY_TRACE_SAMPLE_RATE = float(os.getenv("MEMORY_TRACE_SAMPLE_RATE", "0.05"))
+MB = 1024 * 1024
+
 
 # AWS Clients
-s3 = boto3.client("s3")
-dynamodb = boto3.resource("dynamodb", region_name=REGION)
+s3 = LazyResource(lambda: boto3.client("s3"))
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
 # Get the DynamoDB table resource using the environment variable name
-table = dynamodb.Table(DDB_SUMMARIES_TABLE_NAME)
+table = LazyResource(lambda: dynamodb.Table(DDB_SUMMARIES_TABLE_NAME))
+sqs = LazyResource(lambda: boto3.client("sqs", region_name=REGION))
+book_jobs = LazyResource(lambda: dynamodb.Table(BOOK_JOBS_TABLE))
+user_scheduling = LazyResource(lambda: dynamodb.Table(USER_SCHEDULING_TABLE))
+lambda_client = LazyResource(lambda: boto3.client("lambda", region_name=REGION))
+idempotency = LazyResource(lambda: dynamodb.Table(IDEMPOTENCY_TABLE))
+user_books = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE_NAME))
+token_usage_table = LazyResource(lambda: dynamodb.Table(TOKEN_USAGE_TABLE))
 # Removed ssm client
 
 # Global variable to store API key (fetched once from env var)
 GEMINI_API_KEY = None
 
+# Per-record state (book_id, token counts, per-model metrics, deadline); records run on separate threads
+_record_ctx = threading.local()
+# Stage timings of the book the calling thread is processing (see EmfMetrics)
+metrics = EmfMetrics(FUNCTION_NAME, METRICS_NAMESPACE, METRICS_PER_BOOK,
+                     current_book=lambda: getattr(_record_ctx, "book_id", None))
+token_accounting = TokenAccounting(token_usage_table, _record_ctx, GEMINI_PRICING, BOOK_TOKEN_BUDGET,
+                                   USER_MONTHLY_TOKEN_BUDGET, TOKEN_BUDGET_DEGRADE_AT)
+work_claims = WorkClaims(idempotency, IDEMPOTENCY_LEASE_SECONDS, IDEMPOTENCY_TTL_SECONDS)
+cancellations = CancellationChecks(user_books, CANCEL_CHECK_TTL_SECONDS)
+job_slots = JobSlots(book_jobs, user_scheduling, lambda_client, STAGES_PER_BOOK, FAIR_DISPATCHER_FUNCTION)
+book_loader = NormalizedBookLoader(s3, metrics.timed, MEMORY_LIMIT_MB * MB * MEMORY_USABLE_SHARE / MAX_CONCURRENT_RECORDS,
+                                   BOOK_JSON_MEMORY_FACTOR)
+# Shared cap on concurrent Gemini requests for the whole invocation
+_llm_slots = threading.BoundedSemaphore(MAX_INFLIGHT_LLM_REQUESTS)
+# Recent latency per model in seconds, kept for the lifetime of the container
+_latency_ewma: Dict[str, float] = {}
+_slow_model_skips: Dict[str, int] = {}
+circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD)
+
+
+def _make_rate_limiter():
+    if RATE_LIMITER_BACKEND == "memory":
+        store = InMemoryTokenBucketStore()
+    else:
+        store = DynamoTokenBucketStore(dynamodb.Table(GEMINI_RATE_LIMIT_TABLE))
+    return RateLimiter(store, GEMINI_RATE_LIMITS, GEMINI_RATE_LIMIT_RPS, MAX_RATE_LIMIT_WAIT_SECONDS)
+
+
+# Lazy, like the clients: the DynamoDB store resolves its table when it is built
+rate_limiter = None if RATE_LIMITER_BACKEND == "off" else LazyResource(_make_rate_limiter)
+
+
+def _reserve_capacity(model: str):
+    """Waits for shared capacity; the limiter failing must not stop summarization."""
+    if rate_limiter is None:
+        return
+    try:
+        rate_limiter.acquire(model)
+    except RateLimitedError:
+        # The whole cluster is at quota, which says nothing about Gemini's health: the
+        # breaker stays as it is and only this record goes back to SQS (see RATE_LIMITED_DELAY_SECONDS)
+        raise
+    except Exception as e:
+        logger.warning(f"Rate limiter unavailable, calling Gemini without a reservation: {e}")
+
+
+def _report_throttled(model: str):
+    if rate_limiter is None:
+        return
+    try:
+        rate_limiter.on_throttled(model)
+    except Exception as e:
+        logger.warning(f"Could not report 429 to the rate limiter: {e}")
+
+
 # Helpers
 def get_gemini_api_key():
     """Gets the Gemini API key directly from the environment variable."""
@@ -42,43 +244,111 @@ def get_gemini_api_key():
     return GEMINI_API_KEY
 
 def _flatten_paragraphs(book_json: dict) -> List[str]:
-    """Return a list of pure paragraph strings in reading order."""
+    """Return a list of pure paragraph strings of the narrative chapters in reading order."""
     paragraphs: List[str] = []
     for chap in book_json.get("chapters", []):
+        if chap.get("content_class", NARRATIVE_CLASS) != NARRATIVE_CLASS:
+            continue  # front/back matter is not part of the story
         for block in chap.get("content", []):
             if block.get("type") == "paragraph":
                 paragraphs.append(block["text"].strip())
     logger.info(f"Flattened book into {len(paragraphs)} paragraphs.")
     return paragraphs
 
-def _call_gemini(prompt: str, text: str) -> str:
-    """Calls the Gemini API with the given prompt and text, with retry for 429 errors."""
-    api_key = get_gemini_api_key() # Get key from the global variable (fetched from env var)
-    GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
+def _time_left():
+    """Seconds until the calling thread's record deadline, or None without one."""
+    deadline = getattr(_record_ctx, "deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
 
-    if not api_key:
-        raise RuntimeError("Gemini API key not available")
 
+def _record_latency(model: str, elapsed: float, timed_out: bool = False):
+    """Tracks per-model latency for routing decisions and the per-book metrics line."""
+    token_accounting.add_call(model, int(elapsed * 1000), timed_out)
+    # Exponentially weighted average survives across books in a warm container
+    previous = _latency_ewma.get(model)
+    _latency_ewma[model] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+
+
+def _pick_model(route: dict) -> str:
+    """Returns the primary model unless it has recently been slower than the stage budget."""
+    model, fallback, budget = route["model"], route.get("fallback"), route.get("latency_budget_s")
+    if fallback and budget and _latency_ewma.get(model, 0) > budget:
+        _slow_model_skips[model] = _slow_model_skips.get(model, 0) + 1
+        if _slow_model_skips[model] % SLOW_MODEL_PROBE_EVERY:
+            logger.info(f"{model} is averaging {_latency_ewma[model]:.1f}s (budget {budget}s); using {fallback}.")
+            return fallback
+    return model
+
+
+def _call_gemini(prompt: str, text: str, stage: str) -> str:
+    """
+    Calls the Gemini model configured for `stage` with the given prompt and
+    text, falling back to the stage's faster model when the latency budget is
+    exceeded.
+    """
+    route = MODEL_ROUTING[stage]
     payload = {
         "contents": [{"parts": [{"text": f"{prompt}{text}"}]}]
     }
 
-    # Retry logic for 429 errors
-    max_retries = 5
-    base_wait_time = 2 # seconds
+    budget = token_accounting.state()
+    if budget == "exceeded":
+        raise BudgetExceeded(f"Token budget used up; not calling Gemini for stage '{stage}'.")
+    model = _pick_model(route)
+    fallback = route.get("fallback")
+    if budget == "degrade" and fallback and token_accounting.is_cheaper(fallback, model):
+        # Close to the budget: finish the book on the cheaper model
+        model = fallback
+    timeout = route.get("latency_budget_s") if model != fallback else None
+    with metrics.timed(f"gemini_{stage}", model=model) as span:
+        try:
+            return _generate(model, payload, timeout=timeout or 60)
+        except requests.exceptions.Timeout:
+            if not fallback or model == fallback:
+                raise
+            logger.warning(f"{model} exceeded the {timeout}s budget for stage '{stage}'; retrying on {fallback}.")
+            span["model"] = fallback
+            return _generate(fallback, payload, timeout=60)
+
+
+def _generate(model: str, payload: dict, timeout: float) -> str:
+    """
+    Sends one generateContent request to `model`. 429s and 5xx responses are
+    retried after a short pause, up to MAX_INLINE_ATTEMPTS requests or until
+    the circuit breaker opens.
+    """
+    api_key = get_gemini_api_key() # Get key from the global variable (fetched from env var)
+    GEMINI_URL = f"{GEMINI_API_BASE}/models/{model}:generateContent?key={api_key}"
 
-    for attempt in range(max_retries):
+    if not api_key:
+        raise RuntimeError("Gemini API key not available")
+
+    attempt = 0
+    while True:
+        if circuit_breaker.is_open:
+            raise CircuitOpenError(f"Gemini circuit breaker is open; not calling {model}.")
+        remaining = _time_left()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"Record deadline reached; not calling {model}.")
+        attempt += 1
+        _reserve_capacity(model)
         try:
-            logger.info(f"Calling Gemini API for summarization (Attempt {attempt + 1}/{max_retries})...")
-            resp = requests.post(
-                GEMINI_URL,
-                headers={"Content-Type": "application/json"},
-                data=json.dumps(payload),
-                timeout=60, # Increased timeout for API call
-            )
+            logger.info(f"Calling {model} for summarization (attempt {attempt})...")
+            with _llm_slots:
+                started = time.monotonic()
+                resp = requests.post(
+                    GEMINI_URL,
+                    headers={"Content-Type": "application/json"},
+                    data=json.dumps(payload),
+                    # Never wait on Gemini past the record deadline
+                    timeout=timeout if remaining is None else min(timeout, remaining),
+                )
             resp.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
             data = resp.json()
+            _record_latency(model, time.monotonic() - started)
+            circuit_breaker.record_success()
             logger.info("Gemini API call successful.")
+            token_accounting.add_response(data, model)
 
             # Extract text from the response structure
             generated_text = (
@@ -92,21 +362,32 @@ def _call_gemini(prompt: str, text: str) -> str:
             return generated_text
 
         except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 429:
-                wait_time = base_wait_time * (2 ** attempt) # Exponential backoff
-                logger.warning(f"Received 429 Too Many Requests. Retrying in {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
-            else:
+            status = e.response.status_code
+            if status != 429 and status < 500:
                 logger.error(f"HTTP error calling Gemini API: {e}")
-                raise # Re-raise other HTTP errors
+                raise # Re-raise client errors, retrying will not help
+            circuit_breaker.record_failure()
+            if status == 429:
+                _report_throttled(model)
+            if attempt >= MAX_INLINE_ATTEMPTS:
+                logger.warning(f"Received {status} from {model} on all {attempt} attempts; giving up on this call.")
+                raise
+            # Brief jittered pause only; the breaker turns sustained 429s into an SQS delay
+            wait_time = min(MAX_INLINE_BACKOFF_SECONDS, 0.25 * (2 ** attempt)) * random.uniform(0.5, 1)
+            logger.warning(f"Received {status} from {model}. Retrying in {wait_time:.2f} seconds...")
+            time.sleep(wait_time)
+        except requests.exceptions.Timeout as e:
+            left = _time_left()
+            if left is not None and left <= 0:
+                raise DeadlineExceeded(f"Record deadline reached while calling {model}.") from e
+            _record_latency(model, time.monotonic() - started, timed_out=True)
+            circuit_breaker.record_failure()
+            logger.error(f"Timed out after {timeout}s calling {model}: {e}")
+            raise
         except requests.exceptions.RequestException as e:
             logger.error(f"Request error calling Gemini API: {e}")
             raise # Re-raise other request errors
 
-    # If all retries fail
-    logger.error(f"Failed to call Gemini API after {max_retries} retries due to 429 errors.")
-    raise RuntimeError(f"Gemini API rate limit exceeded after {max_retries} retries.")
-
 
 def _summarize_text_slice(text: str) -> str:
     """Generates a summary for a slice of text using the Gemini API."""
@@ -114,56 +395,206 @@ def _summarize_text_slice(text: str) -> str:
         "Provide a concise recap under 250-300 words of the following book content. "
         "Focus on key events and characters."
     )
-    try:
-        return _call_gemini(prompt, text)
-    except Exception as e:
-        logger.error(f"Failed to get summary from Gemini: {e}")
-        # fallback: truncate raw text
-        return text[:400] + " …[truncated]" if len(text) > 400 else text
+    # No fallback text on failure: a placeholder would be stored as the summary for
+    # good, so errors propagate and the step is retried later instead
+    return _call_gemini(prompt, text, "delta")
+
+
+def _summarize_delta(text: str) -> str:
+    """Summarizes one newly read segment of the book (no earlier context)."""
+    if len(text) < MIN_DELTA_CHARS:
+        # Too short to be worth an API call; the raw text is already a fine summary
+        return text.strip()
+    return _summarize_text_slice(text)
+
+
+def _merge_summaries(previous_summary: str, delta_summaries: List[str], final: bool = False) -> str:
+    """
+    Folds the summaries of newly read segments into the running recap.
+    The final (whole-book) merge is routed to the stronger model.
+    """
+    if not delta_summaries:
+        return previous_summary
+    if not previous_summary and len(delta_summaries) == 1:
+        return delta_summaries[0]
+    prompt = (
+        "Below is a recap of a book so far, followed by summaries of the sections read since. "
+        "Write an updated concise recap under 250-300 words covering everything up to the end "
+        "of the newest section. Focus on key events and characters.\n\n"
+    )
+    text = (
+        f"Recap so far:\n{previous_summary or '(start of book)'}\n\n"
+        "Newest sections:\n" + "\n\n".join(delta_summaries)
+    )
+    return _call_gemini(prompt, text, "final_merge" if final else "merge")
 
 
-def generate_percentage_summaries(book_json: dict, user_id: str, book_id: str):
-    """Generates summaries at percentage intervals and saves to DynamoDB."""
-    logger.info("Generating percentage summaries.")
+def _chapter_spans(book_json: dict) -> List[Dict]:
+    """
+    Returns the character span each chapter covers in the joined paragraph
+    text, in reading order. Chapters without paragraphs and front/back
+    matter are omitted.
+    """
+    spans: List[Dict] = []
+    offset = 0
+    for chap in book_json.get("chapters", []):
+        if chap.get("content_class", NARRATIVE_CLASS) != NARRATIVE_CLASS:
+            continue  # Not in the summarized text, so it gets no recap either
+        length = sum(
+            len(block["text"].strip())
+            for block in chap.get("content", [])
+            if block.get("type") == "paragraph"
+        )
+        if length:
+            spans.append({"id": chap.get("id"), "title": chap.get("title", ""),
+                          "start": offset, "end": offset + length})
+            offset += length
+    return spans
+
+
+def _summary_steps(start_pct: int, target_pct: int) -> List[int]:
+    """Percentages to generate after start_pct: the regular PERCENT_STEP grid plus target_pct."""
+    steps = [p for p in range(PERCENT_STEP, 101, PERCENT_STEP) if start_pct < p < target_pct]
+    if target_pct > start_pct:
+        steps.append(target_pct)
+    return steps
+
+
+def generate_percentage_summaries(book_json: dict, user_id: str, book_id: str,
+                                  target_pct: int = 100, seed: dict = None, attempt: int = 0,
+                                  issued_at: int = None):
+    """
+    Generates summaries at percentage intervals up to target_pct and a recap
+    per chapter, and saves both to DynamoDB.
+
+    The book is cut at every percentage boundary and every chapter boundary,
+    and each resulting segment is summarized exactly once. A percentage
+    summary is the previous percentage summary merged with the segment
+    summaries read since, and a chapter recap is the concatenation of its
+    segment summaries, so no part of the book is sent to Gemini twice.
+
+    `seed` is a previously stored percentage item to continue from; its
+    summary and open chapter state let a later run pick up where it stopped.
+    If the Gemini circuit breaker opens or a call fails (timeout, connection
+    error, 5xx), the steps finished so far are saved and the rest is
+    re-enqueued with an SQS delay (`attempt` counts these).
+    Running out of the record deadline does the same, without the delay if
+    the run saved at least one new step. A run the rate limiter turns away is
+    resumed after RATE_LIMITED_DELAY_SECONDS without counting an attempt.
+    After MAX_RESUME_ATTEMPTS the run is given up (see mark_summary_failed).
+    If the book is deleted or replaced (see CancellationChecks) the run stops before
+    the next step and saves nothing. Once the token budget is used up (see
+    TokenAccounting.state) the finished steps are saved and the run is not resumed.
+    Returns the percentage reached once the run is over: target_pct, or less
+    if the budget was used up or the book has no text. None if the run was
+    handed to a continuation, given up or cancelled.
+    """
+    logger.info(f"Generating percentage and chapter summaries up to {target_pct}%.")
     full_text = "".join(_flatten_paragraphs(book_json))
     total_len = len(full_text)
     if total_len == 0:
         logger.warning("Book has no text content for summarization.")
-        return
+        publish_progress(user_id, book_id, "SUMMARY_PROGRESS", percent=0, stage_done=True, issued_at=issued_at)
+        return 0
+
+    token_accounting.reset()
+    token_usage, model_metrics = token_accounting.usage()
+    token_accounting.load_budget(user_id, book_id)
 
-    last_end = -1 # To avoid processing the same slice if total_len is small
+    start_pct = int(seed["progress"]) if seed else 0
+    last_end = math.ceil(total_len * start_pct / 100)
+    running_summary = seed.get("summary", "") if seed else ""
+    chapter_deltas: List[str] = list(seed.get("open_chapter_deltas", [])) if seed else [] # Segment summaries of the chapter being read
+
+    chapters = _chapter_spans(book_json)
+    chapter_idx = 0
+    while chapter_idx < len(chapters) and chapters[chapter_idx]["end"] <= last_end:
+        chapter_idx += 1
 
     summaries_to_save: List[Dict] = [] # Collect items for batch write
+    last_pct = start_pct
+
+    interrupted = None
+    try:
+        for pct in _summary_steps(start_pct, target_pct):
+            if cancellations.is_cancelled(user_id, book_id, issued_at):
+                raise BookCancelled(f"bookId {book_id} was deleted or replaced")
+            end_idx = math.ceil(total_len * pct / 100)
+            # Ensure we process a new slice of text (the requested bucket is always written)
+            if end_idx == last_end and pct != target_pct:
+                continue
 
-    # Process at each PERCENT_STEP interval
-    for pct in range(PERCENT_STEP, 101, PERCENT_STEP):
-        end_idx = math.ceil(total_len * pct / 100)
-        # Ensure we process a new slice of text
-        if end_idx == last_end:
-            continue
-
-        slice_text = full_text[:end_idx]
-        logger.info(f"Processing up to {pct}% ({len(slice_text)} characters) for summary.")
-
-        # Generate summary for this slice
-        summary_text = _summarize_text_slice(slice_text)
-
-        # Prepare item for DynamoDB
-        # --- ITEM KEYS MATCHING YOUR PROVIDED SUMMARIES TABLE SCHEMA ---
-        summaries_to_save.append({
-            "book_id": book_id, # Partition Key (String)
-            "progress": pct,    # Sort Key (Number)
-            "user_id": user_id, # Attribute (String)
-            "summary": summary_text, # Attribute (String)
-            "createdAt": int(time.time()) # Add a timestamp (Number)
-        })
-        # --- END ITEM KEYS ---
-        last_end = end_idx
-
-        # Optional: Add a small delay between API calls if needed to manage rate limits
-        # The retry logic in _call_gemini handles rate limits more directly,
-        # but a small delay here could still help space out initial calls.
-        # time.sleep(1) # Adjust as necessary
+            logger.info(f"Processing {last_end}-{end_idx} of {total_len} characters for the {pct}% summary.")
+
+            # Split the new text at chapter boundaries so each segment belongs to one chapter
+            step_deltas: List[str] = []
+            seg_start = last_end
+            while seg_start < end_idx:
+                chapter = chapters[chapter_idx]
+                seg_end = min(end_idx, chapter["end"])
+                delta = _summarize_delta(full_text[seg_start:seg_end])
+                step_deltas.append(delta)
+                chapter_deltas.append(delta)
+
+                if seg_end == chapter["end"]:
+                    # Chapter finished: its recap is built from the segments already summarized
+                    summaries_to_save.append({
+                        "book_id": book_id,                                # Partition Key (String)
+                        "progress": CHAPTER_PROGRESS_BASE + chapter["id"], # Sort Key (Number)
+                        "user_id": user_id,
+                        "chapter_id": chapter["id"],
+                        "chapter_title": chapter["title"],
+                        "summary": "\n\n".join(chapter_deltas),
+                        "createdAt": int(time.time())
+                    })
+                    chapter_deltas = []
+                    chapter_idx += 1
+                seg_start = seg_end
+
+            running_summary = _merge_summaries(running_summary, step_deltas, final=(pct == 100))
+
+            # Prepare item for DynamoDB
+            # --- ITEM KEYS MATCHING YOUR PROVIDED SUMMARIES TABLE SCHEMA ---
+            summaries_to_save.append({
+                "book_id": book_id, # Partition Key (String)
+                "progress": pct,    # Sort Key (Number)
+                "user_id": user_id, # Attribute (String)
+                "summary": running_summary, # Attribute (String)
+                # Resume state for on-demand generation past this point
+                "open_chapter_deltas": list(chapter_deltas),
+                "createdAt": int(time.time()) # Add a timestamp (Number)
+            })
+            # --- END ITEM KEYS ---
+            last_end = end_idx
+            last_pct = pct
+    except CircuitOpenError as e:
+        logger.warning(f"Stopping summaries for bookId {book_id} at {last_pct}%: {e}")
+        interrupted = e
+    except BookCancelled as e:
+        logger.info(f"Stopping summaries at {last_pct}% without saving: {e}")
+        interrupted = e
+    except BudgetExceeded as e:
+        logger.warning(f"Stopping summaries for bookId {book_id} at {last_pct}%: {e}")
+        interrupted = e
+    except requests.exceptions.RequestException as e:
+        # The failed step is redone by the continuation; the ones before it are kept
+        logger.warning(f"Gemini call failed for bookId {book_id} after {last_pct}%: {e}")
+        interrupted = e
+
+    # Structured line so token spend can be compared per book in Logs Insights
+    logger.info(json.dumps({"event": "token_usage", "stage": "summary", "book_id": book_id,
+                            "from_pct": start_pct, "to_pct": target_pct, **token_usage,
+                            "cost_usd": round(token_accounting.cost_usd(model_metrics), 6), "models": model_metrics}))
+    token_accounting.record(user_id, book_id, "summary")
+
+    # The last check may be seconds old: rows written after the cancellation would
+    # survive cleanupBook, so it is repeated right before saving
+    if (summaries_to_save and not isinstance(interrupted, BookCancelled)
+            and cancellations.is_cancelled(user_id, book_id, issued_at, fresh=True)):
+        interrupted = BookCancelled(f"bookId {book_id} was deleted or replaced")
+        logger.info(f"Dropping summaries up to {last_pct}% without saving: {interrupted}")
+    if isinstance(interrupted, BookCancelled):
+        return None  # cleanupBook removes what earlier runs saved
 
     if summaries_to_save:
         logger.info(f"Saving {len(summaries_to_save)} summary entries to DynamoDB.")
@@ -172,24 +603,220 @@ def generate_percentage_summaries(book_json: dict, user_id: str, book_id: str):
     else:
         logger.warning("No summary entries generated to save.")
 
-
-def download_json_from_s3(s3_bucket: str, s3_key: str) -> dict:
-    """Downloads and parses a JSON file from S3."""
-    logger.info(f"Downloading JSON from s3://{s3_bucket}/{s3_key}")
+    # Over budget, the book is as done as it will get: readers get what was saved
+    finished = not interrupted or isinstance(interrupted, BudgetExceeded)
+    if last_pct > start_pct or finished:
+        # The upload's eager range being done is what the summaries stage owes a new book
+        publish_progress(user_id, book_id, "SUMMARY_PROGRESS", percent=last_pct,
+                         stage_done=finished and target_pct >= EAGER_PRECOMPUTE_PERCENT,
+                         issued_at=issued_at)
+
+    if finished:
+        return last_pct
+    if isinstance(interrupted, DeadlineExceeded) and last_pct > start_pct:
+        # Out of time after making progress: pick up again straight away
+        continued = enqueue_continuation(book_id, target_pct, attempt, delay_seconds=0)
+    elif isinstance(interrupted, RateLimitedError):
+        # Our own limiter had no capacity: try again later, as the same attempt
+        continued = enqueue_continuation(book_id, target_pct, attempt, delay_seconds=_rate_limited_delay())
+    else:
+        # Everything up to the last saved step is kept; the continuation resumes from it.
+        # A deadline with no step saved counts as a failed attempt too, or a step that
+        # never fits in the remaining time would be retried forever.
+        continued = enqueue_continuation(book_id, target_pct, attempt + 1)
+    if not continued:
+        mark_summary_failed(user_id, book_id, target_pct, last_pct, issued_at)
+    return None
+
+
+def publish_progress(user_id: str, book_id: str, event: str, **details):
+    """Sends a progress event to bookProgressNotifier. Best effort: never fails the book."""
+    if not PROGRESS_EVENTS_QUEUE_URL:
+        return
     try:
-        obj = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-        book_json = json.loads(obj["Body"].read().decode('utf-8')) # Decode bytes to string
-        logger.info("Successfully downloaded and parsed JSON.")
-        return book_json
+        sqs.send_message(
+            QueueUrl=PROGRESS_EVENTS_QUEUE_URL,
+            MessageBody=json.dumps({"user_id": user_id, "book_id": book_id, "event": event,
+                                    "at": int(time.time() * 1000), **details}),
+        )
     except Exception as e:
-        logger.error(f"Failed to download or parse JSON from s3://{s3_bucket}/{s3_key}: {e}")
-        raise # Re-raise the exception
+        logger.warning(f"Could not publish {event} for bookId {book_id}: {e}")
+
+
+def _rate_limited_delay() -> int:
+    """SQS delay for a record turned away by the rate limiter, jittered so they do not all return at once."""
+    return min(900, RATE_LIMITED_DELAY_SECONDS + random.randint(0, RATE_LIMITED_DELAY_SECONDS))
+
+
+def enqueue_continuation(book_id: str, target_pct: int, attempt: int, delay_seconds: int = None) -> bool:
+    """
+    Re-enqueues the unfinished part of a run as an on-demand request for
+    target_pct, delayed so Gemini has time to recover. The continuation seeds
+    from the last saved summary, so finished steps are never redone.
+    Returns False once MAX_RESUME_ATTEMPTS is exhausted.
+    """
+    if attempt > MAX_RESUME_ATTEMPTS:
+        logger.error(f"Giving up on summaries for bookId {book_id} after {MAX_RESUME_ATTEMPTS} resume attempts.")
+        return False
+    delay = delay_seconds if delay_seconds is not None else min(900, RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)))
+    _touch_generation_marker(book_id, delay)
+    sqs.send_message(
+        QueueUrl=SUMMARY_QUEUE_URL,
+        MessageBody=json.dumps({"book_id": book_id, "progress": target_pct, "attempt": attempt}),
+        DelaySeconds=delay,
+    )
+    logger.info(f"Re-enqueued summaries for bookId {book_id} up to {target_pct}% in {delay}s (attempt {attempt}).")
+    return True
+
+
+def _touch_generation_marker(book_id: str, delay_seconds: int = 0):
+    """
+    Keeps the book's generation marker from going stale while its job waits
+    in the queue, so getBookSummary does not start a second job meanwhile.
+    """
+    try:
+        table.update_item(
+            Key={"book_id": book_id, "progress": GENERATION_MARKER_PROGRESS},
+            UpdateExpression="SET requested_at = :at",
+            ConditionExpression="attribute_exists(progress)",
+            ExpressionAttributeValues={":at": int(time.time()) + delay_seconds},
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass  # No marker: the book was cleaned up
+
+
+def hold_generation_marker(book_id: str, target_pct: int):
+    """
+    Takes the book's generation marker for an upload's eager run, so a reader
+    asking past the eager range meanwhile raises its target instead of
+    starting a second job.
+    """
+    table.put_item(Item={"book_id": book_id, "progress": GENERATION_MARKER_PROGRESS,
+                         "target": target_pct, "requested_at": int(time.time()), "status": PENDING_STATUS})
+
+
+def stop_generation(book_id: str, status: str, reached_pct: int):
+    """
+    Replaces the book's generation marker with a terminal one (EXHAUSTED_STATUS
+    or FAILED_STATUS): getBookSummary serves the summaries up to reached_pct and
+    requests no generation until GENERATION_RETRY_AFTER_SECONDS have passed.
+    """
+    table.put_item(Item={"book_id": book_id, "progress": GENERATION_MARKER_PROGRESS, "status": status,
+                         "reached": reached_pct, "retry_after": int(time.time()) + GENERATION_RETRY_AFTER_SECONDS})
+
+
+def finish_generation(book_id: str, done_pct: int, exhausted: bool = False):
+    """
+    Ends the book's generation once a run reached done_pct: drops the
+    generation marker, unless a reader raised its target meanwhile. Then the
+    job carries on to the new target instead, seeded from the steps just
+    saved, so overlapping requests never generate a step twice.
+    `exhausted` (no further step can be generated) leaves a terminal marker.
+    """
+    if exhausted:
+        stop_generation(book_id, EXHAUSTED_STATUS, done_pct)
+        return
+    key = {"book_id": book_id, "progress": GENERATION_MARKER_PROGRESS}
+    try:
+        table.delete_item(
+            Key=key,
+            ConditionExpression="attribute_not_exists(target) OR target <= :done",
+            ExpressionAttributeValues={":done": done_pct},
+        )
+        return
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+    marker = table.get_item(Key=key, ConsistentRead=True).get("Item")
+    if not marker:
+        return  # Dropped meanwhile (the book was cleaned up)
+    target = int(marker["target"])
+    _touch_generation_marker(book_id)
+    sqs.send_message(
+        QueueUrl=SUMMARY_QUEUE_URL,
+        MessageBody=json.dumps({"book_id": book_id, "progress": target}),
+    )
+    logger.info(f"Summaries for bookId {book_id} reached {done_pct}%; carrying on to {target}%.")
+
+
+def mark_summary_failed(user_id: str, book_id: str, target_pct: int, last_pct: int, issued_at: int = None):
+    """
+    Records a run that was given up: leaves a FAILED generation marker, so
+    reads request it afresh only after GENERATION_RETRY_AFTER_SECONDS, and
+    reports SUMMARY_FAILED, which bookProgressNotifier stores as the book's
+    last event and pushes to clients.
+    """
+    stop_generation(book_id, FAILED_STATUS, last_pct)
+    publish_progress(user_id, book_id, "SUMMARY_FAILED", percent=last_pct, target=target_pct,
+                     issued_at=issued_at)
+
+
+def save_manifest(user_id: str, book_id: str, s3_bucket: str, s3_key: str, issued_at: int = None,
+                  normalized_bytes: int = None):
+    """
+    Stores where the normalized book lives so summaries past the eager range
+    can be generated later from nothing but the book_id.
+    """
+    item = {
+        "book_id": book_id,
+        "progress": MANIFEST_PROGRESS,
+        "kind": "manifest",
+        "user_id": user_id,
+        "bucket_name": s3_bucket,
+        "json_s3_key": s3_key,
+        "eager_until": EAGER_PRECOMPUTE_PERCENT,
+        # Upload time of this version, so on-demand runs can tell if it was replaced
+        "issued_at": issued_at or 0,
+        "createdAt": int(time.time())
+    }
+    if normalized_bytes:
+        item["normalized_bytes"] = normalized_bytes  # for book_loader on on-demand runs
+    table.put_item(Item=item)
+
+
+def _latest_ready_summary(book_id: str, before_pct: int):
+    """Returns the highest stored percentage summary below before_pct, or None."""
+    if before_pct <= 1:
+        return None
+    response = table.query(
+        KeyConditionExpression=Key("book_id").eq(book_id) & Key("progress").between(1, before_pct - 1),
+        ScanIndexForward=False,  # Highest progress first
+    )
+    for item in response.get("Items", []):
+        # Skip markers left by getBookSummary for buckets that are still being generated
+        if item.get("status") != PENDING_STATUS:
+            return item
+    return None
+
+
+def generate_summary_on_demand(book_id: str, target_pct: int, attempt: int = 0):
+    """Generates the summaries up to a progress bucket requested by a reader."""
+    manifest = table.get_item(Key={"book_id": book_id, "progress": MANIFEST_PROGRESS}).get("Item")
+    if not manifest:
+        logger.error(f"No manifest for bookId {book_id}; cannot generate {target_pct}% on demand.")
+        return
+
+    existing = table.get_item(Key={"book_id": book_id, "progress": target_pct}).get("Item")
+    if existing and existing.get("status") != PENDING_STATUS:
+        logger.info(f"{target_pct}% summary for bookId {book_id} already exists, nothing to do.")
+        finish_generation(book_id, target_pct)
+        return
+
+    seed = _latest_ready_summary(book_id, target_pct)
+    with book_loader.open(manifest["bucket_name"], manifest["json_s3_key"], manifest.get("normalized_bytes")) as book_json:
+        reached = generate_percentage_summaries(book_json, manifest["user_id"], book_id,
+                                                target_pct=target_pct, seed=seed, attempt=attempt,
+                                                issued_at=int(manifest.get("issued_at", 0)))
+    if reached is not None:
+        # Over budget, a run for a higher target would stop straight away too
+        finish_generation(book_id, reached,
+                          exhausted=reached < target_pct or token_accounting.state() == "exceeded")
+
 
 def batch_put_summaries(items: List[dict]):
     """Writes a batch of items to the DynamoDB table."""
     logger.info(f"Starting batch write to DynamoDB table: {DDB_SUMMARIES_TABLE_NAME}")
     try:
-        with table.batch_writer() as batch:
+        with metrics.timed("batch_put_summaries", items=len(items)), table.batch_writer() as batch:
             for item in items:
                 # Ensure item keys match DynamoDB attribute names (book_id, progress)
                 batch.put_item(Item=item)
@@ -199,59 +826,132 @@ def batch_put_summaries(items: List[dict]):
         raise # Re-raise the exception
 
 
-def lambda_handler(event, context):
+def process_record(sqs_record: dict) -> bool:
     """
-    Trigger source: SQS message containing payload from normalize-books lambda.
-    Downloads normalized JSON, generates summaries at intervals,
-    and saves to DynamoDB.
+    Handles one SQS record. Returns False for records that are skipped as
+    unusable; raises if the record should be redelivered.
     """
-    logger.info(f"Received SQS event with {len(event.get('Records', []))} records.")
-
-    processed_records_count = 0
+    logger.info(f"Processing SQS record: {sqs_record.get('messageId')}")
+    # Parse the JSON payload from the SQS message body
+    message_body = sqs_record.get("body")
+    if not message_body:
+        logger.warning("SQS record body is empty, skipping.")
+        return False
 
-    # SQS events contain a list of records
-    for sqs_record in event.get("Records", []):
-        logger.info(f"Processing SQS record: {sqs_record.get('messageId')}")
-        try:
-            # Parse the JSON payload from the SQS message body
-            message_body = sqs_record.get("body")
-            if not message_body:
-                logger.warning("SQS record body is empty, skipping.")
-                continue
+    try:
+        # The body is the JSON payload sent by the previous lambda
+        payload = json.loads(message_body)
+        logger.info(f"Successfully parsed SQS message body as payload: {payload}")
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse SQS message body as JSON: {e}, skipping record.")
+        return False # Skip this record if body is not valid JSON
+    # Tags the stage timings of this record (see metrics)
+    _record_ctx.book_id = payload.get('book_id')
+
+    # On-demand request from getBookSummary: {"book_id": ..., "progress": N}
+    if payload.get('progress') is not None and payload.get('book_id'):
+        generate_summary_on_demand(payload['book_id'], int(payload['progress']),
+                                   attempt=int(payload.get('attempt', 0)))
+        return True
+
+    # Extract details from the parsed payload
+    user_id = payload.get('user_id')
+    book_id = payload.get('book_id')
+    s3_bucket = payload.get('bucket_name') # This should be the normalized data bucket
+    s3_key = payload.get('json_s3_key')
+
+    # Validate extracted data
+    if not all([user_id, book_id, s3_bucket, s3_key]):
+        logger.error(f"Missing required data in payload: {payload}, skipping record.")
+        return False # Skip if essential data is missing
+
+    # Messages from before content versions were passed along are not deduplicated
+    content_version = payload.get('content_version')
+    if content_version and not work_claims.claim("summaries", book_id, content_version):
+        logger.info(f"Skipping duplicate of bookId {book_id} version {content_version}.")
+        return True
 
-            try:
-                # The body is the JSON payload sent by the previous lambda
-                payload = json.loads(message_body)
-                logger.info(f"Successfully parsed SQS message body as payload: {payload}")
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse SQS message body as JSON: {e}, skipping record.")
-                continue # Skip this record if body is not valid JSON
+    try:
+        if cancellations.is_cancelled(user_id, book_id, payload.get('issued_at')):
+            # Also keeps a stale version from overwriting the replacement's manifest
+            logger.info(f"Skipping bookId {book_id}: deleted or replaced since this version was uploaded.")
+            job_slots.release(payload, "summaries")
+            if content_version:
+                work_claims.complete("summaries", book_id, content_version)
+            return True
+
+        # Download normalized JSON file from S3
+        with book_loader.open(s3_bucket, s3_key, payload.get('normalized_bytes')) as book_json:
+            # Record where the book lives, then precompute the eager range only;
+            # later progress buckets are generated when a reader first asks for them.
+            # An interrupted run continues as an on-demand request, so the claim is done either way.
+            save_manifest(user_id, book_id, s3_bucket, s3_key, issued_at=payload.get('issued_at'),
+                          normalized_bytes=payload.get('normalized_bytes'))
+            hold_generation_marker(book_id, EAGER_PRECOMPUTE_PERCENT)
+            reached = generate_percentage_summaries(book_json, user_id, book_id,
+                                                    target_pct=EAGER_PRECOMPUTE_PERCENT,
+                                                    issued_at=payload.get('issued_at'))
+        if reached is not None:
+            finish_generation(book_id, reached, exhausted=reached < EAGER_PRECOMPUTE_PERCENT
+                              or token_accounting.state() == "exceeded")
+    except Exception:
+        if content_version:
+            work_claims.release("summaries", book_id, content_version)
+        # A redelivery still needs the slot (and must not count the stage as done)
+        if last_delivery(sqs_record, MAX_RECEIVE_COUNT):
+            job_slots.release(payload, "summaries")
+        raise
+
+    # Resumed and on-demand runs are not tied to the upload's slot
+    job_slots.release(payload, "summaries")
+    if content_version:
+        work_claims.complete("summaries", book_id, content_version)
+    return True
+
+
+@metrics.memory_profiled(MEMORY_LIMIT_MB, MEMORY_TRACE_SAMPLE_RATE)
+def lambda_handler(event, context):
+    """
+    Trigger source: SQS message containing payload from normalize-books lambda,
+    or an on-demand request {"book_id": ..., "progress": N} from getBookSummary
+    (on summary-priority-queue, or summary-on-demand-queue for continuations).
+    Downloads normalized JSON, generates summaries at intervals,
+    and saves to DynamoDB.
 
-            # Extract details from the parsed payload
-            user_id = payload.get('user_id')
-            book_id = payload.get('book_id')
-            s3_bucket = payload.get('bucket_name') # This should be the normalized data bucket
-            s3_key = payload.get('json_s3_key')
+    Up to MAX_CONCURRENT_RECORDS records are processed at once, sharing
+    MAX_INFLIGHT_LLM_REQUESTS Gemini requests. Records still running near
+    the Lambda timeout save what they have and continue in a new message.
+    """
+    records = event.get("Records", [])
+    logger.info(f"Received SQS event with {len(records)} records.")
+    # A new invocation gets a fresh chance to reach Gemini
+    circuit_breaker.reset()
 
-            # Validate extracted data
-            if not all([user_id, book_id, s3_bucket, s3_key]):
-                logger.error(f"Missing required data in payload: {payload}, skipping record.")
-                continue # Skip if essential data is missing
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_SAFETY_SECONDS
 
-            # Download normalized JSON file from S3
-            book_json = download_json_from_s3(s3_bucket, s3_key)
+    def run(sqs_record):
+        _record_ctx.deadline = deadline
+        return process_record(sqs_record)
 
-            # Generate summaries at percentage intervals and save to DB
-            generate_percentage_summaries(book_json, user_id, book_id)
+    processed_records_count = 0
+    # Records to redeliver (ReportBatchItemFailures); everything else is deleted from the queue
+    batch_item_failures = []
 
-            logger.info(f"✓ Successfully processed SQS record {sqs_record.get('messageId')}")
-            processed_records_count += 1
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_RECORDS, len(records)))) as pool:
+        futures = [(sqs_record, pool.submit(run, sqs_record)) for sqs_record in records]
 
+    for sqs_record, future in futures:
+        try:
+            if future.result():
+                logger.info(f"✓ Successfully processed SQS record {sqs_record.get('messageId')}")
+                processed_records_count += 1
         except Exception as exc:
             # Log the exception for the specific SQS record that failed
             logger.exception(f"❌ Failed processing SQS record {sqs_record.get('messageId')}: {exc}")
-            # Depending on your retry strategy and batch size, you might re-raise
-            # or handle errors differently. Logging and continuing is safer for batches > 1.
+            # Only this message is redelivered; the rest of the batch is not redone
+            batch_item_failures.append({"itemIdentifier": sqs_record.get("messageId")})
 
     # Return a success response
     return {
@@ -260,5 +960,6 @@ def lambda_handler(event, context):
             "status": "summary_summarization_batch_complete",
             "processed_count": processed_records_count,
             "message": f"Successfully processed {processed_records_count} SQS records for summary summarization."
-        })
+        }),
+        "batchItemFailures": batch_item_failures,
     }
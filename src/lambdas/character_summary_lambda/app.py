@@ -1,11 +1,23 @@
 import json
 import math
 import os
+import random
+import threading
 import time
+import bisect
+import itertools
 import boto3
 import requests
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 import logging
+from book_loader import NormalizedBookLoader
+from emf_metrics import EmfMetrics
+from gemini_limits import (CircuitBreaker, CircuitOpenError, DeadlineExceeded, DynamoTokenBucketStore,
+                           InMemoryTokenBucketStore, RateLimitedError, RateLimiter)
+from lazy_resource import LazyResource
+from pipeline_state import BookCancelled, CancellationChecks, JobSlots, WorkClaims, last_delivery
+from token_accounting import BudgetExceeded, TokenAccounting
 
 # Configure logging
 logger = logging.getLogger()
@@ -13,22 +25,191 @@ logger.setLevel(logging.INFO)
 
 # Constants
 PERCENT_STEP = 5
+# Chapters tagged by normalize-books as front/back matter are skipped; progress
+# percentages are measured over the narrative chapters only
+NARRATIVE_CLASS = "narrative"
 # Environment variable for the characters table name (matches SAM template)
 # Assuming your template uses DDB_CHARACTER_SUMMARIES_TABLE for the table name
 DDB_TABLE_NAME = os.getenv("DDB_CHARACTER_SUMMARIES_TABLE", "characters") # Ensure this matches your table name
 # Environment variable for the Gemini API Key directly
 GEMINI_API_KEY_ENV = os.getenv("GEMINI_API_KEY") # Use API_KEY env var
 REGION = os.getenv("AWS_REGION", "us-east-1")
+# Base URL of the Gemini REST API (point at a local stand-in server for tests)
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+# Model used for each pipeline stage. "latency_budget_s" is the timeout for the
+# primary model; a request that exceeds it is retried once on "fallback", and a
+# model whose recent latency is over budget is skipped in favour of "fallback".
+# Override with GEMINI_MODEL_ROUTING='{"stage": {"model": ...}}' (merged per stage).
+MODEL_ROUTING = {
+    # Character list for everything read so far
+    "characters": {"model": "gemini-2.0-flash", "fallback": "gemini-2.0-flash-lite", "latency_budget_s": 40},
+}
+MODEL_ROUTING.update({
+    stage: {**MODEL_ROUTING.get(stage, {}), **route}
+    for stage, route in json.loads(os.getenv("GEMINI_MODEL_ROUTING", "{}")).items()
+})
+# Every Nth call to a model that is over budget still goes to it, so it can recover
+SLOW_MODEL_PROBE_EVERY = 10
+# Consecutive Gemini failures in one invocation before the circuit breaker opens
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "3"))
+# Longest pause taken inside the Lambda before retrying a 429; anything longer is
+# left to an SQS delay so we are not billed for idle seconds
+MAX_INLINE_BACKOFF_SECONDS = float(os.getenv("MAX_INLINE_BACKOFF_SECONDS", "1"))
+# Requests one call makes before its 429/5xx is raised; the breaker alone does not bound
+# this, as successes on other records' threads keep resetting its count
+MAX_INLINE_ATTEMPTS = int(os.getenv("MAX_INLINE_ATTEMPTS", "4"))
+# SQS delay before resuming after the breaker opens; doubles per attempt (SQS max is 900)
+RETRY_BASE_DELAY_SECONDS = int(os.getenv("RETRY_BASE_DELAY_SECONDS", "60"))
+MAX_RESUME_ATTEMPTS = int(os.getenv("MAX_RESUME_ATTEMPTS", "6"))
+# Cluster-wide Gemini request rate limit shared by every summarizer container.
+# "dynamodb" keeps the token bucket in GEMINI_RATE_LIMIT_TABLE, "memory" keeps it
+# in-process (tests and local runs), "off" disables it.
+RATE_LIMITER_BACKEND = os.getenv("RATE_LIMITER_BACKEND", "dynamodb")
+GEMINI_RATE_LIMIT_TABLE = os.getenv("GEMINI_RATE_LIMIT_TABLE", "gemini_rate_limits")
+# Provider quota in requests per second per model (also the bucket's burst size);
+# GEMINI_RATE_LIMITS='{"gemini-2.5-flash": 5}' overrides individual models
+GEMINI_RATE_LIMIT_RPS = float(os.getenv("GEMINI_RATE_LIMIT_RPS", "30"))
+GEMINI_RATE_LIMITS = json.loads(os.getenv("GEMINI_RATE_LIMITS", "{}"))
+# Longest a caller waits for capacity before giving the work back to SQS
+MAX_RATE_LIMIT_WAIT_SECONDS = float(os.getenv("MAX_RATE_LIMIT_WAIT_SECONDS", "2"))
+# SQS delay before resuming a record the limiter turned away (plus up to as much again
+# as jitter). Being throttled is not a failure: it does not count as a resume attempt.
+RATE_LIMITED_DELAY_SECONDS = int(os.getenv("RATE_LIMITED_DELAY_SECONDS", "30"))
+# SQS records processed at the same time by one invocation
+MAX_CONCURRENT_RECORDS = int(os.getenv("MAX_CONCURRENT_RECORDS", "4"))
+# Gemini requests in flight at once across all of those records
+MAX_INFLIGHT_LLM_REQUESTS = int(os.getenv("MAX_INFLIGHT_LLM_REQUESTS", "8"))
+# Time kept back from the Lambda timeout to save finished steps and enqueue the rest
+DEADLINE_SAFETY_SECONDS = float(os.getenv("DEADLINE_SAFETY_SECONDS", "20"))
+# Queue consumed by this lambda that receives resumed runs
+CHARACTER_RETRY_QUEUE_URL = os.getenv("CHARACTER_RETRY_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/character-retry-queue")
+# Progress events for bookProgressNotifier (user_books status + pushes to clients); empty disables
+PROGRESS_EVENTS_QUEUE_URL = os.getenv("PROGRESS_EVENTS_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/book-progress-events-queue")
+# When enabled the normalized book is registered once as Gemini cached content and
+# every progress step references it instead of re-sending the text inline.
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() == "true"
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# Per-user fair scheduling (see fair_dispatcher): a book holds one of its user's
+# slots until every stage that consumes it has finished
+BOOK_JOBS_TABLE = os.getenv("BOOK_JOBS_TABLE", "book_jobs")
+USER_SCHEDULING_TABLE = os.getenv("USER_SCHEDULING_TABLE", "user_scheduling")
+STAGES_PER_BOOK = int(os.getenv("STAGES_PER_BOOK", "2"))  # summaries + characters
+# maxReceiveCount of the queue's redrive policy: a record failing on this delivery is
+# dead-lettered, so it frees its slot instead of leaving it taken for good
+MAX_RECEIVE_COUNT = int(os.getenv("MAX_RECEIVE_COUNT", "5"))
+FAIR_DISPATCHER_FUNCTION = os.getenv("FAIR_DISPATCHER_FUNCTION", "fairDispatcher")
+# Idempotency claims per (stage, book_id, content version), shared with normalize-books;
+# duplicate deliveries of a book that is already done (or being done) are skipped
+IDEMPOTENCY_TABLE = os.getenv("IDEMPOTENCY_TABLE", "pipeline_idempotency")
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "900"))
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(30 * 24 * 3600)))
+# Deleting or replacing a book sets cancelled_before (epoch ms) on its user_books row;
+# work on a version uploaded before it stops at the next step. The row is re-read at
+# most every CANCEL_CHECK_TTL_SECONDS per book.
+USER_BOOKS_TABLE_NAME = os.getenv("USER_BOOKS_TABLE_NAME", "user_books")
+CANCEL_CHECK_TTL_SECONDS = float(os.getenv("CANCEL_CHECK_TTL_SECONDS", "5"))
+# Token accounting: each run adds its Gemini tokens and cost to TOKEN_USAGE_TABLE, per
+# (book, stage) and per (user, calendar month). Past TOKEN_BUDGET_DEGRADE_AT of either
+# budget, stages switch to their cheaper fallback model; once a budget is used up the
+# run stops, keeps what it finished and is not resumed. A budget of 0 is unlimited.
+TOKEN_USAGE_TABLE = os.getenv("TOKEN_USAGE_TABLE", "token_usage")
+BOOK_TOKEN_BUDGET = int(os.getenv("BOOK_TOKEN_BUDGET", "3000000"))
+USER_MONTHLY_TOKEN_BUDGET = int(os.getenv("USER_MONTHLY_TOKEN_BUDGET", "30000000"))
+TOKEN_BUDGET_DEGRADE_AT = float(os.getenv("TOKEN_BUDGET_DEGRADE_AT", "0.8"))
+# USD per million tokens as (fresh prompt, cached prompt, output); models not listed
+# are counted at 0. GEMINI_PRICING='{"model": [0.1, 0.025, 0.4]}' overrides entries.
+GEMINI_PRICING = {
+    "gemini-2.0-flash-lite": (0.075, 0.01875, 0.30),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+}
+GEMINI_PRICING.update({model: tuple(price) for model, price in json.loads(os.getenv("GEMINI_PRICING", "{}")).items()})
+# EMF metrics (see emf_metrics); METRICS_PER_BOOK adds a book_id dimension (load tests only)
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ReadRecall/Pipeline")
+METRICS_PER_BOOK = os.getenv("METRICS_PER_BOOK", "false").lower() == "true"
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "characterSummaryLambda")
+# Memory planning (see NormalizedBookLoader.plan): a parsed book takes about BOOK_JSON_MEMORY_FACTOR
+# times its JSON size and stays in memory for the whole record; MAX_CONCURRENT_RECORDS
+# records share MEMORY_USABLE_SHARE of the function's memory.
+MEMORY_LIMIT_MB = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1024"))
+MEMORY_USABLE_SHARE = float(os.getenv("MEMORY_USABLE_SHARE", "0.6"))
+BOOK_JSON_MEMORY_FACTOR = float(os.getenv("BOOK_JSON_MEMORY_FACTOR", "6"))
+# Share of invocations that also trace Python allocations (tracemalloc slows allocation down)
+MEMORY_TRACE_SAMPLE_RATE = float(os.getenv("MEMORY_TRACE_SAMPLE_RATE", "0.05"))
+MB = 1024 * 1024
+
 
 # AWS Clients
-s3 = boto3.client("s3")
-dynamodb = boto3.resource("dynamodb", region_name=REGION)
-table = dynamodb.Table(DDB_TABLE_NAME)
+s3 = LazyResource(lambda: boto3.client("s3"))
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+table = LazyResource(lambda: dynamodb.Table(DDB_TABLE_NAME))
+sqs = LazyResource(lambda: boto3.client("sqs", region_name=REGION))
+book_jobs = LazyResource(lambda: dynamodb.Table(BOOK_JOBS_TABLE))
+user_scheduling = LazyResource(lambda: dynamodb.Table(USER_SCHEDULING_TABLE))
+lambda_client = LazyResource(lambda: boto3.client("lambda", region_name=REGION))
+idempotency = LazyResource(lambda: dynamodb.Table(IDEMPOTENCY_TABLE))
+user_books = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE_NAME))
+token_usage_table = LazyResource(lambda: dynamodb.Table(TOKEN_USAGE_TABLE))
 # Removed ssm client
 
 # Global variable to store API key (fetched once from env var)
 GEMINI_API_KEY = None
 
+# Per-record state (book_id, token counts, per-model metrics, deadline); records run on separate threads
+_record_ctx = threading.local()
+# Stage timings of the book the calling thread is processing (see EmfMetrics)
+metrics = EmfMetrics(FUNCTION_NAME, METRICS_NAMESPACE, METRICS_PER_BOOK,
+                     current_book=lambda: getattr(_record_ctx, "book_id", None))
+token_accounting = TokenAccounting(token_usage_table, _record_ctx, GEMINI_PRICING, BOOK_TOKEN_BUDGET,
+                                   USER_MONTHLY_TOKEN_BUDGET, TOKEN_BUDGET_DEGRADE_AT)
+work_claims = WorkClaims(idempotency, IDEMPOTENCY_LEASE_SECONDS, IDEMPOTENCY_TTL_SECONDS)
+cancellations = CancellationChecks(user_books, CANCEL_CHECK_TTL_SECONDS)
+job_slots = JobSlots(book_jobs, user_scheduling, lambda_client, STAGES_PER_BOOK, FAIR_DISPATCHER_FUNCTION)
+book_loader = NormalizedBookLoader(s3, metrics.timed, MEMORY_LIMIT_MB * MB * MEMORY_USABLE_SHARE / MAX_CONCURRENT_RECORDS,
+                                   BOOK_JSON_MEMORY_FACTOR)
+# Shared cap on concurrent Gemini requests for the whole invocation
+_llm_slots = threading.BoundedSemaphore(MAX_INFLIGHT_LLM_REQUESTS)
+# Recent latency per model in seconds, kept for the lifetime of the container
+_latency_ewma: Dict[str, float] = {}
+_slow_model_skips: Dict[str, int] = {}
+circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD)
+
+
+def _make_rate_limiter():
+    if RATE_LIMITER_BACKEND == "memory":
+        store = InMemoryTokenBucketStore()
+    else:
+        store = DynamoTokenBucketStore(dynamodb.Table(GEMINI_RATE_LIMIT_TABLE))
+    return RateLimiter(store, GEMINI_RATE_LIMITS, GEMINI_RATE_LIMIT_RPS, MAX_RATE_LIMIT_WAIT_SECONDS)
+
+
+# Lazy, like the clients: the DynamoDB store resolves its table when it is built
+rate_limiter = None if RATE_LIMITER_BACKEND == "off" else LazyResource(_make_rate_limiter)
+
+
+def _reserve_capacity(model: str):
+    """Waits for shared capacity; the limiter failing must not stop summarization."""
+    if rate_limiter is None:
+        return
+    try:
+        rate_limiter.acquire(model)
+    except RateLimitedError:
+        # The whole cluster is at quota, which says nothing about Gemini's health: the
+        # breaker stays as it is and only this record goes back to SQS (see RATE_LIMITED_DELAY_SECONDS)
+        raise
+    except Exception as e:
+        logger.warning(f"Rate limiter unavailable, calling Gemini without a reservation: {e}")
+
+
+def _report_throttled(model: str):
+    if rate_limiter is None:
+        return
+    try:
+        rate_limiter.on_throttled(model)
+    except Exception as e:
+        logger.warning(f"Could not report 429 to the rate limiter: {e}")
+
+
 # Helpers
 def get_gemini_api_key():
     """Gets the Gemini API key directly from the environment variable."""
@@ -42,43 +223,115 @@ def get_gemini_api_key():
     return GEMINI_API_KEY
 
 def _flatten_paragraphs(book_json: dict) -> List[str]:
-    """Return a list of pure paragraph strings in reading order."""
+    """Return a list of pure paragraph strings of the narrative chapters in reading order."""
     paragraphs: List[str] = []
     for chap in book_json.get("chapters", []):
+        if chap.get("content_class", NARRATIVE_CLASS) != NARRATIVE_CLASS:
+            continue  # front/back matter is not part of the story
         for block in chap.get("content", []):
             if block.get("type") == "paragraph":
                 paragraphs.append(block["text"].strip())
     logger.info(f"Flattened book into {len(paragraphs)} paragraphs.")
     return paragraphs
 
-def _call_gemini(prompt: str, text: str) -> str:
-    """Calls the Gemini API with the given prompt and text, with retry for 429 errors."""
-    api_key = get_gemini_api_key() # Get key from the global variable (fetched from env var)
-    GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
+def _time_left():
+    """Seconds until the calling thread's record deadline, or None without one."""
+    deadline = getattr(_record_ctx, "deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
 
-    if not api_key:
-        raise RuntimeError("Gemini API key not available")
 
+def _record_latency(model: str, elapsed: float, timed_out: bool = False):
+    """Tracks per-model latency for routing decisions and the per-book metrics line."""
+    token_accounting.add_call(model, int(elapsed * 1000), timed_out)
+    # Exponentially weighted average survives across books in a warm container
+    previous = _latency_ewma.get(model)
+    _latency_ewma[model] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+
+
+def _pick_model(route: dict) -> str:
+    """Returns the primary model unless it has recently been slower than the stage budget."""
+    model, fallback, budget = route["model"], route.get("fallback"), route.get("latency_budget_s")
+    if fallback and budget and _latency_ewma.get(model, 0) > budget:
+        _slow_model_skips[model] = _slow_model_skips.get(model, 0) + 1
+        if _slow_model_skips[model] % SLOW_MODEL_PROBE_EVERY:
+            logger.info(f"{model} is averaging {_latency_ewma[model]:.1f}s (budget {budget}s); using {fallback}.")
+            return fallback
+    return model
+
+
+def _call_gemini(prompt: str, text: str, stage: str, cached_content: str = None) -> str:
+    """
+    Calls the Gemini model configured for `stage` with the given prompt and
+    text, falling back to the stage's faster model when the latency budget is
+    exceeded.
+    """
+    route = MODEL_ROUTING[stage]
     payload = {
         "contents": [{"parts": [{"text": f"{prompt}{text}"}]}]
     }
+    if cached_content:
+        # The book itself is already on the provider side; only the instruction is sent
+        payload["cachedContent"] = cached_content
+
+    budget = token_accounting.state()
+    if budget == "exceeded":
+        raise BudgetExceeded(f"Token budget used up; not calling Gemini for stage '{stage}'.")
+    # Cached content is bound to the model it was created for, so no rerouting
+    model = route["model"] if cached_content else _pick_model(route)
+    fallback = route.get("fallback")
+    if budget == "degrade" and fallback and not cached_content:
+        # Close to the budget: finish the book on the cheaper model
+        model = fallback
+    timeout = route.get("latency_budget_s") if model != fallback else None
+    with metrics.timed(f"gemini_{stage}", model=model, cached=bool(cached_content)) as span:
+        try:
+            return _generate(model, payload, timeout=timeout or 60)
+        except requests.exceptions.Timeout:
+            if not fallback or model == fallback or cached_content:
+                raise
+            logger.warning(f"{model} exceeded the {timeout}s budget for stage '{stage}'; retrying on {fallback}.")
+            span["model"] = fallback
+            return _generate(fallback, payload, timeout=60)
+
 
-    # Retry logic for 429 errors
-    max_retries = 5
-    base_wait_time = 2 # seconds
+def _generate(model: str, payload: dict, timeout: float) -> str:
+    """
+    Sends one generateContent request to `model`. 429s and 5xx responses are
+    retried after a short pause, up to MAX_INLINE_ATTEMPTS requests or until
+    the circuit breaker opens.
+    """
+    api_key = get_gemini_api_key() # Get key from the global variable (fetched from env var)
+    GEMINI_URL = f"{GEMINI_API_BASE}/models/{model}:generateContent?key={api_key}"
 
-    for attempt in range(max_retries):
+    if not api_key:
+        raise RuntimeError("Gemini API key not available")
+
+    attempt = 0
+    while True:
+        if circuit_breaker.is_open:
+            raise CircuitOpenError(f"Gemini circuit breaker is open; not calling {model}.")
+        remaining = _time_left()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"Record deadline reached; not calling {model}.")
+        attempt += 1
+        _reserve_capacity(model)
         try:
-            logger.info(f"Calling Gemini API for character extraction (Attempt {attempt + 1}/{max_retries})...")
-            resp = requests.post(
-                GEMINI_URL,
-                headers={"Content-Type": "application/json"},
-                data=json.dumps(payload),
-                timeout=60, # Increased timeout for API call
-            )
+            logger.info(f"Calling {model} for character extraction (attempt {attempt})...")
+            with _llm_slots:
+                started = time.monotonic()
+                resp = requests.post(
+                    GEMINI_URL,
+                    headers={"Content-Type": "application/json"},
+                    data=json.dumps(payload),
+                    # Never wait on Gemini past the record deadline
+                    timeout=timeout if remaining is None else min(timeout, remaining),
+                )
             resp.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
             data = resp.json()
+            _record_latency(model, time.monotonic() - started)
+            circuit_breaker.record_success()
             logger.info("Gemini API call successful.")
+            token_accounting.add_response(data, model)
 
             # Extract text from the response structure
             generated_text = (
@@ -92,103 +345,246 @@ def _call_gemini(prompt: str, text: str) -> str:
             return generated_text
 
         except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 429:
-                wait_time = base_wait_time * (2 ** attempt) # Exponential backoff
-                logger.warning(f"Received 429 Too Many Requests. Retrying in {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
-            else:
+            status = e.response.status_code
+            if status != 429 and status < 500:
                 logger.error(f"HTTP error calling Gemini API: {e}")
-                raise # Re-raise other HTTP errors
+                raise # Re-raise client errors, retrying will not help
+            circuit_breaker.record_failure()
+            if status == 429:
+                _report_throttled(model)
+            if attempt >= MAX_INLINE_ATTEMPTS:
+                logger.warning(f"Received {status} from {model} on all {attempt} attempts; giving up on this call.")
+                raise
+            # Brief jittered pause only; the breaker turns sustained 429s into an SQS delay
+            wait_time = min(MAX_INLINE_BACKOFF_SECONDS, 0.25 * (2 ** attempt)) * random.uniform(0.5, 1)
+            logger.warning(f"Received {status} from {model}. Retrying in {wait_time:.2f} seconds...")
+            time.sleep(wait_time)
+        except requests.exceptions.Timeout as e:
+            left = _time_left()
+            if left is not None and left <= 0:
+                raise DeadlineExceeded(f"Record deadline reached while calling {model}.") from e
+            _record_latency(model, time.monotonic() - started, timed_out=True)
+            circuit_breaker.record_failure()
+            logger.error(f"Timed out after {timeout}s calling {model}: {e}")
+            raise
         except requests.exceptions.RequestException as e:
             logger.error(f"Request error calling Gemini API: {e}")
             raise # Re-raise other request errors
 
-    # If all retries fail
-    logger.error(f"Failed to call Gemini API after {max_retries} retries due to 429 errors.")
-    raise RuntimeError(f"Gemini API rate limit exceeded after {max_retries} retries.")
+
+def create_book_cache(paragraphs: List[str]):
+    """
+    Registers the whole book as Gemini cached content, with every paragraph
+    numbered so a request can say how far the reader has got.
+    Returns the cached content name, or None if the book could not be cached
+    (e.g. it is below the provider's minimum size), in which case callers fall
+    back to sending text inline.
+    """
+    api_key = get_gemini_api_key()
+    numbered = "\n\n".join(f"[P{i}] {p}" for i, p in enumerate(paragraphs, start=1))
+    payload = {
+        # Cached calls always use the stage's primary model (caches are per model)
+        "model": f"models/{MODEL_ROUTING['characters']['model']}",
+        "contents": [{"role": "user", "parts": [{"text": numbered}]}],
+        "ttl": f"{CONTEXT_CACHE_TTL_SECONDS}s",
+    }
+    try:
+        with metrics.timed("gemini_cache_create", paragraphs=len(paragraphs)):
+            resp = requests.post(
+                f"{GEMINI_API_BASE}/cachedContents?key={api_key}",
+                headers={"Content-Type": "application/json"},
+                data=json.dumps(payload),
+                timeout=60,
+            )
+            resp.raise_for_status()
+        name = resp.json().get("name")
+        logger.info(f"Registered book as Gemini cached content {name}.")
+        return name
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Could not create Gemini cached content, sending text inline instead: {e}")
+        return None
+
+
+def delete_book_cache(name: str):
+    """Deletes cached content early instead of paying storage until its TTL expires."""
+    try:
+        requests.delete(f"{GEMINI_API_BASE}/{name}?key={get_gemini_api_key()}", timeout=10)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Failed to delete Gemini cached content {name}: {e}")
+
+
+CHARACTERS_PROMPT = (
+    "Provide a concise list of all the characters appeared in the book similar to x-ray feature of prime video. "
+    "This character list should also have a one liner about the character. "
+    "Just give me the list and not anything else."
+)
 
 
 def _get_characters(text: str) -> str:
     """Generates a character list using the Gemini API."""
-    prompt = (
-        "Provide a concise list of all the characters appeared in the book similar to x-ray feature of prime video. "
-        "This character list should also have a one liner about the character. "
-        "Just give me the list and not anything else."
+    # No fallback text on failure: a placeholder would be stored as the character
+    # list for good, so errors propagate and the step is retried later instead
+    return _call_gemini(CHARACTERS_PROMPT, text, "characters")
+
+
+def _cache_unavailable(error: Exception) -> bool:
+    """True if Gemini rejected a request because its cached content is gone (expired or deleted)."""
+    if not isinstance(error, requests.exceptions.HTTPError) or error.response is None:
+        return False
+    return error.response.status_code in (400, 403, 404) and "cachedcontent" in error.response.text.lower()
+
+
+def _get_characters_cached(cache_name: str, last_paragraph: int) -> Optional[str]:
+    """
+    Generates a character list for paragraphs 1..last_paragraph of a cached
+    book. Returns None if the cached content has expired, so the caller can
+    send the text inline instead; any other error is raised.
+    """
+    instruction = (
+        f" The book is provided in context with numbered paragraphs. Only use paragraphs [P1] "
+        f"through [P{last_paragraph}]; ignore everything after [P{last_paragraph}] so nothing "
+        "the reader has not reached yet is revealed."
     )
     try:
-        return _call_gemini(prompt, text)
-    except Exception as e:
-        logger.error(f"Failed to get characters from Gemini: {e}")
-        # fallback: truncate raw text
-        return text[:400] + " …[truncated]" if len(text) > 400 else text
+        return _call_gemini(CHARACTERS_PROMPT, instruction, "characters", cached_content=cache_name)
+    except requests.exceptions.HTTPError as e:
+        if not _cache_unavailable(e):
+            raise
+        logger.warning(f"Gemini cached content {cache_name} is no longer available: {e}")
+        return None
 
-def generate_percentage_characters(book_json: dict, user_id: str, book_id: str) -> List[Dict]:
-    """Generates character lists at percentage intervals and saves to DynamoDB."""
+
+def generate_percentage_characters(book_json: dict, user_id: str, book_id: str, start_pct: int = 0,
+                                   issued_at: int = None) -> Tuple[List[Dict], Optional[Exception]]:
+    """
+    Generates character lists at percentage intervals after start_pct and
+    saves to DynamoDB. Stops early (keeping the finished steps) if the Gemini
+    circuit breaker opens, a Gemini call fails or the record deadline passes;
+    the caller re-enqueues the rest. Also stops early, for good, once the
+    token budget is used up. Returns the saved items and the exception that
+    stopped the run early, if any. Raises BookCancelled, without saving, if
+    the book is deleted or replaced mid-run.
+    """
     logger.info("Generating percentage characters.")
-    full_text = "".join(_flatten_paragraphs(book_json))
+    paragraphs = _flatten_paragraphs(book_json)
+    full_text = "".join(paragraphs)
     total_len = len(full_text)
     if total_len == 0:
         logger.warning("Book has no text content.")
-        return []
+        return [], None
+
+    token_accounting.reset()
+    token_usage, model_metrics = token_accounting.usage()
+    token_accounting.load_budget(user_id, book_id)
+    cache_name = create_book_cache(paragraphs) if GEMINI_CONTEXT_CACHE else None
+    context_cache = bool(cache_name)
+    # End offset of every paragraph in full_text, to map a cut point to "up to paragraph N"
+    paragraph_ends = list(itertools.accumulate(len(p) for p in paragraphs))
 
     characters_to_save: List[Dict] = []
-    last_end = -1 # To avoid processing the same slice if total_len is small
-
-    # Process at each PERCENT_STEP interval
-    for pct in range(PERCENT_STEP, 101, PERCENT_STEP):
-        end_idx = math.ceil(total_len * pct / 100)
-        # Ensure we process a new slice of text
-        if end_idx == last_end:
-            continue
-
-        slice_text = full_text[:end_idx]
-        logger.info(f"Processing up to {pct}% ({len(slice_text)} characters).")
-
-        # Generate characters for this slice
-        text_characters = _get_characters(slice_text)
-
-        # Prepare item for DynamoDB
-        # --- ITEM KEYS MATCHING YOUR PROVIDED CHARACTERS TABLE SCHEMA ---
-        characters_to_save.append({
-            "book_id": book_id, # Partition Key (String)
-            "progress": pct,    # Sort Key (Number)
-            "user_id": user_id, # Attribute (String)
-            "characters": text_characters, # Attribute (String)
-            "createdAt": int(time.time()) # Add a timestamp (Number)
-        })
-        # --- END ITEM KEYS ---
-        last_end = end_idx
-
-        # Optional: Add a small delay between API calls if needed to manage rate limits
-        # The retry logic in _call_gemini handles rate limits more directly,
-        # but a small delay here could still help space out initial calls.
-        # time.sleep(1) # Adjust as necessary
+    interrupted = None
+    last_end = math.ceil(total_len * start_pct / 100) if start_pct else -1 # To avoid processing the same slice if total_len is small
 
+    try:
+        # Process at each PERCENT_STEP interval
+        for pct in range(start_pct + PERCENT_STEP, 101, PERCENT_STEP):
+            end_idx = math.ceil(total_len * pct / 100)
+            # Ensure we process a new slice of text
+            if end_idx == last_end:
+                continue
+            if cancellations.is_cancelled(user_id, book_id, issued_at):
+                raise BookCancelled(f"bookId {book_id} was deleted or replaced")
+
+            logger.info(f"Processing up to {pct}% ({end_idx} characters).")
+
+            # Generate characters for this slice
+            text_characters = ""
+            if cache_name:
+                # The paragraph containing the cut point is the last one the reader has started
+                last_paragraph = bisect.bisect_left(paragraph_ends, end_idx) + 1
+                text_characters = _get_characters_cached(cache_name, last_paragraph)
+                if text_characters is None:
+                    cache_name = None  # Expired: the rest of the run sends the text inline
+            if not text_characters:
+                text_characters = _get_characters(full_text[:end_idx])
+
+            # Prepare item for DynamoDB
+            # --- ITEM KEYS MATCHING YOUR PROVIDED CHARACTERS TABLE SCHEMA ---
+            characters_to_save.append({
+                "book_id": book_id, # Partition Key (String)
+                "progress": pct,    # Sort Key (Number)
+                "user_id": user_id, # Attribute (String)
+                "characters": text_characters, # Attribute (String)
+                "createdAt": int(time.time()) # Add a timestamp (Number)
+            })
+            # --- END ITEM KEYS ---
+            last_end = end_idx
+    except (CircuitOpenError, BudgetExceeded, requests.exceptions.RequestException) as e:
+        logger.warning(f"Stopping character lists for bookId {book_id}: {e}")
+        interrupted = e
+    finally:
+        if cache_name:
+            delete_book_cache(cache_name)
+
+    # Structured line so cached versus fresh tokens can be compared per book in Logs Insights
+    logger.info(json.dumps({"event": "token_usage", "stage": "characters", "book_id": book_id,
+                            "context_cache": context_cache, **token_usage,
+                            "cost_usd": round(token_accounting.cost_usd(model_metrics), 6), "models": model_metrics}))
+    token_accounting.record(user_id, book_id, "characters")
+
+    # The last check may be seconds old: rows written after the cancellation would
+    # survive cleanupBook, so it is repeated right before saving
+    if characters_to_save and cancellations.is_cancelled(user_id, book_id, issued_at, fresh=True):
+        raise BookCancelled(f"bookId {book_id} was deleted or replaced")
     if characters_to_save:
         logger.info(f"Saving {len(characters_to_save)} character entries to DynamoDB.")
         batch_put_characters(characters_to_save)
     else:
         logger.warning("No character entries generated to save.")
 
-    return characters_to_save # Return the list of items saved
+    return characters_to_save, interrupted
 
-def download_json_from_s3(s3_bucket: str, s3_key: str) -> dict:
-    """Downloads and parses a JSON file from S3."""
-    logger.info(f"Downloading JSON from s3://{s3_bucket}/{s3_key}")
+def publish_progress(user_id: str, book_id: str, event: str, **details):
+    """Sends a progress event to bookProgressNotifier. Best effort: never fails the book."""
+    if not PROGRESS_EVENTS_QUEUE_URL:
+        return
     try:
-        obj = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-        book_json = json.loads(obj["Body"].read().decode('utf-8')) # Decode bytes to string
-        logger.info("Successfully downloaded and parsed JSON.")
-        return book_json
+        sqs.send_message(
+            QueueUrl=PROGRESS_EVENTS_QUEUE_URL,
+            MessageBody=json.dumps({"user_id": user_id, "book_id": book_id, "event": event,
+                                    "at": int(time.time() * 1000), **details}),
+        )
     except Exception as e:
-        logger.error(f"Failed to download or parse JSON from s3://{s3_bucket}/{s3_key}: {e}")
-        raise # Re-raise the exception
+        logger.warning(f"Could not publish {event} for bookId {book_id}: {e}")
+
+def _rate_limited_delay() -> int:
+    """SQS delay for a record turned away by the rate limiter, jittered so they do not all return at once."""
+    return min(900, RATE_LIMITED_DELAY_SECONDS + random.randint(0, RATE_LIMITED_DELAY_SECONDS))
+
+
+def enqueue_continuation(payload: dict, resume_from: int, attempt: int, delay_seconds: int = None) -> bool:
+    """
+    Re-enqueues the rest of a book after the circuit breaker opened or a
+    Gemini call failed, delayed so Gemini has time to recover. Steps up to resume_from are already saved.
+    Returns False once MAX_RESUME_ATTEMPTS is exhausted.
+    """
+    if attempt > MAX_RESUME_ATTEMPTS:
+        logger.error(f"Giving up on characters for bookId {payload.get('book_id')} after {MAX_RESUME_ATTEMPTS} resume attempts.")
+        return False
+    delay = delay_seconds if delay_seconds is not None else min(900, RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)))
+    sqs.send_message(
+        QueueUrl=CHARACTER_RETRY_QUEUE_URL,
+        MessageBody=json.dumps({**payload, "resume_from": resume_from, "attempt": attempt}),
+        DelaySeconds=delay,
+    )
+    logger.info(f"Re-enqueued characters for bookId {payload.get('book_id')} from {resume_from}% in {delay}s (attempt {attempt}).")
+    return True
 
 def batch_put_characters(items: List[dict]):
     """Writes a batch of items to the DynamoDB table."""
     logger.info(f"Starting batch write to DynamoDB table: {DDB_TABLE_NAME}")
     try:
-        with table.batch_writer() as batch:
+        with metrics.timed("batch_put_characters", items=len(items)), table.batch_writer() as batch:
             for item in items:
                 # Ensure item keys match DynamoDB attribute names (book_id, progress)
                 batch.put_item(Item=item)
@@ -198,59 +594,145 @@ def batch_put_characters(items: List[dict]):
         raise # Re-raise the exception
 
 
+def process_record(sqs_record: dict) -> bool:
+    """
+    Handles one SQS record. Returns False for records that are skipped as
+    unusable; raises if the record should be redelivered.
+    """
+    logger.info(f"Processing SQS record: {sqs_record.get('messageId')}")
+    # Parse the JSON payload from the SQS message body
+    message_body = sqs_record.get("body")
+    if not message_body:
+        logger.warning("SQS record body is empty, skipping.")
+        return False
+
+    try:
+        # The body is the JSON payload sent by the previous lambda
+        payload = json.loads(message_body)
+        logger.info(f"Successfully parsed SQS message body as payload: {payload}")
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse SQS message body as JSON: {e}, skipping record.")
+        return False # Skip this record if body is not valid JSON
+    # Tags the stage timings of this record (see metrics)
+    _record_ctx.book_id = payload.get('book_id')
+
+    # Extract details from the parsed payload
+    user_id = payload.get('user_id')
+    book_id = payload.get('book_id')
+    s3_bucket = payload.get('bucket_name') # This should be the normalized data bucket
+    s3_key = payload.get('json_s3_key')
+
+    # Validate extracted data
+    if not all([user_id, book_id, s3_bucket, s3_key]):
+        logger.error(f"Missing required data in payload: {payload}, skipping record.")
+        return False # Skip if essential data is missing
+
+    # Messages from before content versions were passed along are not deduplicated
+    content_version = payload.get('content_version')
+    if content_version and not work_claims.claim("characters", book_id, content_version):
+        logger.info(f"Skipping duplicate of bookId {book_id} version {content_version}.")
+        return True
+
+    continued = False
+    try:
+        # Download normalized JSON file from S3
+        with book_loader.open(s3_bucket, s3_key, payload.get('normalized_bytes')) as book_json:
+            # Generate characters at percentage intervals and save to DB
+            start_pct = int(payload.get('resume_from', 0))
+            try:
+                saved, interrupted = generate_percentage_characters(book_json, user_id, book_id, start_pct=start_pct,
+                                                       issued_at=payload.get('issued_at'))
+            except BookCancelled as e:
+                # Nothing to resume; cleanupBook removes what earlier runs saved
+                logger.info(f"Stopping characters: {e}")
+                token_accounting.record(user_id, book_id, "characters")
+                job_slots.release(payload, "characters")
+                if content_version:
+                    work_claims.complete("characters", book_id, content_version)
+                return True
+
+        resume_from = int(saved[-1]["progress"]) if saved else start_pct
+        attempt = int(payload.get('attempt', 0))
+        unfinished = resume_from < 100 and interrupted and not isinstance(interrupted, BudgetExceeded)
+        if unfinished and isinstance(interrupted, DeadlineExceeded) and resume_from > start_pct:
+            # Out of time after making progress: pick up again straight away
+            continued = enqueue_continuation(payload, resume_from, attempt, delay_seconds=0)
+        elif unfinished and isinstance(interrupted, RateLimitedError):
+            # Our own limiter had no capacity: try again later, as the same attempt
+            continued = enqueue_continuation(payload, resume_from, attempt, delay_seconds=_rate_limited_delay())
+        elif unfinished:
+            # Gemini is unavailable or a call failed: resume after the last saved step
+            # later instead of waiting here (with the breaker open, later records in
+            # this batch end up here immediately). A deadline with no step saved counts
+            # as a failed attempt too, or a step that never fits would be retried forever.
+            continued = enqueue_continuation(payload, resume_from, attempt + 1)
+        if unfinished and not continued:
+            # Given up after MAX_RESUME_ATTEMPTS: the stage is not done, it failed
+            publish_progress(user_id, book_id, "CHARACTERS_FAILED", percent=resume_from,
+                             issued_at=payload.get('issued_at'))
+        else:
+            publish_progress(user_id, book_id, "CHARACTERS_PROGRESS", percent=resume_from,
+                             stage_done=not continued, issued_at=payload.get('issued_at'))
+    except Exception:
+        if content_version:
+            work_claims.release("characters", book_id, content_version)
+        # A redelivery still needs the slot (and must not count the stage as done)
+        if not continued and last_delivery(sqs_record, MAX_RECEIVE_COUNT):
+            job_slots.release(payload, "characters")
+        raise
+
+    # A continuation carries the job_id along and keeps the slot
+    if not continued:
+        job_slots.release(payload, "characters")
+    if content_version:
+        if continued:
+            # The continuation is the same book version: let it take the claim
+            work_claims.release("characters", book_id, content_version)
+        else:
+            work_claims.complete("characters", book_id, content_version)
+    return True
+
+@metrics.memory_profiled(MEMORY_LIMIT_MB, MEMORY_TRACE_SAMPLE_RATE)
 def lambda_handler(event, context):
     """
     Trigger source: SQS message containing payload from normalize-books lambda.
     Downloads normalized JSON, generates character summaries at intervals,
     and saves to DynamoDB.
-    """
-    logger.info(f"Received SQS event with {len(event.get('Records', []))} records.")
 
-    processed_records_count = 0
+    Up to MAX_CONCURRENT_RECORDS records are processed at once, sharing
+    MAX_INFLIGHT_LLM_REQUESTS Gemini requests. Records still running near
+    the Lambda timeout save what they have and continue in a new message.
+    """
+    records = event.get("Records", [])
+    logger.info(f"Received SQS event with {len(records)} records.")
+    # A new invocation gets a fresh chance to reach Gemini
+    circuit_breaker.reset()
 
-    # SQS events contain a list of records
-    for sqs_record in event.get("Records", []):
-        logger.info(f"Processing SQS record: {sqs_record.get('messageId')}")
-        try:
-            # Parse the JSON payload from the SQS message body
-            message_body = sqs_record.get("body")
-            if not message_body:
-                logger.warning("SQS record body is empty, skipping.")
-                continue
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_SAFETY_SECONDS
 
-            try:
-                # The body is the JSON payload sent by the previous lambda
-                payload = json.loads(message_body)
-                logger.info(f"Successfully parsed SQS message body as payload: {payload}")
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse SQS message body as JSON: {e}, skipping record.")
-                continue # Skip this record if body is not valid JSON
-
-            # Extract details from the parsed payload
-            user_id = payload.get('user_id')
-            book_id = payload.get('book_id')
-            s3_bucket = payload.get('bucket_name') # This should be the normalized data bucket
-            s3_key = payload.get('json_s3_key')
-
-            # Validate extracted data
-            if not all([user_id, book_id, s3_bucket, s3_key]):
-                logger.error(f"Missing required data in payload: {payload}, skipping record.")
-                continue # Skip if essential data is missing
-
-            # Download normalized JSON file from S3
-            book_json = download_json_from_s3(s3_bucket, s3_key)
+    def run(sqs_record):
+        _record_ctx.deadline = deadline
+        return process_record(sqs_record)
 
-            # Generate characters at percentage intervals and save to DB
-            generate_percentage_characters(book_json, user_id, book_id)
+    processed_records_count = 0
+    # Records to redeliver (ReportBatchItemFailures); everything else is deleted from the queue
+    batch_item_failures = []
 
-            logger.info(f"✓ Successfully processed SQS record {sqs_record.get('messageId')}")
-            processed_records_count += 1
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_RECORDS, len(records)))) as pool:
+        futures = [(sqs_record, pool.submit(run, sqs_record)) for sqs_record in records]
 
+    for sqs_record, future in futures:
+        try:
+            if future.result():
+                logger.info(f"✓ Successfully processed SQS record {sqs_record.get('messageId')}")
+                processed_records_count += 1
         except Exception as exc:
             # Log the exception for the specific SQS record that failed
             logger.exception(f"❌ Failed processing SQS record {sqs_record.get('messageId')}: {exc}")
-            # Depending on your retry strategy and batch size, you might re-raise
-            # or handle errors differently. Logging and continuing is safer for batches > 1.
+            # Only this message is redelivered; the rest of the batch is not redone
+            batch_item_failures.append({"itemIdentifier": sqs_record.get("messageId")})
 
     # Return a success response
     return {
@@ -259,5 +741,6 @@ def lambda_handler(event, context):
             "status": "character_summarization_batch_complete",
             "processed_count": processed_records_count,
             "message": f"Successfully processed {processed_records_count} SQS records for character summarization."
-        })
+        }),
+        "batchItemFailures": batch_item_failures,
     }
@@ -0,0 +1,166 @@
+# Vendored from src/common/token_accounting.py by tools/vendor_common.py. Edit it there, not here.
+"""
+Shared by the Python lambdas: tools/vendor_common.py copies it into every
+function package that imports it.
+
+Per-book Gemini token counts and the token budgets of the summarizers.
+"""
+
+import logging
+import time
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Key
+
+logger = logging.getLogger()
+
+
+class BudgetExceeded(Exception):
+    """Raised instead of calling Gemini once the book or its user has used up its token budget."""
+
+
+def new_model_stats():
+    """Empty per-model counters."""
+    return {"calls": 0, "timeouts": 0, "latency_ms_total": 0, "latency_ms_max": 0,
+            "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+
+
+class TokenAccounting:
+    """
+    Token counts and per-model metrics of the book each thread is processing,
+    kept on `ctx` (the handler's per-record threading.local).
+
+    Each run adds its tokens and cost to `table`, per (book, stage) and per
+    (user, calendar month). Past `degrade_at` of either budget, stages switch to
+    their cheaper fallback model; once a budget is used up the run stops. A
+    budget of 0 is unlimited. `pricing` maps models to USD per million tokens
+    as (fresh prompt, cached prompt, output); other models are counted at 0.
+    """
+
+    def __init__(self, table, ctx, pricing, book_budget, user_monthly_budget, degrade_at):
+        self.table = table
+        self.ctx = ctx
+        self.pricing = pricing
+        self.book_budget = book_budget
+        self.user_monthly_budget = user_monthly_budget
+        self.degrade_at = degrade_at
+
+    def reset(self):
+        """Starts fresh token counts and per-model metrics for the calling thread's book."""
+        self.ctx.token_usage = {"prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+        self.ctx.model_metrics = {}
+        self.ctx.spent_before = None  # set by load_budget
+
+    def usage(self):
+        """(token counts, per-model metrics) of the book the calling thread is processing."""
+        if not hasattr(self.ctx, "token_usage"):
+            self.reset()
+        return self.ctx.token_usage, self.ctx.model_metrics
+
+    @staticmethod
+    def _usage_keys(user_id, book_id):
+        """Table partition keys of the book's and the user's current month totals."""
+        return f"book#{book_id}", f"user#{user_id}#{time.strftime('%Y-%m', time.gmtime())}"
+
+    def _stored_tokens(self, usage_key):
+        """Tokens recorded under usage_key, over all stages."""
+        response = self.table.query(
+            KeyConditionExpression=Key("usage_key").eq(usage_key),
+            ProjectionExpression="prompt_tokens, cached_tokens, output_tokens",
+        )
+        return sum(int(value) for item in response.get("Items", []) for value in item.values())
+
+    def load_budget(self, user_id, book_id):
+        """Reads what the book and its user have spent before this run, for state()."""
+        book_key, user_key = self._usage_keys(user_id, book_id)
+        try:
+            self.ctx.spent_before = {"book": self._stored_tokens(book_key), "user": self._stored_tokens(user_key)}
+        except Exception as e:
+            # Accounting must never block a book; the budget then only counts this run
+            logger.warning(f"Could not read token usage for bookId {book_id}: {e}")
+            self.ctx.spent_before = {"book": 0, "user": 0}
+
+    def state(self):
+        """"ok", "degrade" or "exceeded" for the book the calling thread is processing."""
+        spent_before = getattr(self.ctx, "spent_before", None)
+        if spent_before is None:
+            return "ok"
+        token_usage, _ = self.usage()
+        this_run = sum(token_usage.values())
+        state = "ok"
+        for scope, budget in (("book", self.book_budget), ("user", self.user_monthly_budget)):
+            if budget <= 0:
+                continue
+            spent = spent_before[scope] + this_run
+            if spent >= budget:
+                return "exceeded"
+            if spent >= budget * self.degrade_at:
+                state = "degrade"
+        return state
+
+    def cost_usd(self, model_metrics):
+        """Price of the tokens in model_metrics."""
+        cost = 0.0
+        for model, stats in model_metrics.items():
+            fresh, cached, output = self.pricing.get(model, (0, 0, 0))
+            cost += (stats["prompt_tokens"] * fresh + stats["cached_tokens"] * cached
+                     + stats["output_tokens"] * output) / 1_000_000
+        return cost
+
+    def is_cheaper(self, model, other):
+        """True if `model` costs less than `other` per fresh prompt and output token."""
+        fresh, _, output = self.pricing.get(model, (0, 0, 0))
+        other_fresh, _, other_output = self.pricing.get(other, (0, 0, 0))
+        return fresh + output < other_fresh + other_output
+
+    def add_response(self, data, model):
+        """Adds the usage metadata of one Gemini response to the running token counts."""
+        token_usage, model_metrics = self.usage()
+        usage = data.get("usageMetadata", {})
+        cached = usage.get("cachedContentTokenCount", 0)
+        # promptTokenCount includes the cached tokens; keep fresh and cached apart
+        token_usage["prompt_tokens"] += usage.get("promptTokenCount", 0) - cached
+        token_usage["cached_tokens"] += cached
+        token_usage["output_tokens"] += usage.get("candidatesTokenCount", 0)
+        stats = model_metrics.setdefault(model, new_model_stats())
+        stats["prompt_tokens"] += usage.get("promptTokenCount", 0) - cached
+        stats["cached_tokens"] += cached
+        stats["output_tokens"] += usage.get("candidatesTokenCount", 0)
+
+    def add_call(self, model, latency_ms, timed_out=False):
+        """Counts one request to `model` in the calling thread's per-model metrics."""
+        _, model_metrics = self.usage()
+        stats = model_metrics.setdefault(model, new_model_stats())
+        stats["calls"] += 1
+        stats["timeouts"] += int(timed_out)
+        stats["latency_ms_total"] += latency_ms
+        stats["latency_ms_max"] = max(stats["latency_ms_max"], latency_ms)
+
+    def record(self, user_id, book_id, stage):
+        """
+        Adds the calling thread's token counts and cost to the book's and the
+        user's totals for `stage`. Best effort: never fails the book.
+        """
+        token_usage, model_metrics = self.usage()
+        calls = sum(stats["calls"] for stats in model_metrics.values())
+        if not calls:
+            return
+        values = {
+            ":prompt": token_usage["prompt_tokens"],
+            ":cached": token_usage["cached_tokens"],
+            ":output": token_usage["output_tokens"],
+            ":calls": calls,
+            ":cost": Decimal(str(round(self.cost_usd(model_metrics), 6))),
+            ":user": user_id,
+            ":now": int(time.time()),
+        }
+        for usage_key in self._usage_keys(user_id, book_id):
+            try:
+                self.table.update_item(
+                    Key={"usage_key": usage_key, "stage": stage},
+                    UpdateExpression="ADD prompt_tokens :prompt, cached_tokens :cached, output_tokens :output, "
+                                     "calls :calls, cost_usd :cost SET user_id = :user, updated_at = :now",
+                    ExpressionAttributeValues=values,
+                )
+            except Exception as e:
+                logger.warning(f"Could not record token usage under {usage_key}: {e}")
@@ -0,0 +1,119 @@
+import json
+import os
+import boto3
+import logging
+from boto3.dynamodb.conditions import Key
+from lazy_resource import LazyResource
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+REGION = os.getenv("AWS_REGION", "us-east-1")
+USER_BOOKS_TABLE_NAME = os.getenv("USER_BOOKS_TABLE_NAME", "user_books")
+SUMMARY_TABLE_NAME = os.getenv("SUMMARY_TABLE_NAME", "summaries")
+CHARACTER_TABLE_NAME = os.getenv("CHARACTER_TABLE_NAME", "characters")
+UPLOAD_BUCKET_NAME = os.getenv("UPLOAD_BUCKET_NAME", "book-processing-uploads")
+NORMALIZED_BUCKET_NAME = os.getenv("NORMALIZED_BUCKET_NAME", "normalized-books")
+S3_DELETE_BATCH = 1000  # delete_objects limit
+
+
+s3 = LazyResource(lambda: boto3.client("s3", region_name=REGION))
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+user_books_table = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE_NAME))
+summaries_table = LazyResource(lambda: dynamodb.Table(SUMMARY_TABLE_NAME))
+characters_table = LazyResource(lambda: dynamodb.Table(CHARACTER_TABLE_NAME))
+
+
+def _written_at(item):
+    """When a summaries/characters item was written, in epoch seconds (0 if unknown)."""
+    return int(item.get("createdAt") or item.get("requested_at") or 0)
+
+
+def _predates(written_at, cancelled_before, delete):
+    """
+    True if something written at `written_at` (epoch seconds) predates the
+    cancellation at `cancelled_before` (epoch ms). Within the cancellation's own
+    second the order is unknown: a deleted book loses what was written in it, a
+    replaced one keeps it, as the replacement's rows must never be removed.
+    """
+    cutoff = cancelled_before // 1000
+    return written_at <= cutoff if delete else written_at < cutoff
+
+
+def delete_items_before(table, book_id, cancelled_before, delete=False):
+    """Deletes the book's items written before the cancellation (see _predates); returns how many."""
+    kwargs = {"KeyConditionExpression": Key("book_id").eq(book_id)}
+    stale = []
+    while True:
+        response = table.query(**kwargs)
+        stale.extend(item["progress"] for item in response.get("Items", [])
+                     if _predates(_written_at(item), cancelled_before, delete))
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    with table.batch_writer() as batch:
+        for progress in stale:
+            batch.delete_item(Key={"book_id": book_id, "progress": progress})
+    return len(stale)
+
+
+def delete_objects_before(bucket, prefix, cancelled_before, delete=False):
+    """Deletes objects under prefix last modified before the cancellation (see _predates); returns how many."""
+    stale = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        stale.extend(obj["Key"] for obj in page.get("Contents", [])
+                     if _predates(int(obj["LastModified"].timestamp()), cancelled_before, delete))
+    for start in range(0, len(stale), S3_DELETE_BATCH):
+        s3.delete_objects(Bucket=bucket, Delete={
+            "Objects": [{"Key": key} for key in stale[start:start + S3_DELETE_BATCH]],
+            "Quiet": True,
+        })
+    return len(stale)
+
+
+def cleanup(message):
+    user_id, book_id = message["user_id"], message["book_id"]
+    cancelled_before = int(message["cancelled_before"])
+    delete = bool(message.get("delete"))
+    removed = {
+        "summaries": delete_items_before(summaries_table, book_id, cancelled_before, delete),
+        "characters": delete_items_before(characters_table, book_id, cancelled_before, delete),
+        "uploads": delete_objects_before(UPLOAD_BUCKET_NAME, f"books/{user_id}/{book_id}/",
+                                         cancelled_before, delete),
+        "normalized": delete_objects_before(NORMALIZED_BUCKET_NAME, f"normalized/{user_id}/{book_id}/",
+                                            cancelled_before, delete),
+    }
+
+    if delete:
+        try:
+            user_books_table.delete_item(
+                Key={"user_id": user_id, "book_id": book_id},
+                # A book restored or replaced since is left alone
+                ConditionExpression="processing_status = :deleted AND cancelled_before = :marker",
+                ExpressionAttributeValues={":deleted": "DELETED", ":marker": cancelled_before},
+            )
+        except user_books_table.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.info(f"user_books row of bookId {book_id} changed since deletion; keeping it.")
+
+    logger.info(json.dumps({"event": "book_cleanup", "book_id": book_id, "delete": delete, **removed}))
+
+
+def lambda_handler(event, context):
+    """
+    Trigger source: SQS book-cleanup-queue, fed (with a delay) by deleteBook and
+    by generatePresignedUploadUrl when a book is replaced.
+    Removes summaries, characters and files of the book written before the
+    cancellation, so a replacement uploaded since is kept, and for a deleted
+    book finally removes its user_books row.
+    """
+    records = event.get("Records", [])
+    logger.info(f"Received {len(records)} cleanup requests.")
+    failures = []
+    for record in records:
+        try:
+            cleanup(json.loads(record["body"]))
+        except Exception as e:
+            logger.exception(f"Cleanup failed for {record.get('messageId')}: {e}")
+            failures.append({"itemIdentifier": record["messageId"]})
+    return {"status": "ok", "batchItemFailures": failures}
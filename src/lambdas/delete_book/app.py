@@ -0,0 +1,97 @@
+import json
+import os
+import time
+import boto3
+import logging
+from lazy_resource import LazyResource
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+REGION = os.getenv("AWS_REGION", "us-east-1")
+USER_BOOKS_TABLE_NAME = os.getenv("USER_BOOKS_TABLE_NAME", "user_books")
+# Consumed by cleanupBook, which removes what the cancelled processing left behind
+BOOK_CLEANUP_QUEUE_URL = os.getenv("BOOK_CLEANUP_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/book-cleanup-queue")
+# Stages notice a cancellation within one step; cleanup waits this long so nothing
+# is written after it has run
+CLEANUP_DELAY_SECONDS = int(os.getenv("CLEANUP_DELAY_SECONDS", "120"))
+
+
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+user_books_table = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE_NAME))
+sqs = LazyResource(lambda: boto3.client("sqs", region_name=REGION))
+
+
+def cancel_book(user_id, book_id, delete):
+    """
+    Records the cancellation marker on the user_books row: every stage stops
+    work on a version of the book issued before `cancelled_before` (and on any
+    version once the book is DELETED). Returns the marker, or None if the user
+    has no such book.
+    """
+    cancelled_before = int(time.time() * 1000)
+    update = "SET cancelled_before = :now"
+    values = {":now": cancelled_before}
+    if delete:
+        update += ", processing_status = :deleted, status_uploaded = :status_key"
+        values[":deleted"] = "DELETED"
+        values[":status_key"] = f"DELETED#{cancelled_before // 1000:012d}"
+    try:
+        user_books_table.update_item(
+            Key={"user_id": user_id, "book_id": book_id},
+            UpdateExpression=update,
+            ConditionExpression="attribute_exists(book_id)",
+            ExpressionAttributeValues=values,
+        )
+    except user_books_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+
+    sqs.send_message(
+        QueueUrl=BOOK_CLEANUP_QUEUE_URL,
+        MessageBody=json.dumps({"user_id": user_id, "book_id": book_id,
+                                "cancelled_before": cancelled_before, "delete": delete}),
+        DelaySeconds=min(900, CLEANUP_DELAY_SECONDS),
+    )
+    return cancelled_before
+
+
+def lambda_handler(event, context):
+    """
+    Deletes a book from the user's library.
+    Triggered by API Gateway DELETE /books/{bookId}.
+    Expects user_id in request headers.
+    Processing still in flight for the book stops within one step, and its
+    summaries, characters and files are removed in the background by cleanupBook.
+    """
+    logger.info(f"Received event: {json.dumps(event)}")
+
+    try:
+        headers = event.get('headers') or {}
+        user_id = headers.get('user-id') or headers.get('User-Id') or headers.get('user_id')
+        book_id = (event.get('pathParameters') or {}).get('bookId')
+        if not user_id or not book_id:
+            logger.warning("Missing user_id in headers or bookId in path.")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': 'Missing user_id or bookId'})
+            }
+
+        if cancel_book(user_id, book_id, delete=True) is None:
+            return {
+                'statusCode': 404,
+                'body': json.dumps({'message': 'Book not found'})
+            }
+
+        logger.info(f"Deleted bookId {book_id} of user {user_id}; cleanup queued.")
+        return {
+            'statusCode': 202,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'book_id': book_id, 'message': 'Book deleted'})
+        }
+
+    except Exception as e:
+        logger.exception(f"An unexpected error occurred: {e}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'message': 'An unexpected error occurred'})
+        }
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+import boto3
+import logging
+from boto3.dynamodb.conditions import Key, Attr
+from lazy_resource import LazyResource
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+REGION = os.getenv("AWS_REGION", "us-east-1")
+# Same queue normalize-books sends to when a user has a free slot
+OUTPUT_QUEUE_URL = os.getenv("OUTPUT_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/summarize-character-queue")
+BOOK_JOBS_TABLE = os.getenv("BOOK_JOBS_TABLE", "book_jobs")
+USER_SCHEDULING_TABLE = os.getenv("USER_SCHEDULING_TABLE", "user_scheduling")
+# Sparse GSI on user_scheduling: partition pending_flag ("Y" while the user has
+# queued jobs), sort last_served_at, so the longest-waiting users come first
+PENDING_USERS_INDEX = os.getenv("PENDING_USERS_INDEX", "pending-users-index")
+PER_USER_CONCURRENCY = int(os.getenv("PER_USER_CONCURRENCY", "3"))
+# Upper bound on books released per invocation, to keep one run short
+MAX_DISPATCH_PER_RUN = int(os.getenv("MAX_DISPATCH_PER_RUN", "100"))
+
+
+sqs = LazyResource(lambda: boto3.client("sqs", region_name=REGION))
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+book_jobs = LazyResource(lambda: dynamodb.Table(BOOK_JOBS_TABLE))
+user_scheduling = LazyResource(lambda: dynamodb.Table(USER_SCHEDULING_TABLE))
+
+
+def _pending_users():
+    """Users with queued jobs, least recently served first."""
+    users, kwargs = [], {}
+    while True:
+        response = user_scheduling.query(
+            IndexName=PENDING_USERS_INDEX,
+            KeyConditionExpression=Key("pending_flag").eq("Y"),
+            ScanIndexForward=True,
+            **kwargs,
+        )
+        users.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return users
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def _claim_user_slot(user_id):
+    """Takes one of the user's concurrency slots; False if they are all in use."""
+    try:
+        user_scheduling.update_item(
+            Key={"user_id": user_id},
+            UpdateExpression="ADD inflight :one",
+            ConditionExpression="attribute_not_exists(inflight) OR inflight < :cap",
+            ExpressionAttributeValues={":one": 1, ":cap": PER_USER_CONCURRENCY},
+        )
+        return True
+    except user_scheduling.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def _release_user_slot(user_id):
+    user_scheduling.update_item(
+        Key={"user_id": user_id},
+        UpdateExpression="ADD inflight :minus_one",
+        ExpressionAttributeValues={":minus_one": -1},
+    )
+
+
+def _oldest_queued_job(user_id):
+    """The user's oldest job that has not been dispatched yet, or None."""
+    kwargs = {}
+    while True:
+        response = book_jobs.query(
+            KeyConditionExpression=Key("user_id").eq(user_id),
+            FilterExpression=Attr("status").eq("QUEUED"),
+            ScanIndexForward=True,  # job ids start with the enqueue time
+            **kwargs,
+        )
+        if response.get("Items"):
+            return response["Items"][0]
+        if "LastEvaluatedKey" not in response:
+            return None
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def _mark_served(user_id, had_job):
+    """Moves the user to the back of the round and clears the flag once nothing is queued."""
+    update = "SET last_served_at = :now" + (" ADD pending :minus_one" if had_job else "")
+    values = {":now": int(time.time() * 1000)}
+    if had_job:
+        values[":minus_one"] = -1
+    user_scheduling.update_item(Key={"user_id": user_id}, UpdateExpression=update,
+                                ExpressionAttributeValues=values)
+    try:
+        user_scheduling.update_item(
+            Key={"user_id": user_id},
+            UpdateExpression="REMOVE pending_flag",
+            ConditionExpression="attribute_not_exists(pending) OR pending <= :zero",
+            ExpressionAttributeValues={":zero": 0},
+        )
+    except user_scheduling.meta.client.exceptions.ConditionalCheckFailedException:
+        pass  # Still has queued jobs
+
+
+def dispatch_one(user_id):
+    """Releases the user's oldest queued book if they have a free slot. Returns True if sent."""
+    if not _claim_user_slot(user_id):
+        return False
+
+    job = _oldest_queued_job(user_id)
+    if job is None:
+        _release_user_slot(user_id)
+        _mark_served(user_id, had_job=False)
+        return False
+
+    try:
+        # Guards against a concurrent dispatcher run taking the same job
+        book_jobs.update_item(
+            Key={"user_id": user_id, "job_id": job["job_id"]},
+            UpdateExpression="SET #s = :dispatched, dispatched_at = :now",
+            ConditionExpression="#s = :queued",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={":dispatched": "DISPATCHED", ":queued": "QUEUED",
+                                       ":now": int(time.time())},
+        )
+    except book_jobs.meta.client.exceptions.ConditionalCheckFailedException:
+        _release_user_slot(user_id)
+        return False
+
+    try:
+        sqs.send_message(QueueUrl=OUTPUT_QUEUE_URL, MessageBody=job["payload"])
+    except Exception:
+        # Not sent: back in the queue for the next run, and the slot is free again
+        book_jobs.update_item(
+            Key={"user_id": user_id, "job_id": job["job_id"]},
+            UpdateExpression="SET #s = :queued REMOVE dispatched_at",
+            ConditionExpression="#s = :dispatched",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={":dispatched": "DISPATCHED", ":queued": "QUEUED"},
+        )
+        _release_user_slot(user_id)
+        raise
+    _mark_served(user_id, had_job=True)
+    logger.info(f"Dispatched {job['job_id']} for user {user_id}.")
+    return True
+
+
+def lambda_handler(event, context):
+    """
+    Trigger source: EventBridge schedule, or an async invoke from a summarizer
+    that just freed a slot.
+    Releases queued books round-robin across users: each pass gives every user
+    with queued work at most one book (least recently served first), subject
+    to the per-user concurrency cap, and passes repeat until nothing more can
+    be dispatched. A bulk import therefore never holds more than
+    PER_USER_CONCURRENCY books ahead of anyone else's upload.
+    """
+    logger.info(f"Received event: {json.dumps(event)}")
+    dispatched = 0
+
+    while dispatched < MAX_DISPATCH_PER_RUN:
+        progress = False
+        for user in _pending_users():
+            if dispatched >= MAX_DISPATCH_PER_RUN:
+                break
+            if int(user.get("inflight", 0)) >= PER_USER_CONCURRENCY:
+                continue  # Cheap pre-check; the conditional claim is the real one
+            try:
+                if dispatch_one(user["user_id"]):
+                    dispatched += 1
+                    progress = True
+            except Exception as e:
+                logger.exception(f"Failed dispatching for user {user['user_id']}: {e}")
+        if not progress:
+            break
+
+    logger.info(f"Dispatched {dispatched} books.")
+    return {"status": "ok", "dispatched": dispatched}
@@ -4,16 +4,24 @@ import boto3
 import os
 import time # Import time for timestamp
 import logging
+from lazy_resource import LazyResource
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb') # Initialize DynamoDB resource
+
+s3_client = LazyResource(lambda: boto3.client('s3'))
+sqs = LazyResource(lambda: boto3.client('sqs'))
+dynamodb = LazyResource(lambda: boto3.resource('dynamodb')) # Initialize DynamoDB resource
 
 # Get environment variables
 UPLOAD_BUCKET_NAME = os.environ.get("UPLOAD_BUCKET_NAME", "book-processing-uploads") # Ensure this matches your env var name
 USER_BOOKS_TABLE_NAME = os.environ.get("USER_BOOKS_TABLE_NAME", "user_books") # New env var for User Books table
+# Consumed by cleanupBook; replacing a book queues removal of the old version's artifacts
+BOOK_CLEANUP_QUEUE_URL = os.environ.get("BOOK_CLEANUP_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/book-cleanup-queue")
+# Stages notice a cancellation within one step; cleanup waits this long so nothing
+# is written after it has run
+CLEANUP_DELAY_SECONDS = int(os.environ.get("CLEANUP_DELAY_SECONDS", "120"))
 
 # --- Add check for environment variables ---
 if not UPLOAD_BUCKET_NAME:
@@ -26,7 +34,7 @@ if not USER_BOOKS_TABLE_NAME:
 # --- End check ---
 
 # Get the User Books DynamoDB table object
-user_books_table = dynamodb.Table(USER_BOOKS_TABLE_NAME)
+user_books_table = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE_NAME))
 
 
 ALLOWED_EXTENSIONS = {".pdf", ".epub"}
@@ -60,8 +68,24 @@ def lambda_handler(event, context):
                 "body": json.dumps({"error": "Invalid user_id or file extension"})
             }
 
+        # Replacing a book (e.g. a corrected file) keeps its book_id; processing of
+        # the old version is cancelled and its artifacts are cleaned up
+        replace_book_id = body.get("replace_book_id")
+        previous = None
+        if replace_book_id:
+            previous = user_books_table.get_item(
+                Key={'user_id': user_id, 'book_id': replace_book_id},
+                ProjectionExpression='processing_status, current_reading_percentage',
+            ).get('Item')
+            if not previous or previous.get('processing_status') == 'DELETED':
+                logger.warning(f"Cannot replace unknown bookId {replace_book_id} of user {user_id}")
+                return {
+                    "statusCode": 404,
+                    "body": json.dumps({"error": "Book to replace not found"})
+                }
+
         # Generate a unique book_id and S3 key
-        book_id = str(uuid.uuid4())
+        book_id = replace_book_id or str(uuid.uuid4())
         s3_key = f"books/{user_id}/{book_id}/{file_name}"
 
         # Generate a pre-signed URL
@@ -87,6 +111,14 @@ def lambda_handler(event, context):
         logger.info("Pre-signed URL generated successfully.")
 
         # --- Insert entry into User Books table ---
+        upload_timestamp = int(time.time()) # Record when the URL was generated
+        cancelled_before = int(time.time() * 1000)
+        if previous:
+            # The book must still be there (and not deleted meanwhile) to be replaced
+            condition = {'ConditionExpression': 'attribute_exists(book_id) AND processing_status <> :deleted',
+                         'ExpressionAttributeValues': {':deleted': 'DELETED'}}
+        else:
+            condition = {'ConditionExpression': 'attribute_not_exists(book_id)'} # Prevent duplicate entries for the same book_id
         try:
             logger.info(f"Inserting entry into {USER_BOOKS_TABLE_NAME} for user: {user_id}, book: {book_id}")
             user_books_table.put_item(
@@ -94,18 +126,36 @@ def lambda_handler(event, context):
                     'user_id': user_id, # <-- Changed from 'userId' to 'user_id' to match error message
                     'book_id': book_id, # Sort Key
                     'file_name': file_name,
-                    'upload_timestamp': int(time.time()), # Record when the URL was generated
+                    'upload_timestamp': upload_timestamp,
                     's3_key': s3_key, # Add the S3 key
                     'upload_bucket_name': UPLOAD_BUCKET_NAME, # Add the upload bucket name
                     'processing_status': 'UPLOADED', # Initial status after upload URL is generated
-                    'current_reading_percentage': 0, # Start at 0%
+                    # Sort key of the status index used by getUserBooks ?status=...; must change with processing_status
+                    'status_uploaded': f"UPLOADED#{upload_timestamp:012d}",
+                    # A replaced book keeps the reader's place
+                    'current_reading_percentage': previous.get('current_reading_percentage', 0) if previous else 0,
                     'book_title': '', # Placeholder - needs to be updated after normalization
-                    'book_author': '' # Placeholder - needs to be updated after normalization
+                    'book_author': '', # Placeholder - needs to be updated after normalization
+                    # Stages stop work on versions of the book issued before this (epoch ms)
+                    **({'cancelled_before': cancelled_before} if previous else {}),
                 },
-                ConditionExpression='attribute_not_exists(bookId)' # Prevent duplicate entries for the same bookId
+                **condition
             )
+            if previous:
+                sqs.send_message(
+                    QueueUrl=BOOK_CLEANUP_QUEUE_URL,
+                    MessageBody=json.dumps({'user_id': user_id, 'book_id': book_id,
+                                            'cancelled_before': cancelled_before, 'delete': False}),
+                    DelaySeconds=min(900, CLEANUP_DELAY_SECONDS),
+                )
             logger.info("User book entry inserted successfully.")
         except user_books_table.meta.client.exceptions.ConditionalCheckFailedException:
+             if previous:
+                 logger.warning(f"bookId {book_id} of user {user_id} was deleted before it could be replaced")
+                 return {
+                     "statusCode": 404,
+                     "body": json.dumps({"error": "Book to replace not found"})
+                 }
              logger.warning(f"User book entry already exists for bookId: {book_id}")
              # This might happen if the same bookId is somehow generated again,
              # or if a retry occurs after the item was already created.
@@ -1,9 +1,11 @@
 import json
 import os
-import boto3
+import time
 import logging
-from boto3.dynamodb.conditions import Key
+from collections import OrderedDict
 from decimal import Decimal # Import Decimal
+from emf_metrics import EmfMetrics
+from lazy_resource import LazyResource
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -11,6 +13,18 @@ logger.setLevel(logging.INFO)
 # Get the characters table name from environment variables
 CHARACTER_TABLE_NAME = os.getenv("CHARACTER_TABLE_NAME", "characters") # Default to 'characters'
 
+# characterSummaryLambda stores characters every PERCENT_STEP percent; a read
+# also fetches the next step so a reader crossing into it is served from cache.
+# 0 turns read-ahead off.
+PREFETCH_STEP = int(os.getenv("PREFETCH_STEP", "5"))
+# Books whose characters a warm container keeps, and for how long
+CHARACTER_CACHE_SIZE = int(os.getenv("CHARACTER_CACHE_SIZE", "512"))
+CHARACTER_CACHE_TTL_SECONDS = int(os.getenv("CHARACTER_CACHE_TTL_SECONDS", "300"))
+# EMF metrics (see emf_metrics); METRICS_PER_BOOK adds a book_id dimension (load tests only)
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ReadRecall/Api")
+METRICS_PER_BOOK = os.getenv("METRICS_PER_BOOK", "false").lower() == "true"
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "getBookCharacters")
+
 # --- Add check for environment variable ---
 if not CHARACTER_TABLE_NAME:
     logger.error("CHARACTER_TABLE_NAME environment variable is not set.")
@@ -19,10 +33,22 @@ if not CHARACTER_TABLE_NAME:
     raise ValueError("CHARACTER_TABLE_NAME environment variable is not set.")
 # --- End check ---
 
+
+def _dynamodb():
+    # The SDK import is most of this function's init time (over its 250 ms budget on
+    # its own); the first query, which needs it anyway, pays for it instead
+    import boto3
+    return boto3.resource("dynamodb")
+
+
 # Initialize the DynamoDB resource
-dynamodb = boto3.resource("dynamodb")
+dynamodb = LazyResource(_dynamodb)
 # Get the DynamoDB table object
-table = dynamodb.Table(CHARACTER_TABLE_NAME)
+table = LazyResource(lambda: dynamodb.Table(CHARACTER_TABLE_NAME))
+metrics = EmfMetrics(FUNCTION_NAME, METRICS_NAMESPACE, METRICS_PER_BOOK)
+
+# book_id -> (fetched_at, covered percentage, character items up to it)
+_CHARACTER_CACHE = OrderedDict()
 
 # Custom JSON Encoder to handle Decimal types (same as summaries lambda)
 class DecimalEncoder(json.JSONEncoder):
@@ -35,11 +61,35 @@ class DecimalEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def cached_characters(book_id, percentage):
+    """Characters up to percentage from this container's cache, or None on a miss."""
+    entry = _CHARACTER_CACHE.get(book_id)
+    if entry is None:
+        return None
+    fetched_at, covered, items = entry
+    if time.time() - fetched_at > CHARACTER_CACHE_TTL_SECONDS or covered < percentage:
+        return None
+    # Characters are written in order while a book is processed, so a cached
+    # entry is only trusted once it reaches past the requested percentage
+    if not any(item['progress'] >= percentage for item in items):
+        return None
+    _CHARACTER_CACHE.move_to_end(book_id)
+    return [item for item in items if item['progress'] <= percentage]
+
+
+def cache_characters(book_id, covered, items):
+    _CHARACTER_CACHE[book_id] = (time.time(), covered, items)
+    _CHARACTER_CACHE.move_to_end(book_id)
+    while len(_CHARACTER_CACHE) > CHARACTER_CACHE_SIZE:
+        _CHARACTER_CACHE.popitem(last=False)
+
+
 def lambda_handler(event, context):
     """
     Retrieves book characters for a specific book up to a given percentage.
     Triggered by API Gateway GET /books/{bookId}/characters?percentage={percentage}.
     Expects bookId in path parameters and percentage in query string parameters.
+    Each read also fetches the next PREFETCH_STEP step into the container cache.
     """
     logger.info(f"Received event: {json.dumps(event)}")
 
@@ -82,24 +132,42 @@ def lambda_handler(event, context):
                 'body': json.dumps({'message': 'Invalid percentage format'})
             }
 
-        logger.info(f"Querying characters for bookId: {book_id} up to {percentage}%.")
+        cached = cached_characters(book_id, percentage)
+        if cached is not None:
+            logger.info(f"Serving {len(cached)} cached character items for bookId {book_id} up to {percentage}%.")
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps(cached, cls=DecimalEncoder)
+            }
+
+        # Read ahead to the next step in the same query
+        upper = percentage
+        if PREFETCH_STEP > 0:
+            upper = min(100, percentage - percentage % PREFETCH_STEP + PREFETCH_STEP)
+        logger.info(f"Querying characters for bookId: {book_id} up to {upper}% (requested {percentage}%).")
 
         # Query DynamoDB for character items.
         # We use KeyConditionExpression to filter by Partition Key (book_id)
         # and Sort Key (progress) using the 'lte' (less than or equal to) condition.
         # This efficiently retrieves all items for the given book_id where the progress
         # is less than or equal to the requested percentage.
-        response = table.query(
-            KeyConditionExpression=Key('book_id').eq(book_id) & Key('progress').lte(percentage)
-            # If you were filtering by user_id, you would add a FilterExpression here:
-            # FilterExpression=Attr('user_id').eq(user_id_from_auth)
-            # Note: FilterExpression is applied *after* the query, so it consumes
-            # read capacity for all items matching the KeyConditionExpression,
-            # even if they are filtered out. Design your keys/indexes carefully.
-        )
+        with metrics.timed("query_characters", book_id, upper=upper) as span:
+            response = table.query(
+                # A plain expression: boto3.dynamodb.conditions would import the SDK at init
+                KeyConditionExpression='book_id = :book_id AND progress <= :upper',
+                ExpressionAttributeValues={':book_id': book_id, ':upper': upper},
+                # If you were filtering by user_id, you would add a FilterExpression here:
+                # FilterExpression=Attr('user_id').eq(user_id_from_auth)
+                # Note: FilterExpression is applied *after* the query, so it consumes
+                # read capacity for all items matching the KeyConditionExpression,
+                # even if they are filtered out. Design your keys/indexes carefully.
+            )
+            span["items"] = response.get('Count', len(response.get('Items', [])))
+        cache_characters(book_id, upper, response.get('Items', []))
 
         # Get the list of items from the query response
-        items = response.get('Items', [])
+        items = [item for item in response.get('Items', []) if item['progress'] <= percentage]
         logger.info(f"Found {len(items)} character items for bookId {book_id} up to {percentage}%.")
 
         # The items returned by the query are already sorted by the Sort Key (progress)
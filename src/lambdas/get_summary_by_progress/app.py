@@ -1,19 +1,68 @@
 import json
 import os
+import time
 import boto3
 import logging
+from collections import OrderedDict
 from boto3.dynamodb.conditions import Key
 from decimal import Decimal # Import Decimal
+from emf_metrics import EmfMetrics
+from lazy_resource import LazyResource
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Get the summaries table name from environment variables
 SUMMARY_TABLE_NAME = os.getenv("SUMMARY_TABLE_NAME", "summaries")
+# Chapter recaps are stored under progress = CHAPTER_PROGRESS_BASE + chapter id
+# (must match bookSummaryLambda)
+CHAPTER_PROGRESS_BASE = 1000
+# progress = 0 holds the book manifest written by bookSummaryLambda
+MANIFEST_PROGRESS = 0
+# progress = -1 holds the book's in-flight generation marker (see request_generation).
+# When generation stops short, bookSummaryLambda leaves an EXHAUSTED or FAILED marker
+# with a "retry_after" instead: until then what exists is served and nothing requested.
+GENERATION_MARKER_PROGRESS = -1
+# Step of the summary grid bookSummaryLambda generates (its PERCENT_STEP)
+PERCENT_STEP = 5
+# Readers are served summaries at this granularity (in percent). Buckets that were
+# not precomputed at upload are generated the first time someone asks for them.
+# Finer than PERCENT_STEP costs a Gemini merge per extra bucket.
+SUMMARY_BUCKET_STEP = int(os.getenv("SUMMARY_BUCKET_STEP", str(PERCENT_STEP)))
+# Queue consumed by bookSummaryLambda for on-demand generation
+SUMMARY_QUEUE_URL = os.getenv("SUMMARY_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/summary-on-demand-queue")
+# Also consumed by bookSummaryLambda, ahead of the queue above: requests a reader
+# is waiting on (or about to be) go here, continuations of long runs do not
+SUMMARY_PRIORITY_QUEUE_URL = os.getenv("SUMMARY_PRIORITY_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/summary-priority-queue")
+# When a reader is served a bucket, the next multiple of this is prefetched (and
+# queued for generation if missing), so crossing into it is served warm.
+# Matches PERCENT_STEP in bookSummaryLambda; 0 turns prefetching off.
+PREFETCH_STEP = int(os.getenv("PREFETCH_STEP", str(PERCENT_STEP)))
+# Books whose summaries a warm container keeps, and for how long
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "512"))
+SUMMARY_CACHE_TTL_SECONDS = int(os.getenv("SUMMARY_CACHE_TTL_SECONDS", "300"))
+PENDING_STATUS = "PENDING"
+# A generation marker older than this is assumed lost and may be requested again
+PENDING_STALE_SECONDS = int(os.getenv("PENDING_STALE_SECONDS", "300"))
+# Internal bookkeeping attributes that are not part of the API response
+INTERNAL_ATTRIBUTES = ("open_chapter_deltas", "status", "requested_at")
+# EMF metrics (see emf_metrics); METRICS_PER_BOOK adds a book_id dimension (load tests only)
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ReadRecall/Api")
+METRICS_PER_BOOK = os.getenv("METRICS_PER_BOOK", "false").lower() == "true"
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "getBookSummary")
+
+
 # Initialize the DynamoDB resource
-dynamodb = boto3.resource("dynamodb")
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb"))
 # Get the DynamoDB table object
-table = dynamodb.Table(SUMMARY_TABLE_NAME)
+table = LazyResource(lambda: dynamodb.Table(SUMMARY_TABLE_NAME))
+sqs = LazyResource(lambda: boto3.client("sqs"))
+metrics = EmfMetrics(FUNCTION_NAME, METRICS_NAMESPACE, METRICS_PER_BOOK)
+
+# book_id -> (fetched_at, ready summary items up to and including the prefetched
+# bucket). Generated summaries never change, so the only staleness is a bucket
+# finished after the fetch, which the TTL bounds.
+_SUMMARY_CACHE = OrderedDict()
 
 # Custom JSON Encoder to handle Decimal types
 class DecimalEncoder(json.JSONEncoder):
@@ -26,11 +75,119 @@ class DecimalEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def request_generation(book_id, bucket, queue_url=SUMMARY_PRIORITY_QUEUE_URL):
+    """
+    Asks bookSummaryLambda to generate summaries up to `bucket`.
+
+    Generation is coalesced per book: one marker item holds the highest
+    bucket asked for. Only the request that creates the marker (or finds it
+    stale) enqueues a job. While that job runs, requests for a higher bucket
+    only raise the marker's target, and the job carries on to it when done,
+    so overlapping requests never generate the same steps twice. A stopped
+    marker blocks requests until its retry_after.
+    Returns True if this call enqueued a job.
+    """
+    now = int(time.time())
+    try:
+        previous = table.update_item(
+            Key={'book_id': book_id, 'progress': GENERATION_MARKER_PROGRESS},
+            UpdateExpression='SET #s = :pending, target = :bucket, requested_at = :now REMOVE retry_after, reached',
+            ConditionExpression='attribute_not_exists(progress) OR retry_after < :now '
+                                'OR requested_at < :stale OR target < :bucket',
+            ExpressionAttributeNames={'#s': 'status'},
+            ExpressionAttributeValues={':pending': PENDING_STATUS, ':bucket': bucket, ':now': now,
+                                       ':stale': now - PENDING_STALE_SECONDS},
+            ReturnValues='ALL_OLD',
+        ).get('Attributes')
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"Summaries up to {bucket}% for bookId {book_id} are already being generated.")
+        return False
+    if (previous and previous.get('status') == PENDING_STATUS
+            and previous['requested_at'] >= now - PENDING_STALE_SECONDS):
+        logger.info(f"Raised the generation target of bookId {book_id} to {bucket}%; the running job continues to it.")
+        return False
+
+    sqs.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps({'book_id': book_id, 'progress': bucket}),
+    )
+    logger.info(f"Requested on-demand generation of the {bucket}% summary for bookId {book_id}.")
+    return True
+
+
+def cached_summaries(book_id, bucket):
+    """Summaries up to bucket from this container's cache, or None unless the bucket itself is cached."""
+    entry = _SUMMARY_CACHE.get(book_id)
+    if entry is None:
+        return None
+    fetched_at, items = entry
+    if time.time() - fetched_at > SUMMARY_CACHE_TTL_SECONDS:
+        del _SUMMARY_CACHE[book_id]
+        return None
+    if not any(item['progress'] == bucket for item in items):
+        return None
+    _SUMMARY_CACHE.move_to_end(book_id)
+    return [item for item in items if item['progress'] <= bucket]
+
+
+def cache_summaries(book_id, items):
+    _SUMMARY_CACHE[book_id] = (time.time(), items)
+    _SUMMARY_CACHE.move_to_end(book_id)
+    while len(_SUMMARY_CACHE) > SUMMARY_CACHE_SIZE:
+        _SUMMARY_CACHE.popitem(last=False)
+
+
+def next_bucket(bucket):
+    """The bucket a reader at `bucket` is expected to ask for next, or None."""
+    if PREFETCH_STEP <= 0:
+        return None
+    upcoming = bucket - bucket % PREFETCH_STEP + PREFETCH_STEP
+    upcoming -= upcoming % SUMMARY_BUCKET_STEP
+    return upcoming if bucket < upcoming <= 100 else None
+
+
+def get_chapter_recap(book_id, chapter_str):
+    """Returns the stored recap of one chapter as a single-item list."""
+    try:
+        chapter_id = int(chapter_str)
+        if chapter_id < 1:
+            raise ValueError(chapter_str)
+    except ValueError:
+        logger.warning(f"Invalid chapter format: {chapter_str}. Must be a positive integer.")
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'message': 'Invalid chapter format'})
+        }
+
+    logger.info(f"Fetching recap of chapter {chapter_id} for bookId: {book_id}.")
+    # A single GetItem on the chapter's sort key; no range scan needed
+    with metrics.timed("get_chapter_recap", book_id):
+        response = table.get_item(
+            Key={'book_id': book_id, 'progress': CHAPTER_PROGRESS_BASE + chapter_id}
+        )
+    item = response.get('Item')
+    if not item:
+        return {
+            'statusCode': 404,
+            'body': json.dumps({'message': 'Chapter recap not found'})
+        }
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps([item], cls=DecimalEncoder)
+    }
+
+
 def lambda_handler(event, context):
     """
     Retrieves book summaries for a specific book up to a given percentage.
     Triggered by API Gateway GET /books/{bookId}/summary?percentage={percentage}.
     Expects bookId in path parameters and percentage in query string parameters.
+    GET /books/{bookId}/summary?chapter={chapterId} returns the recap of a single
+    chapter instead.
+    Each read also fetches the next PREFETCH_STEP bucket into the container
+    cache and queues its generation if it does not exist yet.
     """
     logger.info(f"Received event: {json.dumps(event)}")
 
@@ -40,8 +197,9 @@ def lambda_handler(event, context):
         book_id = path_parameters.get('bookId')
 
         # Extract percentage from query string parameters provided by API Gateway
-        query_string_parameters = event.get('queryStringParameters', {})
+        query_string_parameters = event.get('queryStringParameters') or {}
         percentage_str = query_string_parameters.get('percentage')
+        chapter_str = query_string_parameters.get('chapter')
 
         # In a real application, you would typically authenticate the user
         # and obtain their user_id from the request context (e.g., from a JWT).
@@ -49,6 +207,9 @@ def lambda_handler(event, context):
         # summaries for books they own or have permission to view.
         # For this example, we are not implementing authentication/authorization.
 
+        if book_id and chapter_str:
+            return get_chapter_recap(book_id, chapter_str)
+
         # Validate required parameters
         if not book_id or not percentage_str:
             logger.warning("Missing bookId in path or percentage in query string.")
@@ -73,30 +234,96 @@ def lambda_handler(event, context):
                 'body': json.dumps({'message': 'Invalid percentage format'})
             }
 
-        logger.info(f"Querying summaries for bookId: {book_id} up to {percentage}%.")
+        # Serve the nearest bucket at or below the reader's position
+        bucket = percentage - percentage % SUMMARY_BUCKET_STEP
+        if bucket < 1:
+            # Nothing has been read yet, so there is nothing to summarize
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps([])
+            }
+
+        cached = cached_summaries(book_id, bucket)
+        if cached is not None:
+            logger.info(f"Serving {len(cached)} cached summary items for bookId {book_id} up to {bucket}%.")
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps(cached, cls=DecimalEncoder)
+            }
+
+        # Read ahead to the next bucket in the same query, so the reader's next
+        # request is a cache hit (or its generation is already under way).
+        prefetch = next_bucket(bucket)
+        upper = prefetch or bucket
+        logger.info(f"Querying summaries for bookId: {book_id} up to {upper}% (requested {bucket}%).")
 
         # Query DynamoDB for summary items.
         # We use KeyConditionExpression to filter by Partition Key (book_id)
-        # and Sort Key (progress) using the 'lte' (less than or equal to) condition.
+        # and Sort Key (progress) using the 'between' condition, which skips the
+        # manifest at progress 0 and the chapter recaps above 100.
         # This efficiently retrieves all items for the given book_id where the progress
         # is less than or equal to the requested percentage.
-        response = table.query(
-            KeyConditionExpression=Key('book_id').eq(book_id) & Key('progress').lte(percentage)
-            # If you were filtering by user_id, you would add a FilterExpression here:
-            # FilterExpression=Attr('user_id').eq(user_id_from_auth)
-            # Note: FilterExpression is applied *after* the query, so it consumes
-            # read capacity for all items matching the KeyConditionExpression,
-            # even if they are filtered out. Design your keys/indexes carefully.
-        )
+        with metrics.timed("query_summaries", book_id, upper=upper) as span:
+            response = table.query(
+                KeyConditionExpression=Key('book_id').eq(book_id) & Key('progress').between(1, upper)
+                # If you were filtering by user_id, you would add a FilterExpression here:
+                # FilterExpression=Attr('user_id').eq(user_id_from_auth)
+                # Note: FilterExpression is applied *after* the query, so it consumes
+                # read capacity for all items matching the KeyConditionExpression,
+                # even if they are filtered out. Design your keys/indexes carefully.
+            )
+            span["items"] = response.get('Count', len(response.get('Items', [])))
 
-        # Get the list of items from the query response
-        items = response.get('Items', [])
-        logger.info(f"Found {len(items)} summary items for bookId {book_id} up to {percentage}%.")
+        # Get the list of items from the query response, dropping pending markers
+        ready = [
+            {k: v for k, v in item.items() if k not in INTERNAL_ATTRIBUTES}
+            for item in response.get('Items', [])
+            if item.get('status') != PENDING_STATUS
+        ]
+        cache_summaries(book_id, ready)
+        items = [item for item in ready if item['progress'] <= bucket]
+        logger.info(f"Found {len(items)} summary items for bookId {book_id} up to {bucket}%.")
 
         # The items returned by the query are already sorted by the Sort Key (progress)
         # in ascending order by default, which is suitable for displaying summaries
         # in chronological order of progress. No additional sorting is needed here.
 
+        missing = []
+        if not items or items[-1]['progress'] != bucket:
+            missing.append(bucket)
+        if prefetch and not any(item['progress'] == prefetch for item in ready):
+            missing.append(prefetch)
+
+        manifest = stopped = None
+        if missing:
+            # Books processed before on-demand generation existed have no
+            # manifest and are served as they are. The generation marker sits
+            # right below the manifest, so one query reads both.
+            response = table.query(
+                KeyConditionExpression=Key('book_id').eq(book_id)
+                & Key('progress').between(GENERATION_MARKER_PROGRESS, MANIFEST_PROGRESS)
+            )
+            for item in response.get('Items', []):
+                if item['progress'] == MANIFEST_PROGRESS:
+                    manifest = item
+                elif item.get('retry_after', 0) > time.time():
+                    stopped = item
+        if stopped:
+            logger.info(f"Generation for bookId {book_id} stopped at {stopped.get('reached')}% "
+                        f"({stopped.get('status')}); serving what exists.")
+        elif manifest:
+            # One request covers both: a run generates every grid step up to its target
+            request_generation(book_id, max(missing))
+            if bucket in missing:
+                # 202: the summaries so far are returned, the requested one is on its way
+                return {
+                    'statusCode': 202,
+                    'headers': {'Content-Type': 'application/json', 'X-Summary-Pending': str(bucket)},
+                    'body': json.dumps(items, cls=DecimalEncoder)
+                }
+
         # Return the retrieved summary items in the response body
         return {
             'statusCode': 200,
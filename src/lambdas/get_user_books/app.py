@@ -1,9 +1,13 @@
+import base64
 import json
 import os
 import boto3
 import logging
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 from decimal import Decimal # Import Decimal for serialization
+from emf_metrics import EmfMetrics
+from lazy_resource import LazyResource
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -18,10 +22,27 @@ if not USER_BOOKS_TABLE_NAME:
     raise ValueError("USER_BOOKS_TABLE_NAME environment variable is not set.")
 # --- End check ---
 
+# GSI (user_id, upload_timestamp): the library sorted by upload time
+UPLOAD_TIME_INDEX = os.getenv("USER_BOOKS_UPLOAD_INDEX", "user_id-upload_timestamp-index")
+# GSI (user_id, status_uploaded), where status_uploaded = "<processing_status>#<upload_timestamp>",
+# so ?status=READY is a begins_with range read that is still sorted by upload time
+STATUS_INDEX = os.getenv("USER_BOOKS_STATUS_INDEX", "user_id-status_uploaded-index")
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+# Attributes needed to render the library list; everything else stays in the table
+LISTING_ATTRIBUTES = ["book_id", "book_title", "book_author", "file_name", "upload_timestamp",
+                      "processing_status", "current_reading_percentage"]
+# EMF metrics (see emf_metrics); METRICS_PER_BOOK adds a book_id dimension (load tests only)
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ReadRecall/Api")
+METRICS_PER_BOOK = os.getenv("METRICS_PER_BOOK", "false").lower() == "true"
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "getUserBooks")
+
+
 # Initialize the DynamoDB resource
-dynamodb = boto3.resource("dynamodb")
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb"))
 # Get the User Books DynamoDB table object
-user_books_table = dynamodb.Table(USER_BOOKS_TABLE_NAME)
+user_books_table = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE_NAME))
+metrics = EmfMetrics(FUNCTION_NAME, METRICS_NAMESPACE, METRICS_PER_BOOK)
 
 # Custom JSON Encoder to handle Decimal types (same as other Lambdas)
 class DecimalEncoder(json.JSONEncoder):
@@ -34,11 +55,78 @@ class DecimalEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def encode_cursor(last_evaluated_key: dict) -> str:
+    """
+    Opaque, URL-safe cursor for the next page. The key is stored in DynamoDB's
+    typed form ({"N": "..."}), so numbers come back as the exact Decimals that
+    ExclusiveStartKey needs rather than floats, which boto3 rejects.
+    """
+    serializer = TypeSerializer()
+    typed = {name: serializer.serialize(value) for name, value in last_evaluated_key.items()}
+    raw = json.dumps(typed, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, user_id: str) -> dict:
+    """Inverse of encode_cursor; rejects cursors that belong to another user."""
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    typed = json.loads(raw)
+    if not isinstance(typed, dict) or not all(isinstance(value, dict) and value for value in typed.values()):
+        raise ValueError("malformed cursor")
+    deserializer = TypeDeserializer()
+    key = {name: deserializer.deserialize(value) for name, value in typed.items()}
+    if key.get("user_id") != user_id:
+        raise ValueError("cursor does not belong to this user")
+    return key
+
+
+def query_library_page(user_id: str, limit: int, status: str = None, newest_first: bool = True,
+                       exclusive_start_key: dict = None):
+    """
+    Reads one page of the user's library through the upload-time or status index,
+    returning (items, last_evaluated_key). DynamoDB can stop early at 1 MB, so
+    pages are followed until `limit` items are collected.
+    """
+    names = {f"#a{i}": attr for i, attr in enumerate(LISTING_ATTRIBUTES)}
+    kwargs = {
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+        "ScanIndexForward": not newest_first,
+    }
+    if status:
+        kwargs["IndexName"] = STATUS_INDEX
+        kwargs["KeyConditionExpression"] = Key("user_id").eq(user_id) & Key("status_uploaded").begins_with(f"{status}#")
+    else:
+        kwargs["IndexName"] = UPLOAD_TIME_INDEX
+        kwargs["KeyConditionExpression"] = Key("user_id").eq(user_id)
+        # Deleted books stay in the table until cleanupBook has removed their data
+        kwargs["FilterExpression"] = Attr("processing_status").ne("DELETED")
+
+    items = []
+    while len(items) < limit:
+        if exclusive_start_key:
+            kwargs["ExclusiveStartKey"] = exclusive_start_key
+        response = user_books_table.query(Limit=limit - len(items), **kwargs)
+        items.extend(response.get("Items", []))
+        exclusive_start_key = response.get("LastEvaluatedKey")
+        if not exclusive_start_key:
+            break
+    return items, exclusive_start_key
+
+
 def lambda_handler(event, context):
     """
     Retrieves a list of books for a given user from the User Books table.
     Triggered by API Gateway GET /users/{userId}/books.
     Expects user_id in request headers (e.g., 'user-id', 'User-Id', or 'user_id').
+
+    Query parameters (all optional):
+      limit  - page size (default 50, max 100)
+      cursor - value of the X-Next-Cursor header from the previous page
+      status - only books with this processing_status, e.g. READY
+      order  - "newest" (default) or "oldest", by upload time
+    The body is a list of books with the listing attributes only; the
+    X-Next-Cursor response header is set while more pages remain.
     """
     logger.info(f"Received event: {json.dumps(event)}")
 
@@ -65,24 +153,38 @@ def lambda_handler(event, context):
             }
         # --- End explicit return ---
 
-        logger.info(f"Querying books for user: {user_id}")
+        params = event.get('queryStringParameters') or {}
+        status = (params.get('status') or '').upper() or None
+        order = params.get('order', 'newest')
+        try:
+            limit = int(params.get('limit', DEFAULT_PAGE_SIZE))
+            if not 1 <= limit <= MAX_PAGE_SIZE or order not in ('newest', 'oldest'):
+                raise ValueError("limit or order out of range")
+            start_key = decode_cursor(params['cursor'], user_id) if params.get('cursor') else None
+        except (ValueError, TypeError, json.JSONDecodeError) as e:
+            logger.warning(f"Invalid pagination parameters {params}: {e}")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': 'Invalid limit, order or cursor'})
+            }
 
-        # Query DynamoDB for all items with the given userId (Partition Key)
-        # This will return all books owned by this user.
-        response = user_books_table.query(
-            KeyConditionExpression=Key('user_id').eq(user_id) # Use 'user_id' as the Partition Key name
-        )
+        logger.info(f"Querying books for user: {user_id} (status={status}, limit={limit}, order={order})")
 
-        # Get the list of items from the query response
-        items = response.get('Items', [])
-        logger.info(f"Found {len(items)} books for user {user_id}.")
+        with metrics.timed("query_library", status=status, limit=limit) as span:
+            items, last_key = query_library_page(user_id, limit, status=status,
+                                                 newest_first=(order == 'newest'),
+                                                 exclusive_start_key=start_key)
+            span["items"] = len(items)
+        logger.info(f"Returning {len(items)} books for user {user_id}; more: {bool(last_key)}.")
 
-        # The items are returned sorted by the Sort Key (bookId) by default.
+        response_headers = {'Content-Type': 'application/json'}
+        if last_key:
+            response_headers['X-Next-Cursor'] = encode_cursor(last_key)
 
         # Return the retrieved book items in the response body
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json'},
+            'headers': response_headers,
             # Use the custom DecimalEncoder to serialize the items
             'body': json.dumps(items, cls=DecimalEncoder)
         }
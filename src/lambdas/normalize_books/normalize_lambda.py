@@ -1,98 +1,572 @@
-import json, os, re, tempfile, logging
+import io, json, os, posixpath, re, shutil, tempfile, logging, threading, time, zipfile
+from datetime import datetime
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
 from uuid import uuid4
+from urllib.parse import unquote, unquote_plus
 
 import boto3
-from ebooklib import epub, ITEM_DOCUMENT
-import fitz  # PyMuPDF
+from emf_metrics import EmfMetrics
+from lazy_resource import LazyResource
+from pipeline_state import CancellationChecks, WorkClaims
+# PyMuPDF (fitz) is imported in normalize_pdf: EPUB-only batches never pay for loading it
 
 # ---------- config ----------
 DEST_BUCKET        = os.getenv("DEST_BUCKET", "normalized-books")              # where the JSON will be written
 OUTPUT_QUEUE_URL   = os.getenv("OUTPUT_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/summarize-character-queue")         # next‑stage SQS queue
 REGION             = os.getenv("AWS_REGION", "us-east-1")
+# Progress events for bookProgressNotifier (user_books status + pushes to clients); empty disables
+PROGRESS_EVENTS_QUEUE_URL = os.getenv("PROGRESS_EVENTS_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/577125335862/book-progress-events-queue")
+# Per-user fair scheduling: at most PER_USER_CONCURRENCY books per user are in the
+# summarizer queue at once; the rest wait in BOOK_JOBS_TABLE for fair-dispatcher.
+FAIR_SCHEDULING       = os.getenv("FAIR_SCHEDULING", "true").lower() == "true"
+BOOK_JOBS_TABLE       = os.getenv("BOOK_JOBS_TABLE", "book_jobs")
+USER_SCHEDULING_TABLE = os.getenv("USER_SCHEDULING_TABLE", "user_scheduling")
+PER_USER_CONCURRENCY  = int(os.getenv("PER_USER_CONCURRENCY", "3"))
+# Idempotency claims per (stage, book_id, content version); duplicate S3 events and
+# SQS redeliveries of a book that is already done (or being done) are skipped.
+IDEMPOTENCY_TABLE     = os.getenv("IDEMPOTENCY_TABLE", "pipeline_idempotency")
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "900"))   # crashed worker's claim can be retaken after this
+IDEMPOTENCY_TTL_SECONDS   = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(30 * 24 * 3600)))
+# Pipelining across the records of one invocation: downloads, uploads and scheduling run on
+# IO_WORKERS threads while the main thread parses; at most PREFETCH_DEPTH books wait on /tmp.
+IO_WORKERS            = int(os.getenv("IO_WORKERS", "4"))
+PREFETCH_DEPTH        = int(os.getenv("PREFETCH_DEPTH", "2"))
+SQS_BATCH_SIZE        = 10   # send_message_batch limit
+# PDF cleanup: a line among the first/last PDF_EDGE_LINES of a page that repeats (digits
+# ignored) on at least PDF_REPEAT_SHARE of pages is a running header/footer and is dropped.
+PDF_EDGE_LINES        = int(os.getenv("PDF_EDGE_LINES", "2"))
+PDF_REPEAT_SHARE      = float(os.getenv("PDF_REPEAT_SHARE", "0.5"))
+PDF_REPEAT_MIN_PAGES  = 3
+# Cancellation: deleting or replacing a book sets cancelled_before (epoch ms) on its
+# user_books row; work on a version uploaded before it is dropped. The row is re-read
+# at most every CANCEL_CHECK_TTL_SECONDS per book.
+USER_BOOKS_TABLE      = os.getenv("USER_BOOKS_TABLE_NAME", "user_books")
+CANCEL_CHECK_TTL_SECONDS = float(os.getenv("CANCEL_CHECK_TTL_SECONDS", "5"))
+# EMF metrics (see emf_metrics); METRICS_PER_BOOK adds a book_id dimension (load tests only)
+METRICS_NAMESPACE     = os.getenv("METRICS_NAMESPACE", "ReadRecall/Pipeline")
+METRICS_PER_BOOK      = os.getenv("METRICS_PER_BOOK", "false").lower() == "true"
+FUNCTION_NAME         = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "normalize-books")
+# Memory planning: each book gets a plan from its size and the function's memory. Parsing
+# takes about NORMALIZE_MEMORY_FACTOR times the file size, and up to PREFETCH_DEPTH + 1
+# books are in flight at once, sharing MEMORY_USABLE_SHARE of the memory (see plan_memory).
+MEMORY_LIMIT_MB       = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1024"))
+MEMORY_USABLE_SHARE   = float(os.getenv("MEMORY_USABLE_SHARE", "0.6"))     # the rest: runtime, clients, buffers
+NORMALIZE_MEMORY_FACTOR = {"epub": float(os.getenv("EPUB_MEMORY_FACTOR", "10")),   # zipped HTML inflates
+                           "pdf":  float(os.getenv("PDF_MEMORY_FACTOR", "3"))}     # mostly fonts and images
+IN_MEMORY_MAX_MB      = int(os.getenv("IN_MEMORY_MAX_MB", "16"))            # larger files always go through /tmp
+# Share of invocations that also trace Python allocations (tracemalloc slows allocation down)
+MEMORY_TRACE_SAMPLE_RATE = float(os.getenv("MEMORY_TRACE_SAMPLE_RATE", "0.05"))
+MB                    = 1024 * 1024
 
-s3  = boto3.client("s3")
-sqs = boto3.client("sqs", region_name=REGION)
+s3  = LazyResource(lambda: boto3.client("s3"))
+sqs = LazyResource(lambda: boto3.client("sqs", region_name=REGION))
+dynamodb        = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+book_jobs       = LazyResource(lambda: dynamodb.Table(BOOK_JOBS_TABLE))
+user_scheduling = LazyResource(lambda: dynamodb.Table(USER_SCHEDULING_TABLE))
+idempotency     = LazyResource(lambda: dynamodb.Table(IDEMPOTENCY_TABLE))
+user_books      = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE))
+
+metrics         = EmfMetrics(FUNCTION_NAME, METRICS_NAMESPACE, METRICS_PER_BOOK)
+work_claims     = WorkClaims(idempotency, IDEMPOTENCY_LEASE_SECONDS, IDEMPOTENCY_TTL_SECONDS)
+cancellations   = CancellationChecks(user_books, CANCEL_CHECK_TTL_SECONDS)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
+# ---------- memory ----------
+def plan_memory(size, ext):
+    """
+    Execution plan for a book file of `size` bytes:
+      memory - downloaded into memory and parsed from there, with no /tmp round trip
+      spill  - downloaded to /tmp and parsed from the file
+      stream - as spill, and the normalized JSON is also written to /tmp and uploaded
+               in parts instead of being encoded in memory in one piece
+    """
+    share = MEMORY_LIMIT_MB * MB * MEMORY_USABLE_SHARE / (PREFETCH_DEPTH + 1)
+    need  = size * NORMALIZE_MEMORY_FACTOR.get(ext, 10)
+    if size <= IN_MEMORY_MAX_MB * MB and need + size <= share:
+        return "memory"
+    if shutil.disk_usage(tempfile.gettempdir()).free < 3 * size:
+        logger.warning(f"/tmp has no room for a {size} byte book; keeping it in memory")
+        return "memory"
+    return "spill" if need <= share else "stream"
+
 # ---------- helpers ----------
 def download_from_s3(bucket, key, local_path):
     s3.download_file(bucket, key, local_path)
 
-def upload_to_s3(local_path, bucket, key):
-    s3.upload_file(local_path, bucket, key)
+def upload_json_to_s3(book_json, bucket, key):
+    """Uploads the normalized book; returns its size in bytes."""
+    body = json.dumps(book_json, ensure_ascii=False).encode("utf-8")
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/json")
+    return len(body)
 
-def send_next_event(user_id, book_id, json_s3_key, bucket_name):
+def upload_json_file_to_s3(book_json, bucket, key):
+    """As upload_json_to_s3, but encodes to /tmp and uploads from there in parts."""
+    fd, path = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(book_json, f, ensure_ascii=False)
+        s3.upload_file(path, bucket, key, ExtraArgs={"ContentType": "application/json"})
+        return os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+def next_event(user_id, book_id, json_s3_key, bucket_name, content_version=None, issued_at=None,
+               normalized_bytes=None):
+    """
+    Payload for the summarizers, or None when fair scheduling parked the book
+    for fair-dispatcher. Returned payloads are sent by send_next_events.
+    """
     payload = {"user_id": user_id,
                "book_id": book_id,
                "bucket_name": bucket_name,
-               "json_s3_key": json_s3_key}
-    
-    sqs.send_message(QueueUrl=OUTPUT_QUEUE_URL,
-                     MessageBody=json.dumps(payload))
+               "json_s3_key": json_s3_key,
+               "content_version": content_version,
+               "issued_at": issued_at,   # upload time, checked against cancellations downstream
+               "normalized_bytes": normalized_bytes}   # lets the summarizers plan memory without a HEAD
+
+    if FAIR_SCHEDULING:
+        return schedule_book(payload)
+    return payload
+
+def publish_progress(user_id, book_id, event, **details):
+    """Best effort: a lost progress event must never fail the book itself."""
+    if not PROGRESS_EVENTS_QUEUE_URL:
+        return
+    try:
+        sqs.send_message(QueueUrl=PROGRESS_EVENTS_QUEUE_URL,
+                         MessageBody=json.dumps({"user_id": user_id, "book_id": book_id, "event": event,
+                                                 "at": int(time.time() * 1000), **details}))
+    except Exception as exc:
+        logger.warning(f"Could not publish {event} for {book_id}: {exc}")
+
+def send_next_events(payloads):
+    """Sends payloads SQS_BATCH_SIZE at a time; returns the indexes that could not be sent."""
+    failed = []
+    for start in range(0, len(payloads), SQS_BATCH_SIZE):
+        entries = [{"Id": str(i), "MessageBody": json.dumps(payloads[i])}
+                   for i in range(start, min(start + SQS_BATCH_SIZE, len(payloads)))]
+        try:
+            resp = sqs.send_message_batch(QueueUrl=OUTPUT_QUEUE_URL, Entries=entries)
+        except Exception as exc:
+            logger.exception(f"send_message_batch failed: {exc}")
+            failed.extend(int(e["Id"]) for e in entries)
+            continue
+        for err in resp.get("Failed", []):
+            logger.error(f"Failed to send next event: {err}")
+            failed.append(int(err["Id"]))
+    return failed
 
+# ---------- fair scheduling ----------
+def _claim_user_slot(user_id):
+    """Takes one of the user's concurrency slots; False if they are all in use."""
+    try:
+        user_scheduling.update_item(
+            Key={"user_id": user_id},
+            UpdateExpression="ADD inflight :one",
+            ConditionExpression="attribute_not_exists(inflight) OR inflight < :cap",
+            ExpressionAttributeValues={":one": 1, ":cap": PER_USER_CONCURRENCY})
+        return True
+    except user_scheduling.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def schedule_book(payload):
+    """
+    Records the book as a job for its user. If the user has a free slot the
+    payload is returned to go straight to the summarizer queue, so a typical
+    single upload never waits; otherwise it stays QUEUED and fair-dispatcher
+    releases it round-robin across users as slots free up.
+    """
+    user_id = payload["user_id"]
+    job_id  = f"{int(time.time() * 1000):015d}#{payload['book_id']}"   # sorts oldest first
+    payload = {**payload, "job_id": job_id}
+    dispatched = _claim_user_slot(user_id)
+
+    book_jobs.put_item(Item={"user_id": user_id, "job_id": job_id,
+                             "status": "DISPATCHED" if dispatched else "QUEUED",
+                             "payload": json.dumps(payload),
+                             "created_at": int(time.time())})
+    if dispatched:
+        logger.info(f"Dispatching {job_id} for {user_id} immediately")
+        return payload
+
+    # pending_flag only exists while the user has queued jobs (sparse GSI for the dispatcher)
+    user_scheduling.update_item(
+        Key={"user_id": user_id},
+        UpdateExpression="ADD pending :one SET pending_flag = :y, last_served_at = if_not_exists(last_served_at, :zero)",
+        ExpressionAttributeValues={":one": 1, ":y": "Y", ":zero": 0})
+    logger.info(f"Queued {job_id}: {user_id} already has {PER_USER_CONCURRENCY} books in flight")
+    return None
+
+def unschedule_book(payload):
+    """Undoes schedule_book for a dispatched book whose message could not be sent."""
+    book_jobs.delete_item(Key={"user_id": payload["user_id"], "job_id": payload["job_id"]})
+    user_scheduling.update_item(
+        Key={"user_id": payload["user_id"]},
+        UpdateExpression="ADD inflight :minus_one",
+        ExpressionAttributeValues={":minus_one": -1})
+
+# ---------- S3 keys ----------
 def extract_user_and_book_id_from_key(key):
     # Match keys like: books/{user_id}/{book_id}/{filename}.{ext}
     m = re.match(r"books/([^/]+)/([^/]+)/[^/]+\.[^.]+$", key)
     return (m.group(1), m.group(2)) if m else (None, None)
 
 # ---------- normalization ----------
-# --- EPUB (same logic you supplied, trimmed for brevity) ---
-def normalize_epub(path, book_id, user_id):
-    book       = epub.read_epub(path)
-    title      = (book.get_metadata("DC", "title") or [["Unknown Title"]])[0][0]
-    author     = (book.get_metadata("DC", "creator") or [["Unknown Author"]])[0][0]
-    chapters   = []
-    chap_idx   = 1
-
-    for item in book.get_items():
-        if item.get_type() != ITEM_DOCUMENT:
-            continue
-        html     = item.get_content().decode("utf‑8")
-        chap_ttl = re.search(r"<title>(.*?)</title>", html)
-        chap_ttl = chap_ttl.group(1) if chap_ttl else f"Chapter {chap_idx}"
+# --- EPUB ---
+# Read straight from the zip: container.xml ➜ OPF ➜ spine order, one document at a time,
+# each fed in chunks to an incremental HTML tokenizer that emits paragraph blocks.
+BLOCK_TAGS    = {"p", "div", "li", "blockquote", "pre", "section", "article", "aside", "tr", "td",
+                 "dt", "dd", "figcaption", "h4", "h5", "h6", "hr", "table", "ul", "ol"}
+HEADING_TAGS  = {"h1", "h2", "h3"}
+SKIP_TAGS     = {"script", "style", "head", "svg"}
+HTML_TYPES    = {"application/xhtml+xml", "text/html"}
+EPUB_READ_CHUNK = 64 * 1024
 
-        clean    = re.sub(r"<[^>]+>", " ", html)
-        clean    = re.sub(r"\s+", " ", clean).strip()
-        paras    = [p.strip() for p in clean.split("\n\n") if p.strip()]
+class EpubBlockParser(HTMLParser):
+    """Turns one XHTML document into paragraph/image blocks plus a chapter title."""
 
-        content  = [{"type": "paragraph", "text": p} for p in paras]
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks   = []
+        self.title    = None    # <title>
+        self.heading  = None    # first h1-h3, preferred as the chapter title; later ones stay in the text
+        self._buf     = []
+        self._skip    = 0
+        self._in_title = False
+        self._in_heading = False
 
-        for img in re.finditer(r'<img[^>]+src="([^"]+)"', html):
-            content.append({"type": "image",
-                            "src": f"placeholder_{uuid4()}.jpg"})
+    def _flush(self):
+        text = " ".join("".join(self._buf).split())
+        self._buf = []
+        if not text:
+            return
+        if self._in_heading and self.heading is None:
+            self.heading = text
+        elif self._in_heading:
+            # a section heading inside the chapter, or the next chapter of a file holding several
+            self.blocks.append({"type": "paragraph", "text": text, "heading": True})
+        else:
+            self.blocks.append({"type": "paragraph", "text": text})
 
-        chapters.append({"id": chap_idx,
-                         "title": chap_ttl,
-                         "content": content})
-        chap_idx += 1
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self._in_title, self.title = True, ""
+        elif tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag in BLOCK_TAGS or tag in HEADING_TAGS:
+            self._flush()
+            self._in_heading = tag in HEADING_TAGS
+        elif tag == "br":
+            self._buf.append(" ")
+        elif tag in ("img", "image") and not self._skip:
+            self._flush()
+            self.blocks.append({"type": "image", "src": f"placeholder_{uuid4()}.jpg"})
 
-    return {"book_id": book_id, "title": title,
-            "author": author, "chapters": chapters}
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+        elif tag in SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in BLOCK_TAGS or tag in HEADING_TAGS:
+            self._flush()
+            self._in_heading = False
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip:
+            self._buf.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+        self.title = " ".join((self.title or "").split()) or None
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def read_epub_package(zf):
+    """Returns (opf metadata dict, [zip member of each spine document in reading order])."""
+    container = ET.fromstring(zf.read("META-INF/container.xml"))
+    opf_path  = next(el.get("full-path") for el in container.iter() if _local(el.tag) == "rootfile")
+    opf_dir   = posixpath.dirname(opf_path)
+    opf       = ET.fromstring(zf.read(opf_path))
+
+    meta, manifest, spine = {}, {}, []
+    for el in opf.iter():
+        name = _local(el.tag)
+        if name in ("title", "creator") and name not in meta and (el.text or "").strip():
+            meta[name] = el.text.strip()
+        elif name == "item":
+            manifest[el.get("id")] = (el.get("href"), el.get("media-type"))
+        elif name == "itemref" and el.get("linear", "yes") != "no":
+            spine.append(el.get("idref"))
+
+    members = []
+    for idref in spine:
+        href, media_type = manifest.get(idref, (None, None))
+        if href and media_type in HTML_TYPES:
+            members.append(posixpath.normpath(posixpath.join(opf_dir, unquote(href.split("#")[0]))))
+    return meta, members
+
+def parse_epub_document(zf, member):
+    """Streams one spine document through EpubBlockParser without decoding it in one piece."""
+    parser = EpubBlockParser()
+    with zf.open(member) as raw:
+        reader = io.TextIOWrapper(raw, encoding="utf-8", errors="replace")
+        for chunk in iter(lambda: reader.read(EPUB_READ_CHUNK), ""):
+            parser.feed(chunk)
+    parser.close()
+    return parser
+
+def normalize_epub(source, book_id, user_id):
+    """`source` is a path or an in-memory file (see plan_memory)."""
+    chapters = []
+    with zipfile.ZipFile(source) as zf:
+        meta, members = read_epub_package(zf)
+        for member in members:
+            try:
+                doc = parse_epub_document(zf, member)
+            except KeyError:
+                logger.warning(f"Spine item {member} missing from {book_id}, skipped")
+                continue
+            if not doc.blocks:
+                continue     # e.g. an empty wrapper page
+            chap_idx = len(chapters) + 1
+            chapter = {"id": chap_idx, "title": doc.heading or doc.title, "content": doc.blocks}
+            if not chapter["title"]:
+                chapter.update(title=f"Chapter {chap_idx}", untitled=True)   # see classify_chapter
+            chapters.append(chapter)
+
+    return {"book_id": book_id, "title": meta.get("title", "Unknown Title"),
+            "author": meta.get("creator", "Unknown Author"), "chapters": chapters}
+
+# --- PDF cleanup ---
+# Roman numerals number front matter only: well-formed and below 400 (no d/m),
+# so words such as "did", "mild" or "civil" are never taken for page numbers
+ROMAN_PAGE      = r"(?=[ivxlc])c{0,3}(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})"
+# A bare Roman numeral is a page number only in lower case; "IV" or "XIV" alone is as
+# likely a chapter heading, and counts only when pages next to it repeat one (see roman_page_edges)
+PAGE_NUMBER_RE  = re.compile(rf"^(?:(?i:page\s+(?:\d+|{ROMAN_PAGE}))|\d+|{ROMAN_PAGE})(?i:\s+of\s+\d+)?$")
+UPPER_ROMAN_RE  = re.compile(rf"^{ROMAN_PAGE.upper()}$")
+# A word broken over one line break (never a paragraph break) by a hyphen
+HYPHEN_BREAK_RE = re.compile(r"(\w+)-\n[ \t]*([a-z]\w*)")
+# Words of the document that touch no hyphen, to tell a broken word from a compound
+WORD_RE         = re.compile(r"(?<![\w-])[a-z]+(?![\w-])")
+
+def _edge_signature(line):
+    """Header/footer identity of a line: case and page numbers ignored."""
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+def _text_chars(text):
+    """Characters of text that are not whitespace, so line and paragraph breaks never count."""
+    return len("".join(text.split()))
+
+def document_words(pages_lines):
+    """Lower-cased words used anywhere in the document, the dictionary hyphen breaks are checked against."""
+    words = set()
+    for lines in pages_lines:
+        words.update(WORD_RE.findall("\n".join(lines).lower()))
+    return words
+
+def roman_page_edges(pages_lines):
+    """
+    Per page, the edges (0 top, -1 bottom) where an upper-case Roman numeral is a page
+    number: the page before or after also has one at that edge.
+    """
+    found = []
+    for lines in pages_lines:
+        lines = [l.strip() for l in lines if l.strip()]
+        found.append({edge for edge, edge_lines in ((0, lines[:PDF_EDGE_LINES]), (-1, lines[-PDF_EDGE_LINES:]))
+                      if any(UPPER_ROMAN_RE.match(l) for l in edge_lines)})
+    return [{edge for edge in edges
+             if (i > 0 and edge in found[i - 1]) or (i + 1 < len(found) and edge in found[i + 1])}
+            for i, edges in enumerate(found)]
+
+def _join_hyphen_break(match, words):
+    """"inter-\nesting" ➜ "interesting", but "well-\nknown" ➜ "well-known" when "wellknown" is no word."""
+    prefix, rest = match.group(1), match.group(2)
+    if (prefix + rest).lower() in words or prefix.lower() not in words:
+        return prefix + rest
+    return f"{prefix}-{rest}"
+
+def find_running_lines(pages_lines):
+    """
+    Counts, over the whole document, how many pages carry each top/bottom line
+    and returns the signatures that repeat often enough to be headers/footers.
+    """
+    counts = {}
+    for lines in pages_lines:
+        # blank lines (e.g. the "" after get_text()'s final newline) are skipped, as in clean_page_text
+        lines = [l for l in lines if l.strip()]
+        edges = {_edge_signature(l) for l in lines[:PDF_EDGE_LINES] + lines[-PDF_EDGE_LINES:]}
+        for sig in edges:
+            counts[sig] = counts.get(sig, 0) + 1
+    needed = max(PDF_REPEAT_MIN_PAGES, PDF_REPEAT_SHARE * len(pages_lines))
+    return {sig for sig, n in counts.items() if n >= needed}
+
+def clean_page_text(lines, running, words, roman_edges=()):
+    """
+    Drops running headers/footers and page numbers at the page edges, then rejoins
+    hyphenated words. `words` is document_words(); `roman_edges` the page's entry of
+    roman_page_edges().
+    """
+    lines = list(lines)
+    for edge in (0, -1):
+        dropped = 0
+        while lines and dropped < PDF_EDGE_LINES:
+            line = lines[edge].strip()
+            if not line:
+                lines.pop(edge)          # blank edge lines do not count towards the limit
+                continue
+            page_number = PAGE_NUMBER_RE.match(line) or (edge in roman_edges and UPPER_ROMAN_RE.match(line))
+            if _edge_signature(line) not in running and not page_number:
+                break
+            lines.pop(edge)
+            dropped += 1
+    text = "\n".join(lines)
+    # a capital after the break is kept as a real hyphen (the pattern needs lower case)
+    return HYPHEN_BREAK_RE.sub(lambda m: _join_hyphen_break(m, words), text)
+
+# --- PDF chapters ---
+# Chapter starts come from the outline (get_toc) when there is one, else from lines set in a
+# larger font than the body text at the top of a page, else from "Chapter N" opening a page.
+HEADING_SIZE_RATIO = float(os.getenv("PDF_HEADING_SIZE_RATIO", "1.3"))
+HEADING_MAX_CHARS  = 80
+CHAPTER_LINE_RE    = re.compile(r"^chapter\s+\d+", re.I)
+
+MIN_TOC_CHAPTERS   = 3
+
+def toc_chapter_starts(pdf):
+    """
+    {page index: title} from the outline. Uses the shallowest level with at least
+    MIN_TOC_CHAPTERS entries, so "Part One / Part Two" outlines split on their chapters.
+    """
+    toc = [(lvl, (ttl or "").strip(), page - 1) for lvl, ttl, page, *_ in (pdf.get_toc(simple=True) or [])
+           if 1 <= page <= len(pdf)]
+    counts = {}
+    for lvl, _, _ in toc:
+        counts[lvl] = counts.get(lvl, 0) + 1
+    if not counts or max(counts.values()) < 2:
+        return None
+    level = next((lvl for lvl in sorted(counts) if counts[lvl] >= MIN_TOC_CHAPTERS), max(counts, key=counts.get))
+    starts = {}
+    for lvl, ttl, page in toc:
+        if lvl == level:
+            starts.setdefault(page, ttl)           # several entries on one page ➜ keep the first
+    return starts
+
+def page_font_lines(page_dict, sizes):
+    """
+    (text, largest font size) of the top lines of one page from its get_text("dict");
+    adds the characters set in each font size to `sizes`.
+    """
+    lines = []
+    for block in page_dict.get("blocks", []):
+        for line in block.get("lines", []):
+            spans = [sp for sp in line.get("spans", []) if sp.get("text", "").strip()]
+            if not spans:
+                continue
+            for sp in spans:
+                size = round(sp["size"], 1)
+                sizes[size] = sizes.get(size, 0) + len(sp["text"])
+            lines.append((" ".join(sp["text"].strip() for sp in spans), max(sp["size"] for sp in spans)))
+    return lines[:3]
+
+def font_chapter_starts(sizes, tops):
+    """
+    {page index: title} for pages whose top lines are set well above the body font size.
+    `sizes` and `tops` (one entry per page) come from page_font_lines.
+    """
+    if not sizes:
+        return None
+
+    body = max(sizes, key=sizes.get)          # the size most characters are set in
+    starts = {}
+    for i, lines in enumerate(tops):
+        heading = [t for t, size in lines if size >= body * HEADING_SIZE_RATIO and len(t) <= HEADING_MAX_CHARS]
+        if heading:
+            starts[i] = " ".join(heading[:2])
+    # big text on most pages is a running header or a picture book, not chapter starts
+    if len(starts) < 2 or len(starts) > len(tops) / 2:
+        return None
+    return starts
+
+def regex_chapter_starts(pages_paras):
+    starts = {i: paras[0].split("\n", 1)[0].strip() for i, paras in enumerate(pages_paras)
+              if paras and CHAPTER_LINE_RE.match(paras[0])}
+    return starts or None
+
+def _strip_heading(paras, title):
+    """Drops the chapter title from the top of its first page; it is kept as the title only."""
+    if not paras or not title:
+        return paras
+    squash = lambda t: " ".join(t.lower().split())
+    lines = paras[0].split("\n")
+    for n in range(1, min(3, len(lines)) + 1):      # headings can wrap over a couple of lines
+        if squash(" ".join(lines[:n])) == squash(title):
+            rest = "\n".join(lines[n:]).strip()
+            return ([rest] if rest else []) + paras[1:]
+    return paras
 
 # --- PDF ---
-def normalize_pdf(path, book_id, user_id):
-    pdf   = fitz.open(path)
+def normalize_pdf(source, book_id, user_id):
+    """`source` is a path or an in-memory file (see plan_memory)."""
+    import fitz  # PyMuPDF
+    if isinstance(source, str):
+        pdf = fitz.open(source)
+    else:
+        pdf = fitz.open(stream=source.getbuffer(), filetype="pdf")
     meta  = pdf.metadata or {}
-    title = meta.get("title",  "Unknown Title")
-    auth  = meta.get("author", "Unknown Author")
+    title = meta.get("title") or "Unknown Title"
+    auth  = meta.get("author") or "Unknown Author"
+
+    # one text pass over the document; headers are found across all pages before any is cleaned.
+    # Without an outline, the same pass reads font sizes off each page's text page for font_chapter_starts.
+    toc_starts  = toc_chapter_starts(pdf)
+    pages_lines, font_sizes, font_tops = [], {}, []
+    for page in pdf:
+        textpage = page.get_textpage()
+        pages_lines.append(page.get_text(textpage=textpage).split("\n"))
+        if not toc_starts:
+            font_tops.append(page_font_lines(page.get_text("dict", textpage=textpage), font_sizes))
+    running     = find_running_lines(pages_lines)
+    words       = document_words(pages_lines)
+    roman_edges = roman_page_edges(pages_lines)
+    raw_chars   = sum(_text_chars(l) for lines in pages_lines for l in lines)
+    pages_paras = []
+    for lines, edges in zip(pages_lines, roman_edges):
+        text = clean_page_text(lines, running, words, edges)
+        pages_paras.append([p.strip() for p in text.split("\n\n") if p.strip()])
+    kept_chars  = sum(_text_chars(p) for paras in pages_paras for p in paras)
 
-    chapters, chap_id = [], 1
-    current           = {"id": chap_id, "title": f"Chapter {chap_id}", "content": []}
+    chapter_source, starts = "outline", toc_starts
+    if not starts:
+        chapter_source, starts = "font", font_chapter_starts(font_sizes, font_tops)
+    if not starts:
+        chapter_source, starts = "regex", regex_chapter_starts(pages_paras)
+    starts = starts or {}
+    logger.info(f"{book_id}: {len(starts)} chapter starts from "
+                f"{chapter_source if starts else 'nothing (one chapter)'}")
 
+    chapters, current = [], None
     for i in range(len(pdf)):
-        page = pdf[i]
-        text = page.get_text()
-        paras = [p.strip() for p in text.split("\n\n") if p.strip()]
+        page  = pdf[i]
+        paras = pages_paras[i]
 
-        # naïve chapter detection
-        if i == 0 or (paras and re.match(r"^chapter\s+\d+", paras[0], re.I)):
-            if current["content"]:
+        if current is None or i in starts:
+            if current and current["content"]:
                 chapters.append(current)
-                chap_id += 1
-            chapter_title = paras[0] if paras else f"Chapter {chap_id}"
-            current = {"id": chap_id, "title": chapter_title, "content": []}
-            paras = paras[1:] if paras else paras
+            chap_id = len(chapters) + 1
+            chapter_title = starts.get(i) or f"Chapter {chap_id}"
+            current = {"id": chap_id, "title": chapter_title, "content": [], "pages": [i + 1, i + 1]}
+            if not starts.get(i):
+                current["untitled"] = True   # see classify_chapter
+            paras = _strip_heading(paras, starts.get(i))
+        current["pages"][1] = i + 1
 
         current["content"].extend({"type": "paragraph", "text": p} for p in paras)
 
@@ -101,69 +575,300 @@ def normalize_pdf(path, book_id, user_id):
             current["content"].append({"type": "image",
                                        "src": f"placeholder_{uuid4()}.jpg"})
 
-    if current["content"]:
+    if current and current["content"]:
         chapters.append(current)
 
+    # ~4 characters per token; every progress step re-sends this text to Gemini
+    cleanup = {"running_lines": len(running),
+               "chars_before": raw_chars, "chars_after": kept_chars,
+               "est_tokens_saved": (raw_chars - kept_chars) // 4,
+               "reduction_pct": round(100 * (raw_chars - kept_chars) / raw_chars, 1) if raw_chars else 0.0}
+    logger.info(json.dumps({"event": "pdf_cleanup", "book_id": book_id, **cleanup}))
+
     return {"book_id": book_id, "title": title,
-            "author": auth, "chapters": chapters}
+            "author": auth, "chapters": chapters, "cleanup": cleanup,
+            "chapter_source": chapter_source if starts else "none"}
+
+# --- content classes ---
+# Each chapter gets "content_class": "narrative", "front_matter" or "back_matter".
+# The summarizers and Q&A only read narrative chapters, and progress % is measured over them.
+# Titles match as a whole ("Notes", "Index", "Cover") or by a phrase that opens them
+# ("Praise for ...", "About the Author"), so "Notes from Underground" stays narrative.
+FRONT_TITLE_RE = re.compile(r"^\W*(?:(?:copyright(?: page)?|contents|table of contents|dedication|title page|"
+                            r"half title|epigraph|frontispiece|cover)\W*$|(?:also by|praise for|"
+                            r"by the same author)\b)", re.I)
+BACK_TITLE_RE  = re.compile(r"^\W*(?:(?:acknowledge?ments?|index|bibliography|glossary|notes|endnotes|"
+                            r"newsletter)\W*$|(?:about the authors?|about the publisher|also by|reading group|"
+                            r"discussion questions|excerpt|other books)\b)", re.I)
+BOILERPLATE_RE = re.compile(r"(©|\ball rights reserved\b|\bisbn\b|\bfirst published\b|\bprinted in\b|"
+                            r"\blibrary of congress\b|\bwww\.|\bsign up\b)", re.I)
+NARRATIVE_MIN_WORDS = 120   # shorter chapters at the edges of the book need no other evidence
+
+def _looks_like_listing(paras):
+    """TOC and index pages: mostly short entries that end in page numbers or are chapter headings."""
+    if len(paras) < 5:
+        return False
+    listing = sum(1 for p in paras if len(p) < 80 and (re.search(r"\d+\s*$", p) or re.match(r"^(chapter|part)\b", p, re.I)))
+    return listing / len(paras) > 0.6
+
+def classify_chapter(chapter, position, total):
+    """Content class of one chapter from its title, boilerplate phrases, length and position in the book."""
+    paras = [b["text"] for b in chapter.get("content", []) if b.get("type") == "paragraph"]
+    # a "Chapter N" made up for an untitled chapter says nothing about its content
+    title = "" if chapter.get("untitled") else chapter.get("title", "")
+    words = sum(len(p.split()) for p in paras)
+    front = position < max(3, total * 0.25)          # only the edges of the book can be matter
+    back  = position >= total - max(3, total * 0.25)
+
+    if front and (FRONT_TITLE_RE.search(title) or _looks_like_listing(paras)):
+        return "front_matter"
+    if back and (BACK_TITLE_RE.search(title) or _looks_like_listing(paras)):
+        return "back_matter"
+    if (front or back) and words < NARRATIVE_MIN_WORDS * 4 and len(BOILERPLATE_RE.findall(" ".join(paras))) >= 2:
+        return "front_matter" if front and (not back or position < total / 2) else "back_matter"
+    if (front or back) and words < NARRATIVE_MIN_WORDS and not re.match(r"^(chapter|prologue|part)\b", title, re.I):
+        return "front_matter" if position < total / 2 else "back_matter"
+    return "narrative"
+
+def tag_content_classes(book_json):
+    """Adds content_class to every chapter; if nothing looks narrative, everything is kept."""
+    chapters = book_json["chapters"]
+    classes  = [classify_chapter(c, i, len(chapters)) for i, c in enumerate(chapters)]
+    if "narrative" not in classes:
+        classes = ["narrative"] * len(chapters)
+    for chapter, cls in zip(chapters, classes):
+        chapter["content_class"] = cls
+        chapter.pop("untitled", None)
+    skipped = [c["title"] for c in chapters if c["content_class"] != "narrative"]
+    logger.info(f"Content classes for {book_json['book_id']}: {len(chapters) - len(skipped)} narrative, skipped {skipped}")
+    return book_json
 
-def normalize_book(path, book_id, user_id, ext):
+def build_chapter_index(book_json):
+    """
+    Per-chapter lookup table stored with the book: title, content class, PDF page range,
+    and [char_start, char_end) in the joined narrative paragraph text the summarizers
+    slice, so a chapter can be located without walking every block.
+    """
+    index, offset = [], 0
+    for chap in book_json["chapters"]:
+        length = sum(len(b["text"].strip()) for b in chap["content"] if b.get("type") == "paragraph")
+        entry = {"id": chap["id"], "title": chap["title"], "content_class": chap.get("content_class", "narrative"),
+                 "blocks": len(chap["content"])}
+        if "pages" in chap:
+            entry["pages"] = chap["pages"]
+        if entry["content_class"] == "narrative":
+            entry["char_start"], entry["char_end"] = offset, offset + length
+            offset += length
+        index.append(entry)
+    book_json["chapter_index"] = index
+    return book_json
+
+def normalize_book(source, book_id, user_id, ext):
     ext = ext.lower()
     if ext == "epub":
-        return normalize_epub(path, book_id, user_id)
+        return build_chapter_index(tag_content_classes(normalize_epub(source, book_id, user_id)))
     if ext == "pdf":
-        return normalize_pdf(path,  book_id, user_id)
+        return build_chapter_index(tag_content_classes(normalize_pdf(source, book_id, user_id)))
     # ➜ For MOBI you usually convert to EPUB first (KindleUnpack / Calibre).  Raise for now.
     raise ValueError(f"Unsupported file type: {ext}")
 
 # ---------- Lambda entry ----------
-def lambda_handler(event, _ctx):
+def plan_upload(bucket, key, etag, issued_at, size=None):
+    """
+    Validates an uploaded key and claims it; returns the job dict, or None to skip.
+    `size` comes from the S3 event; without it the object is looked up with HEAD.
+    """
+    user_id, book_id = extract_user_and_book_id_from_key(key)
+    if not user_id:
+        logger.warning(f"Skip key outside books/{{user_id}}/{{book_id}}/: {key}")
+        return None
+
+    ext = key.rsplit(".", 1)[-1].lower()
+    if ext not in ("epub", "pdf"):
+        logger.warning(f"Skip unsupported file: {key}")
+        return None
+
+    cancelled_before, deleted = cancellations.state(user_id, book_id, fresh=True)
+    if deleted or issued_at < cancelled_before:
+        logger.info(f"Skip {key}: book was deleted or replaced after this upload")
+        return None
+    # A replaced book is a new version even if the same file is uploaded again:
+    # cleanupBook removes what the old one produced, so it must be redone
+    version = f"{etag}@{cancelled_before}" if cancelled_before else etag
+
+    if size is None:
+        size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    job = {"bucket": bucket, "key": key, "version": version, "ext": ext, "size": size,
+           "plan": plan_memory(size, ext),
+           "user_id": user_id, "book_id": book_id, "issued_at": issued_at,
+           "json_key": f"normalized/{user_id}/{book_id}/normalized.json"}
+
+    # Claimed last: nothing between the claim and process_uploads can raise
+    # and leave it IN_PROGRESS, which would make the redelivery a "duplicate"
+    if not work_claims.claim("normalize", book_id, version):
+        logger.info(f"Skip {key}: version {version} already normalized or in progress")
+        return None
+    return job
+
+def download_upload(job):
     """
-    Trigger source: SQS message whose body **either** is:
-      1. Raw S3 event (book just uploaded)  **or**
-      2. Our own JSON: {"s3_key": "...", "bucket": "...", "user_id": "...", "book_id": "..."}
+    Downloads the original file (runs on an IO thread): into memory for the
+    "memory" plan, else to /tmp. Returns the in-memory file or the path.
     """
-    print("Events", event)
-    for rec in event.get("Records", []):
-        print(rec)
-        logger.info(f"Processing record: {rec}")
+    if job["plan"] == "memory":
+        with metrics.timed("download", job["book_id"], ext=job["ext"], plan=job["plan"]) as span:
+            body = s3.get_object(Bucket=job["bucket"], Key=job["key"])["Body"].read()
+            span["bytes"] = len(body)
+        return io.BytesIO(body)
+
+    fd, path = tempfile.mkstemp(suffix="." + job["ext"])
+    os.close(fd)
+    try:
+        with metrics.timed("download", job["book_id"], ext=job["ext"], plan=job["plan"]) as span:
+            download_from_s3(job["bucket"], job["key"], path)
+            span["bytes"] = os.path.getsize(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+def store_normalized(job, book_json):
+    """Uploads the normalized JSON and schedules the book (runs on an IO thread)."""
+    upload = upload_json_file_to_s3 if job["plan"] == "stream" else upload_json_to_s3
+    with metrics.timed("upload", job["book_id"], plan=job["plan"]) as span:
+        normalized_bytes = span["bytes"] = upload(book_json, DEST_BUCKET, job["json_key"])
+    publish_progress(job["user_id"], job["book_id"], "NORMALIZED", title=book_json.get("title"),
+                     author=book_json.get("author"), chapters=len(book_json["chapters"]),
+                     issued_at=job["issued_at"])
+    # The summarizers read the normalized JSON, which lives in DEST_BUCKET
+    return next_event(job["user_id"], job["book_id"], job["json_key"], DEST_BUCKET,
+                      content_version=job["version"], issued_at=job["issued_at"],
+                      normalized_bytes=normalized_bytes)
+
+def process_uploads(jobs, io_pool):
+    """
+    Normalizes jobs in a pipeline: the next PREFETCH_DEPTH downloads run while
+    the current book is parsed on this thread, and each book's upload and
+    scheduling run in the background while the next one is parsed. Next-stage
+    events are sent with send_message_batch at the end.
+    Returns the set of job indexes that failed.
+    """
+    failed, cancelled = set(), set()
+    downloads, stores = {}, {}
+    next_download = 0
+
+    def top_up(current):
+        nonlocal next_download
+        while next_download < len(jobs) and next_download <= current + PREFETCH_DEPTH:
+            downloads[next_download] = io_pool.submit(download_upload, jobs[next_download])
+            next_download += 1
+
+    for i, job in enumerate(jobs):
+        top_up(i)
         try:
-            # S3 event forwarded by SQS
-            if rec.get("eventSource") == "aws:s3":
-                s3rec = rec.get("s3", None)
-                if s3rec:
-                    bucket = s3rec["bucket"]["name"]
-                    key = s3rec["object"]["key"]
-                user_id, book_id = extract_user_and_book_id_from_key(key)
-
-                ext = key.rsplit(".", 1)[-1].lower()
-                if ext not in ("epub", "pdf"):
-                    logger.warning(f"Skip unsupported file: {key}")
-                    continue
-
-                # --- download original file
-                with tempfile.NamedTemporaryFile(suffix="." + ext) as tmpin:
-                    download_from_s3(bucket, key, tmpin.name)
-                    print("Downloaded book name", tmpin.name)
-                    book_json = normalize_book(tmpin.name, book_id, user_id, ext)
-                    print("Epub book normalized", len(book_json))
-                # --- write JSON to /tmp and upload
-                with tempfile.NamedTemporaryFile(suffix=".json", mode="w", encoding="utf-8") as tmpout:
-                    json.dump(book_json, tmpout, ensure_ascii=False)
-                    tmpout.flush()
-                    json_key = f"normalized/{user_id}/{book_id}/normalized.json"
-                    print(tmpout.name, DEST_BUCKET, json_key)
-                    upload_to_s3(tmpout.name, DEST_BUCKET, json_key)
-                    print("Upload to S3 completed")
-
-                # --- Push event for next stage
-                send_next_event(user_id, book_id, json_key, bucket)
-                logger.info(f"✓ normalized {key} ➜ {json_key}")
-            
-            else:
+            source = downloads.pop(i).result()
+            try:
+                with metrics.timed("normalize", job["book_id"], ext=job["ext"], plan=job["plan"]) as span:
+                    book_json = normalize_book(source, job["book_id"], job["user_id"], job["ext"])
+                    span["chapters"] = len(book_json["chapters"])
+            finally:
+                if isinstance(source, str):
+                    os.remove(source)
+                source = None   # an in-memory file is freed before the next book is parsed
+            logger.info(f"Normalized {job['key']}: {len(book_json['chapters'])} chapters")
+            if cancellations.is_cancelled(job["user_id"], job["book_id"], job["issued_at"], fresh=True):
+                logger.info(f"Dropping {job['key']}: book was deleted or replaced while parsing")
+                cancelled.add(i)
                 continue
+            stores[i] = io_pool.submit(store_normalized, job, book_json)
+        except Exception as exc:
+            logger.exception(f"❌ Failed to normalize {job['key']}: {exc}")
+            failed.add(i)
 
+    ready = []   # (job index, payload) to send now
+    for i, future in stores.items():
+        try:
+            payload = future.result()
+            if payload:
+                ready.append((i, payload))
+        except Exception as exc:
+            logger.exception(f"❌ Failed to store {jobs[i]['key']}: {exc}")
+            failed.add(i)
+
+    for n in send_next_events([payload for _, payload in ready]):
+        i, payload = ready[n]
+        failed.add(i)
+        if payload.get("job_id"):
+            unschedule_book(payload)
+
+    for i, job in enumerate(jobs):
+        if i in failed:
+            work_claims.release("normalize", job["book_id"], job["version"])
+        elif i in stores:
+            work_claims.complete("normalize", job["book_id"], job["version"])
+            logger.info(f"✓ normalized {job['key']} ➜ {job['json_key']}")
+        elif i in cancelled:
+            work_claims.complete("normalize", job["book_id"], job["version"])   # a redelivery has nothing to do either
+    return failed
+
+def _s3_records(rec):
+    """S3 records carried by a Lambda record: direct S3 notification or S3 event forwarded by SQS."""
+    if rec.get("eventSource") == "aws:s3":
+        return [rec]
+    if rec.get("eventSource") == "aws:sqs":
+        body = json.loads(rec.get("body") or "{}")
+        return [r for r in body.get("Records", []) if r.get("eventSource") == "aws:s3"]
+    return []
+
+def _event_time_ms(s3rec):
+    """Upload time of an S3 record in epoch ms (now if the record has none)."""
+    try:
+        return int(datetime.fromisoformat(s3rec["eventTime"].replace("Z", "+00:00")).timestamp() * 1000)
+    except (KeyError, ValueError):
+        return int(time.time() * 1000)
+
+@metrics.memory_profiled(MEMORY_LIMIT_MB, MEMORY_TRACE_SAMPLE_RATE)
+def lambda_handler(event, _ctx):
+    """
+    Trigger source: S3 upload notifications, delivered directly or through SQS.
+    All books of the batch go through one pipeline (see process_uploads), so
+    throughput grows with the SQS batch size. With SQS, only the messageIds
+    that failed are returned in batchItemFailures (ReportBatchItemFailures),
+    so successful books in the batch are not redone.
+    """
+    logger.info(f"Received {len(event.get('Records', []))} records")
+    failed_records = set()
+    jobs, job_records = [], []   # job_records[i] = index of the Lambda record job i came from
+    for r, rec in enumerate(event.get("Records", [])):
+        try:
+            for s3rec in _s3_records(rec):
+                obj = s3rec["s3"]["object"]
+                # eTag identifies the uploaded content; a re-upload of the same file is a
+                # duplicate, unless the book was replaced since (see plan_upload)
+                job = plan_upload(s3rec["s3"]["bucket"]["name"], unquote_plus(obj["key"]),
+                                  obj.get("eTag") or obj.get("sequencer"), _event_time_ms(s3rec),
+                                  size=obj.get("size"))
+                if job:
+                    jobs.append(job)
+                    job_records.append(r)
         except Exception as exc:
-            logger.exception(f"❌ Failed record: {exc}")
+            logger.exception(f"❌ Failed record: {exc}")
+            failed_records.add(r)
+
+    try:
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as io_pool:
+            failed_jobs = process_uploads(jobs, io_pool)
+    except Exception:
+        # Only claims still IN_PROGRESS are dropped; finished books stay COMPLETED
+        for job in jobs:
+            work_claims.release("normalize", job["book_id"], job["version"])
+        raise
+    failed_records.update(job_records[i] for i in failed_jobs)
 
-    return {"status": "ok", "uploaded_book": json_key}
+    records = event.get("Records", [])
+    if any(not records[r].get("messageId") for r in failed_records):
+        # Direct S3 invocations are async: raising lets Lambda retry the event
+        raise RuntimeError("Failed to normalize one or more uploaded books")
+    return {"status": "ok",
+            "normalized": len(jobs) - len(failed_jobs),
+            "batchItemFailures": [{"itemIdentifier": records[r]["messageId"]} for r in sorted(failed_records)]}
@@ -0,0 +1,184 @@
+import json
+import os
+import time
+import boto3
+import logging
+from collections import OrderedDict
+from typing import List, Dict
+from lazy_resource import LazyResource
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Constants
+USER_BOOKS_TABLE_NAME = os.getenv("USER_BOOKS_TABLE_NAME", "user_books")
+REGION = os.getenv("AWS_REGION", "us-east-1")
+# Progress is stored in whole steps of this many percent; a page turn that stays
+# inside the stored step is acknowledged without a write
+PROGRESS_STEP_PERCENT = int(os.getenv("PROGRESS_STEP_PERCENT", "1"))
+# Most updates accepted in one request (an offline client flushing its queue)
+MAX_BATCH_UPDATES = 100
+# Books whose last written progress is remembered by a warm container, and for how
+# long. Short, because a rewind handled by another container makes the entry too high
+# and forward updates below it would be dropped until it expires.
+PROGRESS_CACHE_SIZE = int(os.getenv("PROGRESS_CACHE_SIZE", "2048"))
+PROGRESS_CACHE_TTL_SECONDS = float(os.getenv("PROGRESS_CACHE_TTL_SECONDS", "5"))
+
+
+# AWS Clients
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+user_books_table = LazyResource(lambda: dynamodb.Table(USER_BOOKS_TABLE_NAME))
+
+# (user_id, book_id) -> (last progress step this container wrote or saw stored, when).
+# Only used to skip writes; the conditional update stays the source of truth.
+_PROGRESS_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+
+def _remembered(user_id: str, book_id: str):
+    """The cached step for the book, or None if there is none or it has expired."""
+    entry = _PROGRESS_CACHE.get((user_id, book_id))
+    if entry is None:
+        return None
+    step, cached_at = entry
+    if time.monotonic() - cached_at > PROGRESS_CACHE_TTL_SECONDS:
+        del _PROGRESS_CACHE[(user_id, book_id)]
+        return None
+    return step
+
+
+def _remember(user_id: str, book_id: str, step: int):
+    _PROGRESS_CACHE[(user_id, book_id)] = (step, time.monotonic())
+    _PROGRESS_CACHE.move_to_end((user_id, book_id))
+    while len(_PROGRESS_CACHE) > PROGRESS_CACHE_SIZE:
+        _PROGRESS_CACHE.popitem(last=False)
+
+
+def _to_step(percentage) -> int:
+    """Floors a 0-100 percentage to the stored step."""
+    value = float(percentage)
+    if not 0 <= value <= 100:
+        raise ValueError("percentage must be between 0 and 100")
+    return int(value // PROGRESS_STEP_PERCENT) * PROGRESS_STEP_PERCENT
+
+
+def coalesce_updates(updates: List[dict]) -> Dict[str, dict]:
+    """
+    Collapses a batch to one update per book. Forward progress keeps the
+    furthest position; an explicit rewind keeps the most recent one.
+    """
+    per_book: Dict[str, dict] = {}
+    for update in updates:
+        book_id = update.get("book_id")
+        if not book_id:
+            raise ValueError("every update needs a book_id")
+        candidate = {
+            "step": _to_step(update.get("percentage")),
+            "updated_at": int(update.get("updated_at") or time.time() * 1000),
+            "rewind": bool(update.get("rewind")),
+        }
+        current = per_book.get(book_id)
+        if current is None:
+            per_book[book_id] = candidate
+        elif candidate["rewind"] or current["rewind"]:
+            if candidate["updated_at"] >= current["updated_at"]:
+                per_book[book_id] = candidate
+        elif candidate["step"] > current["step"]:
+            per_book[book_id] = {**candidate, "updated_at": max(candidate["updated_at"], current["updated_at"])}
+    return per_book
+
+
+def apply_progress(user_id: str, book_id: str, step: int, updated_at: int, rewind: bool = False) -> str:
+    """
+    Writes one book's progress if it moves the stored value. Returns
+    "updated", "unchanged" (nothing to write) or "not_found".
+    Forward updates only ever raise current_reading_percentage, so late or
+    out-of-order updates cannot move a reader backwards; a rewind (re-reading)
+    instead wins only if it is newer than the last write.
+    """
+    cached = _remembered(user_id, book_id)
+    if not rewind and cached is not None and step <= cached:
+        return "unchanged"
+
+    if rewind:
+        condition = ("attribute_exists(book_id) AND "
+                     "(attribute_not_exists(progress_updated_at) OR progress_updated_at < :t)")
+    else:
+        condition = ("attribute_exists(book_id) AND "
+                     "(attribute_not_exists(current_reading_percentage) OR current_reading_percentage < :p)")
+    try:
+        user_books_table.update_item(
+            Key={"user_id": user_id, "book_id": book_id},
+            UpdateExpression="SET current_reading_percentage = :p, progress_updated_at = :t",
+            ConditionExpression=condition,
+            ExpressionAttributeValues={":p": step, ":t": updated_at},
+        )
+        _remember(user_id, book_id, step)
+        return "updated"
+    except user_books_table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+
+    # Either the book is not this user's, or the stored value is already ahead: find out which
+    item = user_books_table.get_item(
+        Key={"user_id": user_id, "book_id": book_id},
+        ProjectionExpression="current_reading_percentage",
+    ).get("Item")
+    if item is None:
+        return "not_found"
+    _remember(user_id, book_id, int(item.get("current_reading_percentage", 0)))
+    return "unchanged"
+
+
+def lambda_handler(event, context):
+    """
+    Records reading progress for one or more books.
+    Triggered by API Gateway PUT /books/progress.
+    Expects user_id in request headers and a JSON body that is either one update
+    {"book_id": "...", "percentage": 37.5} or a batch queued while offline
+    {"updates": [{"book_id": "...", "percentage": 37.5, "updated_at": <epoch ms>}, ...]}.
+    Add "rewind": true to move progress backwards (re-reading from the start).
+    """
+    logger.info(f"Received event: {json.dumps(event)}")
+
+    try:
+        headers = event.get('headers') or {}
+        user_id = headers.get('user-id') or headers.get('User-Id') or headers.get('user_id')
+        if not user_id:
+            logger.warning("Missing user_id in request headers.")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': 'Missing user_id in headers'})
+            }
+
+        try:
+            body = json.loads(event.get("body") or "{}")
+            updates = body.get("updates") if "updates" in body else [body]
+            if not isinstance(updates, list) or not updates or len(updates) > MAX_BATCH_UPDATES:
+                raise ValueError(f"expected 1 to {MAX_BATCH_UPDATES} updates")
+            per_book = coalesce_updates(updates)
+        except (json.JSONDecodeError, ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"Invalid progress update: {e}")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': f'Invalid progress update: {e}'})
+            }
+
+        results = {
+            book_id: apply_progress(user_id, book_id, u["step"], u["updated_at"], u["rewind"])
+            for book_id, u in per_book.items()
+        }
+        written = sum(1 for status in results.values() if status == "updated")
+        logger.info(f"Progress for user {user_id}: {len(updates)} updates, {len(per_book)} books, {written} writes.")
+
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'results': results})
+        }
+
+    except Exception as e:
+        logger.exception(f"An unexpected error occurred: {e}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'message': 'An unexpected error occurred'})
+        }
@@ -0,0 +1,66 @@
+import json
+import os
+import time
+import boto3
+import logging
+from boto3.dynamodb.conditions import Key
+from lazy_resource import LazyResource
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+REGION = os.getenv("AWS_REGION", "us-east-1")
+CONNECTIONS_TABLE_NAME = os.getenv("CONNECTIONS_TABLE_NAME", "websocket_connections")
+# Global secondary index on connection_id, used by $disconnect (which carries no user_id)
+CONNECTION_ID_INDEX = os.getenv("CONNECTION_ID_INDEX", "connection_id-index")
+# API Gateway closes idle WebSockets after two hours; rows expire (TTL) a little later
+CONNECTION_TTL_SECONDS = int(os.getenv("CONNECTION_TTL_SECONDS", str(3 * 3600)))
+
+
+dynamodb = LazyResource(lambda: boto3.resource("dynamodb", region_name=REGION))
+connections_table = LazyResource(lambda: dynamodb.Table(CONNECTIONS_TABLE_NAME))
+
+
+def lambda_handler(event, context):
+    """
+    Triggered by the $connect and $disconnect routes of the WebSocket API.
+    Clients connect with wss://.../{stage}?user_id={user_id} (browsers cannot
+    set headers on a WebSocket); bookProgressNotifier pushes processing
+    events for the user's books to every connection registered here.
+    """
+    request_context = event.get("requestContext", {})
+    route = request_context.get("routeKey")
+    connection_id = request_context.get("connectionId")
+    logger.info(f"WebSocket {route} for connection {connection_id}.")
+
+    try:
+        if route == "$connect":
+            query_string_parameters = event.get("queryStringParameters") or {}
+            headers = event.get("headers") or {}
+            user_id = query_string_parameters.get("user_id") or headers.get("user-id")
+            if not user_id:
+                logger.warning("Missing user_id on WebSocket connect.")
+                return {'statusCode': 400, 'body': json.dumps({'message': 'Missing user_id'})}
+            now = int(time.time())
+            connections_table.put_item(Item={
+                "user_id": user_id,
+                "connection_id": connection_id,
+                "connected_at": now,
+                "expires_at": now + CONNECTION_TTL_SECONDS,
+            })
+            return {'statusCode': 200, 'body': json.dumps({'message': 'Connected'})}
+
+        if route == "$disconnect":
+            response = connections_table.query(
+                IndexName=CONNECTION_ID_INDEX,
+                KeyConditionExpression=Key("connection_id").eq(connection_id),
+            )
+            for item in response.get("Items", []):
+                connections_table.delete_item(Key={"user_id": item["user_id"], "connection_id": connection_id})
+            return {'statusCode': 200, 'body': json.dumps({'message': 'Disconnected'})}
+
+        return {'statusCode': 400, 'body': json.dumps({'message': f'Unsupported route {route}'})}
+
+    except Exception as e:
+        logger.exception(f"An unexpected error occurred: {e}")
+        return {'statusCode': 500, 'body': json.dumps({'message': 'An unexpected error occurred'})}
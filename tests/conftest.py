@@ -0,0 +1,36 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+LAMBDAS_DIR = os.path.join(ROOT, "src", "lambdas")
+
+# Handlers are loaded by path in the tests; the modules vendored next to them
+# (see tools/vendor_common.py) are imported from their source in src/common
+sys.path.insert(0, os.path.join(ROOT, "src", "common"))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """In-process S3, SQS and DynamoDB (tools/fake_aws.py) behind boto3.client/boto3.resource."""
+    pytest.importorskip("boto3")
+    from fake_aws import FakeAWS
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    fake = FakeAWS().install()
+    yield fake
+    fake.uninstall()
+
+
+@pytest.fixture(scope="session")
+def load_lambda():
+    """Imports a handler module afresh by path, e.g. load_lambda("cleanup_book")."""
+    def load(directory, module="app"):
+        path = os.path.join(LAMBDAS_DIR, directory, f"{module}.py")
+        spec = importlib.util.spec_from_file_location(f"{directory}_{module}", path)
+        handler = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(handler)
+        return handler
+    return load
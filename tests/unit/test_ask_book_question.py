@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def app(aws, load_lambda, monkeypatch):
+    monkeypatch.setenv("QA_CHUNK_CHARS", "60")
+    return load_lambda("ask_book_question")
+
+
+def _book(*chapters, content_class="narrative"):
+    return {"chapters": [{"id": i, "title": f"Chapter {i}", "content_class": content_class,
+                          "content": [{"type": "paragraph", "text": text} for text in paragraphs]}
+                         for i, paragraphs in enumerate(chapters, start=1)]}
+
+
+def test_chunks_follow_paragraphs_and_never_span_chapters(app):
+    chunks = app._build_chunks(_book(["a" * 40, "b" * 40, "c" * 10], ["d" * 10]))
+    assert [(c["chapter_id"], c["end_offset"]) for c in chunks] == [(1, 40), (1, 90), (2, 100)]
+
+
+def test_front_and_back_matter_is_not_indexed(app):
+    book = _book(["Copyright and contents."])
+    book["chapters"][0]["content_class"] = "front_matter"
+    assert app._build_chunks(book) == []
+
+
+def test_bm25_ranks_the_matching_chunk_first_and_returns_reading_order(app):
+    index = app._build_index(app._build_chunks(_book(
+        ["The lighthouse keeper lit the lamp."],
+        ["A storm wrecked the fishing boat."],
+        ["The keeper rowed out to the boat."],
+    )))
+    assert app._bm25_top_k(index, "Who is the keeper of the lighthouse?", 3, 1) == [0]
+    assert app._bm25_top_k(index, "What happened to the boat?", 3, 2) == [1, 2]
+    assert app._bm25_top_k(index, "the and of", 3, 2) == []  # stopwords only
+
+
+def test_bm25_never_scores_chunks_past_the_readers_position(app):
+    index = app._build_index(app._build_chunks(_book(
+        ["The garden was quiet."],
+        ["The murderer was the gardener."],
+    )))
+    assert app._bm25_top_k(index, "who was the murderer", 1, 3) == []
+    assert app._bm25_top_k(index, "who was the murderer", 2, 3) == [1]
+
+
+def test_index_is_rebuilt_when_the_book_is_replaced(app):
+    def upload(text, issued_at):
+        app.s3.put_object(Bucket=app.NORMALIZED_BUCKET, Key="normalized/u/b/normalized.json",
+                          Body=json.dumps(_book([text])).encode())
+        app.summaries_table.put_item(Item={"book_id": "b", "progress": 0, "issued_at": issued_at})
+
+    upload("First edition.", 1)
+    first = app.get_book_index("u", "b")
+    assert app.get_book_index("u", "b") is first
+
+    upload("Second edition.", 2)
+    assert app.get_book_index("u", "b")["chunks"][0]["text"] == "Second edition."
@@ -0,0 +1,40 @@
+import pytest
+
+
+@pytest.fixture
+def app(aws, load_lambda):
+    return load_lambda("cleanup_book")
+
+
+def _put_rows(app, *created_at):
+    for progress, seconds in enumerate(created_at, start=1):
+        app.summaries_table.put_item(Item={"book_id": "b", "progress": progress, "createdAt": seconds})
+
+
+def _remaining(app):
+    return [int(item["progress"]) for item in app.summaries_table.query(
+        KeyConditionExpression="book_id = :b", ExpressionAttributeValues={":b": "b"})["Items"]]
+
+
+def test_replacement_keeps_rows_written_in_the_cancellations_second(app):
+    # cancelled_before is epoch ms, createdAt whole seconds
+    _put_rows(app, 999, 1_000, 1_001)
+    app.cleanup({"user_id": "u", "book_id": "b", "cancelled_before": 1_000_500, "delete": False})
+    assert _remaining(app) == [2, 3]
+
+
+def test_deletion_removes_rows_written_in_the_cancellations_second(app):
+    _put_rows(app, 999, 1_000, 1_001)
+    app.cleanup({"user_id": "u", "book_id": "b", "cancelled_before": 1_000_500, "delete": True})
+    assert _remaining(app) == [3]
+
+
+def test_deletion_removes_the_user_books_row_only_if_still_deleted(app):
+    app.user_books_table.put_item(Item={"user_id": "u", "book_id": "b", "processing_status": "DELETED",
+                                        "cancelled_before": 1_000_500})
+    app.user_books_table.put_item(Item={"user_id": "u", "book_id": "c", "processing_status": "UPLOADED",
+                                        "cancelled_before": 2_000_000})
+    for book_id in ("b", "c"):
+        app.cleanup({"user_id": "u", "book_id": book_id, "cancelled_before": 1_000_500, "delete": True})
+    assert "Item" not in app.user_books_table.get_item(Key={"user_id": "u", "book_id": "b"})
+    assert "Item" in app.user_books_table.get_item(Key={"user_id": "u", "book_id": "c"})
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "tools"))
+from measure_cold_start import HANDLERS, measure  # noqa: E402
+
+# The handlers need boto3 (and their own requirements) to import at all
+pytest.importorskip("boto3")
+
+RUNS = int(os.getenv("COLD_START_RUNS", "5"))
+
+
+@pytest.mark.parametrize("function", sorted(HANDLERS))
+def test_handler_imports_within_budget(function):
+    directory, module, budget = HANDLERS[function]
+    import_ms, slowest = measure(directory, module, RUNS, importtime=True)
+    imports = ", ".join(f"{name} {ms:.1f} ms" for ms, name in slowest)
+    assert import_ms <= budget, f"{function} imports in {import_ms:.1f} ms (budget {budget} ms): {imports}"
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def app(aws, load_lambda, monkeypatch):
+    monkeypatch.setenv("PER_USER_CONCURRENCY", "2")
+    return load_lambda("fair_dispatcher")
+
+
+def _queue(app, user_id, *job_ids):
+    for job_id in job_ids:
+        app.book_jobs.put_item(Item={"user_id": user_id, "job_id": job_id, "status": "QUEUED",
+                                     "payload": json.dumps({"book_id": job_id})})
+    app.user_scheduling.update_item(
+        Key={"user_id": user_id},
+        UpdateExpression="SET pending_flag = :y, last_served_at = if_not_exists(last_served_at, :zero) "
+                         "ADD pending :n",
+        ExpressionAttributeValues={":y": "Y", ":zero": 0, ":n": len(job_ids)},
+    )
+
+
+def _sent(aws):
+    return [json.loads(m["body"])["book_id"] for m in aws.sqs.receive("summarize-character-queue", 10)]
+
+
+def _scheduling(app, user_id):
+    return app.user_scheduling.get_item(Key={"user_id": user_id})["Item"]
+
+
+def test_dispatch_claims_a_slot_and_releases_the_oldest_job(aws, app):
+    _queue(app, "u", "1-old", "2-new")
+    assert app.dispatch_one("u")
+    assert _sent(aws) == ["1-old"]
+    assert app.book_jobs.get_item(Key={"user_id": "u", "job_id": "1-old"})["Item"]["status"] == "DISPATCHED"
+    state = _scheduling(app, "u")
+    assert (state["inflight"], state["pending"], state["pending_flag"]) == (1, 1, "Y")
+
+
+def test_dispatch_stops_at_the_users_concurrency_cap(aws, app):
+    _queue(app, "u", "1", "2", "3")
+    assert app.dispatch_one("u")
+    assert app.dispatch_one("u")
+    assert not app.dispatch_one("u")
+    assert len(_sent(aws)) == 2
+    assert _scheduling(app, "u")["inflight"] == 2
+
+
+def test_a_user_with_nothing_queued_gives_the_slot_back(app):
+    _queue(app, "u")
+    assert not app.dispatch_one("u")
+    state = _scheduling(app, "u")
+    assert state["inflight"] == 0
+    assert "pending_flag" not in state
+
+
+def test_handler_serves_users_round_robin(aws, app):
+    _queue(app, "bulk", "1", "2", "3", "4", "5")
+    _queue(app, "single", "9")
+    result = app.lambda_handler({}, None)
+    assert result["dispatched"] == 3  # two for the bulk import (its cap), one for the other user
+    assert sorted(_sent(aws)) == ["1", "2", "9"]
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from gemini_limits import CircuitBreaker, InMemoryTokenBucketStore, RateLimitedError, RateLimiter
+
+
+class FrozenClock:
+    """Stands in for time.time in gemini_limits, so refills only happen when a test moves it."""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FrozenClock()
+    monkeypatch.setattr("gemini_limits.time.time", clock)
+    return clock
+
+
+def test_acquire_spends_the_quota_then_turns_callers_away(clock):
+    limiter = RateLimiter(InMemoryTokenBucketStore(), {"flash": 3}, default_rps=1, max_wait_seconds=0)
+    for _ in range(3):
+        limiter.acquire("flash")
+    with pytest.raises(RateLimitedError):
+        limiter.acquire("flash")
+
+    clock.now += 1.0  # one second refills the bucket at the quota rate
+    for _ in range(3):
+        limiter.acquire("flash")
+
+
+def test_models_have_separate_buckets(clock):
+    limiter = RateLimiter(InMemoryTokenBucketStore(), {"flash": 1}, default_rps=2, max_wait_seconds=0)
+    limiter.acquire("flash")
+    limiter.acquire("pro")  # unlisted models get default_rps
+    limiter.acquire("pro")
+    with pytest.raises(RateLimitedError):
+        limiter.acquire("flash")
+
+
+def test_throttling_cuts_the_shared_rate_once_per_second(clock):
+    store = InMemoryTokenBucketStore()
+    limiter = RateLimiter(store, {"flash": 10}, default_rps=1, max_wait_seconds=0)
+    limiter.acquire("flash")
+    clock.now += 1.0
+    limiter.on_throttled("flash")
+    limiter.on_throttled("flash")  # same second: a burst of 429s counts once
+    assert store.load("gemini:flash")["rate"] == pytest.approx(7.0)
+
+    clock.now += RateLimiter.RATE_INCREASE_INTERVAL
+    limiter.acquire("flash")
+    assert store.load("gemini:flash")["rate"] == pytest.approx(8.0)
+
+
+def test_a_bucket_too_contended_to_update_counts_as_rate_limited(clock):
+    class AlwaysConflicting(InMemoryTokenBucketStore):
+        def compare_and_set(self, bucket_id, expected_version, state):
+            return False
+
+    limiter = RateLimiter(AlwaysConflicting(), {}, default_rps=5, max_wait_seconds=0)
+    with pytest.raises(RateLimitedError, match="contended"):
+        limiter.acquire("flash")
+
+
+def test_circuit_breaker_opens_after_consecutive_failures_only():
+    breaker = CircuitBreaker(threshold=3)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+    breaker.record_failure()
+    assert breaker.is_open
+    breaker.reset()
+    assert not breaker.is_open and breaker.consecutive_failures == 0
+
+
+def test_circuit_breaker_counts_failures_from_all_threads():
+    breaker = CircuitBreaker(threshold=1000)
+    threads = [threading.Thread(target=lambda: [breaker.record_failure() for _ in range(100)])
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert breaker.consecutive_failures == 800
@@ -0,0 +1,92 @@
+import base64
+import importlib.util
+import json
+import os
+from decimal import Decimal
+
+import boto3
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+from botocore.stub import ANY, Stubber
+
+LAMBDA_PATH = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                           "src", "lambdas", "get_user_books", "app.py")
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    spec = importlib.util.spec_from_file_location("get_user_books_app", LAMBDA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class SerializesTo:
+    """
+    Matches a parameter whose DynamoDB wire form is `expected`. The stubber sees
+    parameters before boto3 serializes them, and a float would compare equal to
+    the Decimal it should have been.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def __eq__(self, value):
+        serializer = TypeSerializer()
+        return {name: serializer.serialize(v) for name, v in value.items()} == self.expected
+
+    def __repr__(self):
+        return f"SerializesTo({self.expected!r})"
+
+
+def _event(**params):
+    return {"headers": {"user-id": "user-1"}, "queryStringParameters": params or None}
+
+
+def test_cursor_round_trips_last_evaluated_key_through_query(app):
+    # What DynamoDB returns for the upload-time index: the GSI key plus the table key.
+    # A function, as boto3 deserializes responses in place.
+    def wire_key():
+        return {"user_id": {"S": "user-1"}, "book_id": {"S": "book-2"}, "upload_timestamp": {"N": "1712345678901"}}
+    book = {"user_id": {"S": "user-1"}, "book_id": {"S": "book-2"}, "upload_timestamp": {"N": "1712345678901"},
+            "processing_status": {"S": "READY"}}
+
+    with Stubber(app.user_books_table.meta.client) as stubber:
+        stubber.add_response("query", {"Items": [book], "Count": 1, "LastEvaluatedKey": wire_key()})
+        first = app.lambda_handler(_event(limit="1"), None)
+        cursor = first["headers"]["X-Next-Cursor"]
+
+        # Page 2 must send back exactly the key page 1 ended at
+        expected = {"TableName": ANY, "IndexName": ANY, "KeyConditionExpression": ANY, "FilterExpression": ANY,
+                    "ProjectionExpression": ANY, "ExpressionAttributeNames": ANY,
+                    "ScanIndexForward": False, "Limit": 1, "ExclusiveStartKey": SerializesTo(wire_key())}
+        stubber.add_response("query", {"Items": [], "Count": 0}, expected)
+        second = app.lambda_handler(_event(limit="1", cursor=cursor), None)
+
+    assert first["statusCode"] == 200
+    assert second["statusCode"] == 200, second["body"]
+    assert json.loads(second["body"]) == []
+    assert "X-Next-Cursor" not in second["headers"]
+    stubber.assert_no_pending_responses()
+
+
+def test_decoded_cursor_keeps_numbers_exact(app):
+    key = {"user_id": "user-1", "book_id": "book-2", "upload_timestamp": Decimal("1712345678901")}
+    decoded = app.decode_cursor(app.encode_cursor(key), "user-1")
+    assert decoded == key
+    assert isinstance(decoded["upload_timestamp"], Decimal)
+
+
+@pytest.mark.parametrize("cursor_user, raw", [
+    ("user-2", None),  # another user's cursor
+    ("user-1", b'{"user_id": "user-1"}'),  # untyped key
+])
+def test_foreign_or_malformed_cursor_is_rejected(app, cursor_user, raw):
+    cursor = (base64.urlsafe_b64encode(raw).decode() if raw
+              else app.encode_cursor({"user_id": "user-1", "book_id": "b", "upload_timestamp": Decimal(1)}))
+    response = app.lambda_handler({"headers": {"user-id": cursor_user},
+                                   "queryStringParameters": {"cursor": cursor}}, None)
+    assert response["statusCode"] == 400
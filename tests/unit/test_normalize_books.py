@@ -0,0 +1,115 @@
+import io
+import zipfile
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def app(load_lambda):
+    pytest.importorskip("boto3")
+    return load_lambda("normalize_books", "normalize_lambda")
+
+
+def _parse(app, html):
+    parser = app.EpubBlockParser()
+    parser.feed(html)
+    parser.close()
+    return parser
+
+
+# ---------- EPUB ----------
+
+def test_epub_parser_takes_the_first_heading_as_title_and_keeps_later_ones(app):
+    parser = _parse(app, "<html><head><title>File title</title><style>p {}</style></head><body>"
+                         "<h1>Chapter One</h1><p>It was a  dark\nnight.</p><h2>Later that night</h2>"
+                         "<p>Line<br/>break</p><img src='a.jpg'/><script>skip()</script></body></html>")
+    assert (parser.title, parser.heading) == ("File title", "Chapter One")
+    assert [b.get("text", b["type"]) for b in parser.blocks] == [
+        "It was a dark night.", "Later that night", "Line break", "image"]
+    assert parser.blocks[1]["heading"] is True
+
+
+def _epub(spine_docs):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("META-INF/container.xml",
+                    '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                    '<rootfile full-path="OEBPS/content.opf"/></rootfiles></container>')
+        items = "".join(f'<item id="{name}" href="{name}.xhtml" media-type="application/xhtml+xml"/>'
+                        for name, _, _ in spine_docs)
+        refs = "".join(f'<itemref idref="{name}"{"" if linear else " linear=%22no%22"}/>'.replace("%22", '"')
+                       for name, linear, _ in spine_docs)
+        zf.writestr("OEBPS/content.opf",
+                    '<package xmlns="http://www.idpf.org/2007/opf" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                    '<metadata><dc:title>The Book</dc:title><dc:creator>A. Writer</dc:creator></metadata>'
+                    f"<manifest>{items}</manifest><spine>{refs}</spine></package>")
+        for name, _, body in spine_docs:
+            zf.writestr(f"OEBPS/{name}.xhtml", f"<html><body>{body}</body></html>")
+    buffer.seek(0)
+    return buffer
+
+
+def test_normalize_epub_follows_the_linear_spine(app):
+    book = app.normalize_epub(_epub([
+        ("one", True, "<h1>One</h1><p>First.</p>"),
+        ("notes", False, "<h1>Notes</h1><p>Skipped.</p>"),
+        ("empty", True, ""),
+        ("two", True, "<p>Untitled text.</p>"),
+    ]), "b", "u")
+    assert (book["title"], book["author"]) == ("The Book", "A. Writer")
+    assert [(c["id"], c["title"], c.get("untitled", False)) for c in book["chapters"]] == [
+        (1, "One", False), (2, "Chapter 2", True)]
+
+
+# ---------- PDF cleanup ----------
+
+def test_running_headers_and_page_numbers_are_dropped(app):
+    bodies = ["It was late.", "She left.", "Rain fell.", "He waited.", "Dawn came.", "The end."]
+    pages = [["The Novel", body, body.upper(), "", str(i)] for i, body in enumerate(bodies, start=1)]
+    running = app.find_running_lines(pages)
+    words = app.document_words(pages)
+    assert app.clean_page_text(pages[2], running, words).strip() == "Rain fell.\nRAIN FELL."
+
+
+def test_only_lower_case_or_repeated_roman_numerals_are_page_numbers(app):
+    body = ["Some text.", "More text.", "Even more."]
+    pages = [["xii"] + body, ["XIV"] + body, body + ["IV"], body + ["V"]]
+    edges = app.roman_page_edges(pages)
+    words = app.document_words(pages)
+    cleaned = [app.clean_page_text(lines, set(), words, page_edges) for lines, page_edges in zip(pages, edges)]
+    assert cleaned == ["\n".join(body), "\n".join(["XIV"] + body), "\n".join(body), "\n".join(body)]
+
+
+def test_hyphen_breaks_join_words_but_keep_compounds(app):
+    words = app.document_words([["a well known fact", "the interesting part"]])
+    text = "an inter-\nesting and well-\nknown fact, Anglo-\nSaxon, end-\n\nnext"
+    assert app.clean_page_text(text.split("\n"), set(), words) == \
+        "an interesting and well-known fact, Anglo-\nSaxon, end-\n\nnext"
+
+
+# ---------- chapter classes ----------
+
+def _chapter(title, text, untitled=False):
+    chapter = {"title": title, "content": [{"type": "paragraph", "text": text}]}
+    if untitled:
+        chapter["untitled"] = True
+    return chapter
+
+
+@pytest.mark.parametrize("title, text, position, expected", [
+    ("Contents", "Chapter 1", 0, "front_matter"),
+    ("Copyright", "© 2020 All rights reserved. ISBN 123", 1, "front_matter"),
+    ("Acknowledgements", "Thanks to everyone. " * 50, 9, "back_matter"),
+    ("Notes from Underground", "I am a sick man. " * 100, 0, "narrative"),
+    ("Chapter 7", "Short.", 5, "narrative"),  # the middle of the book is never matter
+    ("Chapter 10", "Short.", 9, "narrative"),
+    ("Chapter 1", "Short.", 0, "front_matter"),  # untitled: the made-up title is no evidence
+])
+def test_classify_chapter(app, title, text, position, expected):
+    chapter = _chapter(title, text, untitled=title == "Chapter 1")
+    assert app.classify_chapter(chapter, position, total=10) == expected
+
+
+def test_a_book_with_no_narrative_chapter_keeps_everything(app):
+    book = {"book_id": "b", "chapters": [_chapter("Index", "a 1"), _chapter("Notes", "b 2")]}
+    assert [c["content_class"] for c in app.tag_content_classes(book)["chapters"]] == ["narrative"] * 2
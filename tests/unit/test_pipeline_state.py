@@ -0,0 +1,50 @@
+import pytest
+
+from pipeline_state import CancellationChecks, WorkClaims
+
+
+@pytest.fixture
+def user_books(aws):
+    return aws.dynamodb.Table("user_books")
+
+
+def test_a_version_uploaded_before_the_replacement_is_cancelled(user_books):
+    user_books.put_item(Item={"user_id": "u", "book_id": "b", "processing_status": "UPLOADED",
+                              "cancelled_before": 2_000})
+    checks = CancellationChecks(user_books, ttl_seconds=60)
+    assert checks.is_cancelled("u", "b", issued_at=1_999)
+    assert not checks.is_cancelled("u", "b", issued_at=2_000)
+    assert not checks.is_cancelled("u", "other", issued_at=1)
+
+
+def test_a_deleted_book_is_cancelled_whatever_its_version(user_books):
+    user_books.put_item(Item={"user_id": "u", "book_id": "b", "processing_status": "DELETED"})
+    assert CancellationChecks(user_books, ttl_seconds=60).is_cancelled("u", "b", issued_at=10**13)
+
+
+def test_cancellation_is_cached_until_a_fresh_check(user_books):
+    checks = CancellationChecks(user_books, ttl_seconds=60)
+    assert not checks.is_cancelled("u", "b", issued_at=1_000)
+    user_books.put_item(Item={"user_id": "u", "book_id": "b", "cancelled_before": 5_000})
+    assert not checks.is_cancelled("u", "b", issued_at=1_000)
+    # Right before saving, callers skip the cached answer
+    assert checks.is_cancelled("u", "b", issued_at=1_000, fresh=True)
+
+
+def test_work_claim_is_taken_once_and_released_for_a_retry(aws):
+    claims = WorkClaims(aws.dynamodb.Table("pipeline_idempotency"), lease_seconds=900, ttl_seconds=3600)
+    assert claims.claim("summaries", "b", "v1")
+    assert not claims.claim("summaries", "b", "v1")
+    assert claims.claim("summaries", "b", "v2")  # a new version is new work
+
+    claims.release("summaries", "b", "v1")
+    assert claims.claim("summaries", "b", "v1")
+    claims.complete("summaries", "b", "v1")
+    claims.release("summaries", "b", "v1")  # a completed claim stays
+    assert not claims.claim("summaries", "b", "v1")
+
+
+def test_an_expired_lease_can_be_retaken(aws):
+    claims = WorkClaims(aws.dynamodb.Table("pipeline_idempotency"), lease_seconds=-1, ttl_seconds=3600)
+    assert claims.claim("characters", "b", "v1")
+    assert claims.claim("characters", "b", "v1")
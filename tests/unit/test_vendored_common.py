@@ -0,0 +1,15 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "tools"))
+from vendor_common import plan, stale_copies  # noqa: E402
+
+
+def test_every_lambda_carries_current_copies_of_the_modules_it_imports():
+    assert stale_copies() == [], "run python tools/vendor_common.py"
+
+
+def test_plan_covers_the_lambdas_that_import_shared_modules():
+    vendored = {os.path.basename(directory): names for directory, names in plan().items()}
+    assert "lazy_resource" in vendored["get_summary_by_progress"]
+    assert "lazy_resource" in vendored["normalize_books"]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+One-off backfill of `status_uploaded` on user_books rows created before the
+status index existed, so they show up in getUserBooks ?status=... queries.
+
+    python tools/backfill_user_books_status.py --table user_books [--dry-run]
+
+Rows without upload_timestamp are given 0, which sorts them as the oldest.
+"""
+
+import argparse
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+
+def status_key(item):
+    return f"{item.get('processing_status') or 'UPLOADED'}#{int(item.get('upload_timestamp') or 0):012d}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill status_uploaded on user_books")
+    parser.add_argument("--table", default="user_books")
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    table = boto3.resource("dynamodb", region_name=args.region).Table(args.table)
+    kwargs = {
+        "FilterExpression": Attr("status_uploaded").not_exists(),
+        "ProjectionExpression": "user_id, book_id, processing_status, upload_timestamp",
+    }
+    updated = 0
+    while True:
+        page = table.scan(**kwargs)
+        for item in page.get("Items", []):
+            key = status_key(item)
+            if not args.dry_run:
+                table.update_item(
+                    Key={"user_id": item["user_id"], "book_id": item["book_id"]},
+                    UpdateExpression="SET status_uploaded = :k, upload_timestamp = if_not_exists(upload_timestamp, :zero)",
+                    ExpressionAttributeValues={":k": key, ":zero": 0},
+                )
+            updated += 1
+        if "LastEvaluatedKey" not in page:
+            break
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    print(f"{'Would update' if args.dry_run else 'Updated'} {updated} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,751 @@
+#!/usr/bin/env python3
+"""
+End-to-end load benchmark of the book pipeline, run in one process.
+
+Synthetic EPUB and PDF books are uploaded through generatePresignedUploadUrl
+and go through the real handlers: normalize-books, both summarizers,
+fairDispatcher and bookProgressNotifier, wired together by the SQS event
+sources they have when deployed. A book is done when bookProgressNotifier
+marks it READY. The read lambdas (getBookSummary, getBookCharacters,
+getUserBooks, askBookQuestion) are then called against the processed books.
+S3, SQS, DynamoDB and Lambda are in-process fakes (tools/fake_aws.py) and
+Gemini is tools/fake_gemini_server.py, with configurable latency and 429s.
+
+    python tools/benchmark_pipeline.py                      # 12 books, 4 users
+    python tools/benchmark_pipeline.py --books 40 --users 8 --words 60000 --pdf-share 0.25 \\
+        --gemini-latency-ms 800 --gemini-jitter-ms 400 --gemini-429-rate 0.05 --save baseline.json
+    python tools/benchmark_pipeline.py ... --baseline baseline.json    # compare a change with it
+
+Reports books per minute, upload-to-READY latency, per-stage latency (from
+the EMF lines the handlers print), invocations and queue waits per function,
+read latency, Gemini calls and tokens, and AWS API calls. Each function runs
+in up to --concurrency containers; every container loads its own copy of the
+handler module, so module state is per container as on Lambda.
+
+Run it in an environment with the functions' requirements installed (boto3,
+requests, PyMuPDF for PDF books). Memory metrics are process-wide here, and
+SQS delays and visibility timeouts are scaled by --delay-scale.
+"""
+
+import argparse
+import collections
+import importlib.util
+import io
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import textwrap
+import threading
+import time
+import uuid
+import zipfile
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_aws import FakeAWS  # noqa: E402
+from fake_gemini_server import start_server  # noqa: E402
+from measure_cold_start import HANDLERS, LAMBDAS_DIR  # noqa: E402
+from vendor_common import COMMON_DIR  # noqa: E402
+
+# Handlers are loaded by path, so the modules vendored next to them come from src/common
+sys.path.insert(0, COMMON_DIR)
+
+UPLOAD_BUCKET = "book-processing-uploads"
+# SQS event sources: queue -> [(function, batch size)]. A queue with several
+# consumers delivers every message to each of them, like the deployed fan-out.
+EVENT_SOURCES = {
+    "book-processing-queue": [("normalize-books", 10)],
+    "summarize-character-queue": [("bookSummaryLambda", 4), ("characterSummaryLambda", 4)],
+    "summary-priority-queue": [("bookSummaryLambda", 4)],
+    "summary-on-demand-queue": [("bookSummaryLambda", 4)],
+    "character-retry-queue": [("characterSummaryLambda", 4)],
+    "book-progress-events-queue": [("bookProgressNotifier", 10)],
+    "book-cleanup-queue": [("cleanupBook", 10)],
+}
+# Function -> (timeout in seconds, default concurrency)
+FUNCTION_LIMITS = {
+    "generatePresignedUploadUrl": (29, 4),
+    "normalize-books": (300, 2),
+    "bookSummaryLambda": (900, 4),
+    "characterSummaryLambda": (900, 4),
+    "fairDispatcher": (60, 1),
+    "bookProgressNotifier": (60, 2),
+    "cleanupBook": (300, 1),
+    "getBookSummary": (29, 8),
+    "getBookCharacters": (29, 8),
+    "getUserBooks": (29, 8),
+    "askBookQuestion": (29, 8),
+}
+# Share of reads going to each read function
+READ_MIX = {"getBookSummary": 0.5, "getBookCharacters": 0.25, "getUserBooks": 0.15, "askBookQuestion": 0.1}
+QUESTIONS = ["Who is {name}?", "What happened to {name} so far?", "Why did {name} leave the city?",
+             "Where are {name} and the others going?"]
+
+NAMES = ["Ada", "Bram", "Cora", "Dmitri", "Elena", "Farid", "Greta", "Hugo", "Iris", "Jonah", "Kira", "Lucan"]
+VOCAB = ("the a of and to in was had with for on at by from that this their his her its they she he it "
+         "river city house road night morning letter window door garden market bridge tower field storm "
+         "silver old quiet long cold bright dark small hidden broken distant careful sudden "
+         "walked waited watched turned spoke listened remembered found carried opened closed followed "
+         "slowly again never always almost nearly still already together alone").split()
+
+
+# ---------- synthetic books ----------
+def _sentence(rng, cast):
+    words = [rng.choice(VOCAB) for _ in range(rng.randint(8, 18))]
+    if rng.random() < 0.6:
+        words.insert(rng.randrange(len(words)), rng.choice(cast))
+    return " ".join(words).capitalize() + "."
+
+
+def synthetic_book(rng, index, words, chapters):
+    """(title, author, [(chapter title, [paragraph])]) of about `words` words, with front and back matter."""
+    cast = rng.sample(NAMES, 5)
+    title, author = f"Benchmark Book {index}", f"{rng.choice(NAMES)} Synthetic"
+    body = [("Copyright", [f"Copyright © 2024 {author}. All rights reserved.",
+                           f"ISBN 978-0-00-{index:06d}-0. First published in 2024."])]
+    per_chapter = max(1, words // chapters)
+    for n in range(1, chapters + 1):
+        paragraphs, count = [], 0
+        while count < per_chapter:
+            paragraph = " ".join(_sentence(rng, cast) for _ in range(rng.randint(4, 8)))
+            paragraphs.append(paragraph)
+            count += len(paragraph.split())
+        body.append((f"Chapter {n}", paragraphs))
+    body.append(("Acknowledgements", [f"Thanks to {', '.join(cast[:3])} for their patience."]))
+    return title, author, body
+
+
+CONTAINER_XML = ('<?xml version="1.0"?><container version="1.0" '
+                 'xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                 '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                 '</rootfiles></container>')
+
+
+def make_epub(title, author, chapters):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", CONTAINER_XML)
+        manifest, spine = [], []
+        for n, (chapter_title, paragraphs) in enumerate(chapters, 1):
+            body = "".join(f"<p>{escape(p)}</p>" for p in paragraphs)
+            zf.writestr(f"OEBPS/ch{n:03d}.xhtml",
+                        '<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml">'
+                        f"<head><title>{escape(chapter_title)}</title></head>"
+                        f"<body><h1>{escape(chapter_title)}</h1>{body}</body></html>")
+            manifest.append(f'<item id="ch{n}" href="ch{n:03d}.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="ch{n}"/>')
+        zf.writestr("OEBPS/content.opf",
+                    '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" '
+                    'version="3.0" unique-identifier="id"><metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                    f"<dc:identifier id=\"id\">{uuid.uuid4()}</dc:identifier><dc:title>{escape(title)}</dc:title>"
+                    f"<dc:creator>{escape(author)}</dc:creator><dc:language>en</dc:language></metadata>"
+                    f"<manifest>{''.join(manifest)}</manifest><spine>{''.join(spine)}</spine></package>")
+    return buf.getvalue()
+
+
+def _pdf_text(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+def make_pdf(title, author, chapters, lines_per_page=46):
+    """A text PDF: one page run per chapter, a larger heading, a running header, page numbers and an outline."""
+    objects = []
+
+    def add(body=None):
+        objects.append(body)
+        return len(objects)
+
+    font = add("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    pages = add()
+    page_ids, outline = [], []
+    for chapter_title, paragraphs in chapters:
+        lines = [line for p in paragraphs for line in textwrap.wrap(p, 95)]
+        first = True
+        while first or lines:
+            room = lines_per_page - (4 if first else 0)
+            chunk, lines = lines[:room], lines[room:]
+            ops = [f"BT /F1 9 Tf 72 760 Td {_pdf_text(title)} Tj ET"]
+            if first:
+                ops.append(f"BT /F1 20 Tf 72 720 Td {_pdf_text(chapter_title)} Tj ET")
+            top = 680 if first else 730
+            ops.append(f"BT /F1 11 Tf 14 TL 72 {top} Td " + " T* ".join(f"{_pdf_text(l)} Tj" for l in chunk) + " ET")
+            ops.append(f"BT /F1 9 Tf 300 40 Td {_pdf_text(str(len(page_ids) + 1))} Tj ET")
+            data = "\n".join(ops).encode("cp1252")
+            content = add(b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream")
+            page = add(f"<< /Type /Page /Parent {pages} 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {content} 0 R >>")
+            page_ids.append(page)
+            if first:
+                outline.append((chapter_title, page))
+            first = False
+    objects[pages - 1] = f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in page_ids)}] /Count {len(page_ids)} >>"
+
+    root = add()
+    items = [add() for _ in outline]
+    for i, ((chapter_title, page), item) in enumerate(zip(outline, items)):
+        links = (f" /Prev {items[i - 1]} 0 R" if i else "") + (f" /Next {items[i + 1]} 0 R" if i + 1 < len(items) else "")
+        objects[item - 1] = (f"<< /Title {_pdf_text(chapter_title)} /Parent {root} 0 R "
+                             f"/Dest [{page} 0 R /XYZ 0 792 0]{links} >>")
+    objects[root - 1] = f"<< /Type /Outlines /First {items[0]} 0 R /Last {items[-1]} 0 R /Count {len(items)} >>"
+    catalog = add(f"<< /Type /Catalog /Pages {pages} 0 R /Outlines {root} 0 R /PageMode /UseOutlines >>")
+    info = add(f"<< /Title {_pdf_text(title)} /Author {_pdf_text(author)} >>")
+
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for n, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % n + (body if isinstance(body, bytes) else body.encode("cp1252")) + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, catalog, info, xref)
+    return bytes(out)
+
+
+# ---------- measurements ----------
+def percentile(values, pct):
+    """Nearest-rank percentile; None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(values):
+    return {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+            "max": max(values) if values else None}
+
+
+class EmfCollector(io.TextIOBase):
+    """
+    Stands in for sys.stdout while the handlers run: keeps the EMF lines they
+    print and passes anything else through. Lines are assembled per thread.
+    """
+
+    def __init__(self, passthrough):
+        self.passthrough = passthrough
+        self.lines = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        pending = getattr(self._local, "pending", "") + text
+        *lines, self._local.pending = pending.split("\n")
+        for line in lines:
+            if line.startswith('{"_aws"'):
+                with self._lock:
+                    self.lines.append(json.loads(line))
+            elif line:
+                self.passthrough.write(line + "\n")
+        return len(text)
+
+    def flush(self):
+        self.passthrough.flush()
+
+    def stage_timings(self):
+        """(function, stage) -> ([duration_ms], errors)"""
+        timings = collections.defaultdict(lambda: ([], [0]))
+        with self._lock:
+            lines = list(self.lines)
+        for line in lines:
+            if "duration_ms" not in line:
+                continue
+            durations, errors = timings[(line["function"], line["stage"])]
+            durations.append(float(line["duration_ms"]))
+            errors[0] += line.get("outcome") == "error"
+        return {key: (durations, errors[0]) for key, (durations, errors) in timings.items()}
+
+
+class FakeContext:
+    def __init__(self, function_name, timeout, memory_mb):
+        self.function_name = function_name
+        self.memory_limit_in_mb = memory_mb
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+# ---------- functions ----------
+_load_lock = threading.Lock()
+
+
+class Function:
+    """
+    A deployed function with up to `concurrency` containers. Each container is
+    a separate copy of the handler module, loaded on its first (cold) invocation.
+    """
+
+    def __init__(self, name, concurrency, timeout, memory_mb, env):
+        directory, module, _ = HANDLERS[name]
+        self.name = name
+        self.path = os.path.join(LAMBDAS_DIR, directory, module + ".py")
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.env = env
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self._idle = queue.LifoQueue()  # warm containers, most recently used first
+        self._containers = 0
+        self._lock = threading.Lock()
+        self.durations, self.init_ms, self.queue_waits = [], [], []
+        self.errors = self.over_timeout = 0
+        self.running = 0
+
+    def _cold_start(self):
+        with self._lock:
+            self._containers += 1
+            module_name = f"bench_{self.name.replace('-', '_')}_{self._containers}"
+        started = time.perf_counter()
+        # Module constants are read from the environment at import time
+        with _load_lock:
+            os.environ.update(self.env, AWS_LAMBDA_FUNCTION_NAME=self.name,
+                              AWS_LAMBDA_FUNCTION_MEMORY_SIZE=str(self.memory_mb))
+            spec = importlib.util.spec_from_file_location(module_name, self.path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        with self._lock:
+            self.init_ms.append((time.perf_counter() - started) * 1000)
+        return module.lambda_handler
+
+    def run(self, event):
+        """Runs one invocation; the caller holds one of self.slots."""
+        try:
+            handler = self._idle.get_nowait()
+        except queue.Empty:
+            handler = self._cold_start()
+        with self._lock:
+            self.running += 1
+        started = time.perf_counter()
+        try:
+            return handler(event, FakeContext(self.name, self.timeout, self.memory_mb))
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.running -= 1
+                self.durations.append(elapsed * 1000)
+                self.over_timeout += elapsed > self.timeout
+            self._idle.put(handler)
+
+    def invoke(self, event):
+        with self.slots:
+            return self.run(event)
+
+
+class Pipeline:
+    """The functions, their SQS event sources and async invokes, on top of FakeAWS."""
+
+    def __init__(self, aws, functions):
+        self.aws = aws
+        self.functions = functions
+        self.stop = threading.Event()
+        self._threads = []
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        aws.lambda_.dispatch = self._dispatch
+        for queue_name, consumers in EVENT_SOURCES.items():
+            if len(consumers) > 1:
+                aws.sqs.fan_out(queue_name, [f"{queue_name}:{fn}" for fn, _ in consumers])
+
+    def start(self):
+        for queue_name, consumers in EVENT_SOURCES.items():
+            for function_name, batch_size in consumers:
+                source = f"{queue_name}:{function_name}" if len(consumers) > 1 else queue_name
+                thread = threading.Thread(target=self._poll, args=(source, self.functions[function_name], batch_size),
+                                          name=f"poll-{source}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _poll(self, source, function, batch_size):
+        """The Lambda event source mapping: one batch per free container."""
+        while not self.stop.is_set():
+            if not function.slots.acquire(timeout=0.1):
+                continue
+            records = self.aws.sqs.receive(source, batch_size, wait_seconds=0.05)
+            if not records:
+                function.slots.release()
+                continue
+            self._begin()
+            threading.Thread(target=self._run_batch, args=(function, records), daemon=True).start()
+
+    def _begin(self):
+        with self._busy_lock:
+            self._busy += 1
+
+    def _end(self):
+        with self._busy_lock:
+            self._busy -= 1
+
+    def _run_batch(self, function, records):
+        now_ms = time.time() * 1000
+        with function._lock:
+            function.queue_waits.extend(now_ms - int(r["attributes"]["SentTimestamp"]) for r in records)
+        try:
+            result = function.run({"Records": records})
+            failed = {f["itemIdentifier"] for f in (result or {}).get("batchItemFailures", [])}
+        except Exception as e:
+            logging.getLogger("benchmark").error(f"{function.name} invocation failed: {e}")
+            failed = {r["messageId"] for r in records}
+        finally:
+            function.slots.release()
+        for record in records:
+            if record["messageId"] in failed:
+                self.aws.sqs.fail(record["receiptHandle"], visibility_timeout=function.timeout)
+            else:
+                self.aws.sqs.ack(record["receiptHandle"])
+        self._end()
+
+    def _dispatch(self, function_name, payload, asynchronous):
+        function = self.functions[function_name]
+        if not asynchronous:
+            return function.invoke(payload)
+        self._begin()
+
+        def run():
+            try:
+                function.invoke(payload)
+            except Exception as e:
+                logging.getLogger("benchmark").error(f"{function_name} async invocation failed: {e}")
+            finally:
+                self._end()
+        threading.Thread(target=run, daemon=True).start()
+        return None
+
+    def idle(self):
+        with self._busy_lock:
+            return self._busy == 0 and self.aws.sqs.pending() == 0
+
+    def schedule(self, function_name, interval):
+        """Invokes a function every `interval` seconds, like an EventBridge schedule."""
+        def tick():
+            while not self.stop.wait(interval):
+                self._dispatch(function_name, {"source": "aws.events"}, asynchronous=True)
+        thread = threading.Thread(target=tick, name=f"schedule-{function_name}", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def shutdown(self, wait=30):
+        self.stop.set()
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            with self._busy_lock:
+                if self._busy == 0:
+                    return
+            time.sleep(0.05)
+
+
+# ---------- phases ----------
+def upload_books(args, pipeline, rng):
+    """Uploads every book; returns {book_id: {...}} with upload times."""
+    uploader = pipeline.functions["generatePresignedUploadUrl"]
+    books = {}
+    interval = 1 / args.arrival_rate if args.arrival_rate else 0
+    for index in range(args.books):
+        user_id = f"bench-user-{index % args.users}"
+        fmt = "pdf" if rng.random() < args.pdf_share else "epub"
+        title, author, chapters = synthetic_book(rng, index, args.words, args.chapters)
+        data = make_pdf(title, author, chapters) if fmt == "pdf" else make_epub(title, author, chapters)
+        response = uploader.invoke({"body": json.dumps({"user_id": user_id, "file_name": f"book-{index}.{fmt}"})})
+        if response.get("statusCode") != 200:
+            raise RuntimeError(f"generatePresignedUploadUrl failed: {response.get('body')}")
+        upload = json.loads(response["body"])
+        books[upload["book_id"]] = {"user_id": user_id, "format": fmt, "bytes": len(data),
+                                    "cast": sorted({n for _, ps in chapters for p in ps for n in NAMES if n in p}),
+                                    "uploaded_at": time.monotonic()}
+        pipeline.aws.s3.put_object(Bucket=UPLOAD_BUCKET, Key=upload["s3_key"], Body=data)
+        if interval:
+            time.sleep(interval)
+    return books
+
+
+def wait_until_ready(args, pipeline, books):
+    """Polls user_books until every book is READY, the pipeline goes idle or --timeout passes."""
+    user_books = pipeline.aws.dynamodb.Table("user_books")
+    deadline = time.monotonic() + args.timeout
+    idle_since = None
+    while time.monotonic() < deadline:
+        for item in user_books.items():
+            book = books.get(item["book_id"])
+            if book and item.get("processing_status") == "READY" and "ready_at" not in book:
+                book["ready_at"] = time.monotonic()
+        if all("ready_at" in book for book in books.values()):
+            return True
+        if pipeline.idle():
+            idle_since = idle_since or time.monotonic()
+            if time.monotonic() - idle_since > 2:
+                return False  # nothing left to run, yet some books never became READY
+        else:
+            idle_since = None
+        time.sleep(0.05)
+    return False
+
+
+def run_reads(args, pipeline, books, rng):
+    """args.reads reads per READY book, spread over READ_MIX; returns {function: [(ms, status)]}."""
+    ready = [(book_id, book) for book_id, book in books.items() if "ready_at" in book]
+    requests_ = []
+    for book_id, book in ready:
+        for _ in range(args.reads):
+            function = rng.choices(list(READ_MIX), weights=list(READ_MIX.values()))[0]
+            percentage = rng.randint(1, args.read_max_percent)
+            headers = {"user-id": book["user_id"]}
+            if function == "getUserBooks":
+                event = {"headers": headers, "queryStringParameters": None}
+            elif function == "askBookQuestion":
+                question = rng.choice(QUESTIONS).format(name=rng.choice(book["cast"] or NAMES))
+                event = {"headers": headers, "pathParameters": {"bookId": book_id},
+                         "body": json.dumps({"question": question, "percentage": percentage})}
+            else:
+                event = {"headers": headers, "pathParameters": {"bookId": book_id},
+                         "queryStringParameters": {"percentage": str(percentage)}}
+            requests_.append((function, event))
+
+    results = collections.defaultdict(list)
+    lock = threading.Lock()
+    work = queue.Queue()
+    for request in requests_:
+        work.put(request)
+
+    def reader():
+        while True:
+            try:
+                function, event = work.get_nowait()
+            except queue.Empty:
+                return
+            started = time.perf_counter()
+            try:
+                status = pipeline.functions[function].invoke(event).get("statusCode")
+            except Exception:
+                status = "error"
+            with lock:
+                results[function].append(((time.perf_counter() - started) * 1000, status))
+
+    threads = [threading.Thread(target=reader, daemon=True) for _ in range(args.read_concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# ---------- report ----------
+def _ms(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def build_report(args, aws, gemini, collector, functions, books, pipeline_seconds, reads):
+    done = [b for b in books.values() if "ready_at" in b]
+    first_upload = min((b["uploaded_at"] for b in books.values()), default=0)
+    last_ready = max((b["ready_at"] for b in done), default=first_upload)
+    span_min = (last_ready - first_upload) / 60
+    token_items = [i for i in aws.dynamodb.Table("token_usage").items() if i["usage_key"].startswith("book#")]
+    stats = dict(gemini.stats)
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("save", "baseline")},
+        "books": len(books),
+        "books_ready": len(done),
+        "books_per_minute": len(done) / span_min if span_min > 0 else None,
+        "pipeline_seconds": pipeline_seconds,
+        "upload_to_ready_s": summarize([b["ready_at"] - b["uploaded_at"] for b in done]),
+        "dead_letters": {q: len(m) for q, m in aws.sqs.dead_letters.items() if m},
+        "stages": {f"{fn} / {stage}": {**summarize(durations), "errors": errors}
+                   for (fn, stage), (durations, errors) in sorted(collector.stage_timings().items())},
+        "functions": {
+            fn.name: {**summarize(fn.durations), "errors": fn.errors, "cold_starts": len(fn.init_ms),
+                      "init_p50": percentile(fn.init_ms, 50), "queue_wait_p50": percentile(fn.queue_waits, 50),
+                      "queue_wait_p95": percentile(fn.queue_waits, 95), "over_timeout": fn.over_timeout}
+            for fn in functions.values() if fn.durations},
+        "reads": {fn: {**summarize([ms for ms, _ in results]),
+                       "status": dict(collections.Counter(str(status) for _, status in results))}
+                  for fn, results in sorted(reads.items())},
+        "llm": {**stats,
+                "tokens_per_book": (stats["prompt_tokens"] + stats["cached_tokens"] + stats["output_tokens"])
+                / len(books) if books else None,
+                "cost_usd": float(sum(i.get("cost_usd", 0) for i in token_items))},
+        "aws_calls": {f"{service}.{operation}": n for (service, operation), n in sorted(aws.calls.items())},
+    }
+
+
+def print_report(report, out):
+    p = lambda *a: print(*a, file=out)
+    e2e = report["upload_to_ready_s"]
+    rate = report["books_per_minute"]
+    throughput = f"{rate:.2f} books/min" if rate else "no book finished"
+    p(f"\nPipeline: {report['books_ready']}/{report['books']} books READY in {report['pipeline_seconds']:.1f} s"
+      f"  ->  {throughput}")
+    p(f"  upload -> READY   p50 {_ms(e2e['p50'])} s   p95 {_ms(e2e['p95'])} s   max {_ms(e2e['max'])} s")
+    if report["dead_letters"]:
+        p(f"  dead letters: {report['dead_letters']}")
+
+    p(f"\n{'Stage latency (ms)':58} {'count':>6} {'p50':>9} {'p95':>9} {'max':>9} {'errors':>7}")
+    for name, s in report["stages"].items():
+        p(f"  {name:56} {s['count']:6} {_ms(s['p50']):>9} {_ms(s['p95']):>9} {_ms(s['max']):>9} {s['errors']:7}")
+
+    p(f"\n{'Invocations (ms)':30} {'count':>6} {'p50':>9} {'p95':>9} {'max':>9} {'errors':>7} {'cold':>5}"
+      f" {'init p50':>9} {'queue p50':>10} {'queue p95':>10}")
+    for name, s in report["functions"].items():
+        p(f"  {name:28} {s['count']:6} {_ms(s['p50']):>9} {_ms(s['p95']):>9} {_ms(s['max']):>9} {s['errors']:7}"
+          f" {s['cold_starts']:5} {_ms(s['init_p50']):>9} {_ms(s['queue_wait_p50']):>10} {_ms(s['queue_wait_p95']):>10}")
+
+    if report["reads"]:
+        p(f"\n{'Reads (ms)':30} {'count':>6} {'p50':>9} {'p95':>9} {'max':>9}  status")
+        for name, s in report["reads"].items():
+            p(f"  {name:28} {s['count']:6} {_ms(s['p50']):>9} {_ms(s['p95']):>9} {_ms(s['max']):>9}  {s['status']}")
+
+    llm = report["llm"]
+    p(f"\nGemini: {llm['generate_calls']} calls, {llm['throttled']} answered 429, {llm['caches_created']} caches;"
+      f" tokens prompt {llm['prompt_tokens']}, cached {llm['cached_tokens']}, output {llm['output_tokens']}"
+      f" ({llm['tokens_per_book'] or 0:.0f} per book); recorded cost ${llm['cost_usd']:.4f}")
+
+    by_service = collections.Counter()
+    for name, n in report["aws_calls"].items():
+        by_service[name.split(".")[0]] += n
+    p("AWS calls: " + ", ".join(f"{service} {n}" for service, n in sorted(by_service.items())))
+
+
+def _comparable(report):
+    """Flat name -> value of the metrics compared against a baseline."""
+    values = {"books/min": report["books_per_minute"],
+              "upload->READY p50 s": report["upload_to_ready_s"]["p50"],
+              "upload->READY p95 s": report["upload_to_ready_s"]["p95"],
+              "Gemini tokens per book": report["llm"]["tokens_per_book"],
+              "Gemini calls": report["llm"]["generate_calls"]}
+    for name, s in report["stages"].items():
+        values[f"{name} p50 ms"] = s["p50"]
+        values[f"{name} p95 ms"] = s["p95"]
+    for name, s in report["reads"].items():
+        values[f"read {name} p95 ms"] = s["p95"]
+    values["AWS calls"] = sum(report["aws_calls"].values())
+    return values
+
+
+def print_comparison(report, baseline, out):
+    current, before = _comparable(report), _comparable(baseline)
+    print(f"\n{'Against baseline':58} {'baseline':>11} {'now':>11} {'change':>8}", file=out)
+    for name in current:
+        old, new = before.get(name), current[name]
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "-"
+        print(f"  {name:56} {old:11.1f} {new:11.1f} {change:>8}", file=out)
+
+
+# ---------- main ----------
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end pipeline load benchmark with local stand-ins")
+    books = parser.add_argument_group("books")
+    books.add_argument("--books", type=int, default=12)
+    books.add_argument("--users", type=int, default=4, help="Books are spread round-robin over this many users")
+    books.add_argument("--words", type=int, default=20000, help="Words per book")
+    books.add_argument("--chapters", type=int, default=12, help="Narrative chapters per book")
+    books.add_argument("--pdf-share", type=float, default=0.25, help="Share of books uploaded as PDF")
+    books.add_argument("--arrival-rate", type=float, default=0, help="Uploads per second (0: all at once)")
+    books.add_argument("--seed", type=int, default=1)
+    gemini = parser.add_argument_group("Gemini stand-in")
+    gemini.add_argument("--gemini-latency-ms", type=float, default=300)
+    gemini.add_argument("--gemini-jitter-ms", type=float, default=200)
+    gemini.add_argument("--gemini-429-rate", type=float, default=0.0)
+    gemini.add_argument("--gemini-response-words", type=int, default=250)
+    gemini.add_argument("--gemini-min-cache-tokens", type=int, default=0)
+    runtime = parser.add_argument_group("runtime")
+    runtime.add_argument("--aws-latency-ms", type=float, default=0, help="Added to every S3/SQS/DynamoDB call")
+    runtime.add_argument("--delay-scale", type=float, default=0.01,
+                         help="Scale of SQS delays and visibility timeouts (0.01: a minute takes 0.6 s)")
+    runtime.add_argument("--memory-mb", type=int, default=1024, help="AWS_LAMBDA_FUNCTION_MEMORY_SIZE for all functions")
+    runtime.add_argument("--concurrency", action="append", default=[], metavar="FUNCTION=N",
+                         help="Containers per function, e.g. bookSummaryLambda=8")
+    runtime.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                         help="Environment for every function, e.g. PREFETCH_DEPTH=4")
+    runtime.add_argument("--dispatch-interval", type=float, default=5, help="Seconds between scheduled fairDispatcher runs")
+    runtime.add_argument("--timeout", type=float, default=900, help="Longest wait for the books to become READY")
+    reads = parser.add_argument_group("reads")
+    reads.add_argument("--reads", type=int, default=20, help="Reads per READY book")
+    reads.add_argument("--read-concurrency", type=int, default=8)
+    reads.add_argument("--read-max-percent", type=int, default=100, help="Reads ask for progress 1..N percent")
+    output = parser.add_argument_group("output")
+    output.add_argument("--save", help="Write the report as JSON, to use as a baseline later")
+    output.add_argument("--baseline", help="Compare with a report written by --save")
+    output.add_argument("--verbose", action="store_true", help="Show the handlers' INFO logs")
+    args = parser.parse_args()
+    if args.pdf_share > 0 and importlib.util.find_spec("fitz") is None:
+        parser.error("PDF books need PyMuPDF (pip install -r src/lambdas/normalize_books/requirements.txt), "
+                     "or use --pdf-share 0")
+    return args
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    root = logging.getLogger()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setLevel(logging.INFO if args.verbose else logging.ERROR)
+    root.addHandler(handler)  # also stops the last-resort handler printing every warning
+
+    gemini, gemini_base = start_server(min_cache_tokens=args.gemini_min_cache_tokens,
+                                       latency_ms=args.gemini_latency_ms, jitter_ms=args.gemini_jitter_ms,
+                                       rate_429=args.gemini_429_rate, response_words=args.gemini_response_words)
+    aws = FakeAWS(latency_ms=args.aws_latency_ms, delay_scale=args.delay_scale).install()
+    aws.s3.notify(UPLOAD_BUCKET, "book-processing-queue")
+
+    env = {"AWS_REGION": "us-east-1", "AWS_DEFAULT_REGION": "us-east-1",
+           "GEMINI_API_BASE": gemini_base, "GEMINI_API_KEY": "benchmark",
+           "WEBSOCKET_ENDPOINT": "", "MEMORY_TRACE_SAMPLE_RATE": "0"}
+    env.update(item.split("=", 1) for item in args.env)
+    concurrency = {name: limits[1] for name, limits in FUNCTION_LIMITS.items()}
+    concurrency.update({name: args.read_concurrency for name in READ_MIX})
+    for item in args.concurrency:
+        name, n = item.split("=", 1)
+        if name not in FUNCTION_LIMITS:
+            sys.exit(f"Unknown function {name}; one of {', '.join(FUNCTION_LIMITS)}")
+        concurrency[name] = int(n)
+    functions = {name: Function(name, concurrency[name], timeout, args.memory_mb, env)
+                 for name, (timeout, _) in FUNCTION_LIMITS.items()}
+
+    real_stdout = sys.stdout
+    collector = EmfCollector(real_stdout)
+    sys.stdout = collector
+    pipeline = Pipeline(aws, functions)
+    try:
+        pipeline.start()
+        pipeline.schedule("fairDispatcher", args.dispatch_interval)
+        started = time.monotonic()
+        books = upload_books(args, pipeline, rng)
+        all_ready = wait_until_ready(args, pipeline, books)
+        pipeline_seconds = time.monotonic() - started
+        if not all_ready:
+            print(f"Only {sum('ready_at' in b for b in books.values())} of {len(books)} books became READY.",
+                  file=sys.stderr)
+        reads = run_reads(args, pipeline, books, rng) if args.reads else {}
+        # Let on-demand generation started by the reads finish, so its tokens are counted
+        deadline = time.monotonic() + args.timeout
+        while not pipeline.idle() and time.monotonic() < deadline:
+            time.sleep(0.1)
+    finally:
+        pipeline.shutdown()
+        sys.stdout = real_stdout
+        aws.uninstall()
+        gemini.shutdown()
+
+    report = build_report(args, aws, gemini, collector, functions, books, pipeline_seconds, reads)
+    print_report(report, real_stdout)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(report, json.load(f), real_stdout)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved report to {args.save}", file=real_stdout)
+    return 0 if all_ready else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,833 @@
+#!/usr/bin/env python3
+"""
+In-process stand-ins for the AWS services the lambdas use: S3, SQS,
+DynamoDB (resource API) and Lambda async invokes.
+
+They implement the calls the handlers make, the way the handlers make them,
+so the real handler modules can run unchanged in one process:
+
+    aws = FakeAWS(latency_ms=5).install()   # boto3.client / boto3.resource now return fakes
+    aws.s3.notify("book-processing-uploads", "book-processing-queue")
+    ...load and call handlers...
+    records = aws.sqs.receive("book-processing-queue", 10)
+
+DynamoDB supports the expression subset used in src/lambdas: SET (with
+if_not_exists, list_append, + and -), ADD (numbers and sets), REMOVE and
+DELETE updates; conditions with comparisons, BETWEEN, IN, AND / OR / NOT,
+attribute_exists, attribute_not_exists, begins_with, contains and size;
+boto3.dynamodb.conditions objects for key conditions and filters; GSIs
+(sparse), Limit / ExclusiveStartKey paging and projections. Like boto3,
+numbers come back as Decimal and floats are rejected.
+
+Used by tools/benchmark_pipeline.py. boto3 must be installed (its condition
+classes are used as-is); no AWS credentials or network access are needed.
+"""
+
+import collections
+import copy
+import datetime
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+import boto3
+
+# Table name -> (partition key, sort key or None)
+TABLE_KEYS = {
+    "summaries": ("book_id", "progress"),
+    "characters": ("book_id", "progress"),
+    "user_books": ("user_id", "book_id"),
+    "users": ("user_id", None),
+    "book_jobs": ("user_id", "job_id"),
+    "user_scheduling": ("user_id", None),
+    "pipeline_idempotency": ("idempotency_key", None),
+    "gemini_rate_limits": ("bucket_id", None),
+    "websocket_connections": ("user_id", "connection_id"),
+    "token_usage": ("usage_key", "stage"),
+}
+# Index name -> (partition key, sort key or None); items without the keys are not in the index
+INDEX_KEYS = {
+    "user_id-upload_timestamp-index": ("user_id", "upload_timestamp"),
+    "user_id-status_uploaded-index": ("user_id", "status_uploaded"),
+    "pending-users-index": ("pending_flag", "last_served_at"),
+    "connection_id-index": ("connection_id", None),
+}
+
+
+class ClientError(Exception):
+    """Shaped like botocore's ClientError: the error code is in response["Error"]["Code"]."""
+
+    def __init__(self, code, message="", operation=""):
+        super().__init__(f"An error occurred ({code}) when calling the {operation} operation: {message}")
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+def _error_class(code):
+    return type(code, (ClientError,), {"__init__": lambda self, message="", operation="":
+                                       ClientError.__init__(self, code, message, operation)})
+
+
+class _Exceptions:
+    def __init__(self, *codes):
+        for code in codes:
+            setattr(self, code, _error_class(code))
+        self.ClientError = ClientError
+
+
+class _Service:
+    """Per-call latency and call counting shared by all fakes."""
+
+    def __init__(self, aws, service):
+        self.aws = aws
+        self.service = service
+
+    def _call(self, operation):
+        self.aws.count(self.service, operation)
+        if self.aws.latency_ms:
+            time.sleep(self.aws.latency_ms / 1000)
+
+
+# ---------- S3 ----------
+class _Body:
+    """StreamingBody stand-in."""
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._stream.read() if amt is None else self._stream.read(amt)
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        return iter(lambda: self._stream.read(chunk_size), b"")
+
+    def close(self):
+        pass
+
+
+class FakeS3(_Service):
+    def __init__(self, aws):
+        super().__init__(aws, "s3")
+        self.exceptions = _Exceptions("NoSuchKey", "NoSuchBucket")
+        self._lock = threading.Lock()
+        self._objects = collections.defaultdict(dict)  # bucket -> key -> (data, etag, last_modified, content_type)
+        self._notifications = {}  # bucket -> queue name
+
+    def notify(self, bucket, queue_name):
+        """Sends an ObjectCreated event to the SQS queue for every object put into `bucket`."""
+        self._notifications[bucket] = queue_name
+
+    def _store(self, bucket, key, data, content_type=None):
+        etag = hashlib.md5(data).hexdigest()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            self._objects[bucket][key] = (data, etag, now, content_type)
+        queue = self._notifications.get(bucket)
+        if queue:
+            event = {"Records": [{
+                "eventVersion": "2.1", "eventSource": "aws:s3", "eventName": "ObjectCreated:Put",
+                "eventTime": now.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+                "s3": {"bucket": {"name": bucket},
+                       "object": {"key": key, "size": len(data), "eTag": etag,
+                                  "sequencer": f"{time.time_ns():X}"}},
+            }]}
+            self.aws.sqs.send_message(QueueUrl=queue, MessageBody=json.dumps(event))
+        return etag
+
+    def _get(self, bucket, key, operation):
+        with self._lock:
+            found = self._objects.get(bucket, {}).get(key)
+        if found is None:
+            raise self.exceptions.NoSuchKey("The specified key does not exist.", operation)
+        return found
+
+    def put_object(self, Bucket, Key, Body=b"", ContentType=None, **_):
+        self._call("PutObject")
+        data = Body.encode("utf-8") if isinstance(Body, str) else Body if isinstance(Body, bytes) else Body.read()
+        return {"ETag": f'"{self._store(Bucket, Key, data, ContentType)}"'}
+
+    def get_object(self, Bucket, Key, **_):
+        self._call("GetObject")
+        data, etag, modified, content_type = self._get(Bucket, Key, "GetObject")
+        return {"Body": _Body(data), "ContentLength": len(data), "ETag": f'"{etag}"',
+                "LastModified": modified, "ContentType": content_type}
+
+    def head_object(self, Bucket, Key, **_):
+        self._call("HeadObject")
+        try:
+            data, etag, modified, content_type = self._get(Bucket, Key, "HeadObject")
+        except ClientError:
+            raise ClientError("404", "Not Found", "HeadObject") from None
+        return {"ContentLength": len(data), "ETag": f'"{etag}"', "LastModified": modified,
+                "ContentType": content_type}
+
+    def download_file(self, Bucket, Key, Filename, **_):
+        self._call("GetObject")
+        data = self._get(Bucket, Key, "GetObject")[0]
+        with open(Filename, "wb") as f:
+            f.write(data)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **_):
+        self._call("PutObject")
+        with open(Filename, "rb") as f:
+            self._store(Bucket, Key, f.read(), (ExtraArgs or {}).get("ContentType"))
+
+    def delete_objects(self, Bucket, Delete, **_):
+        self._call("DeleteObjects")
+        with self._lock:
+            for obj in Delete["Objects"]:
+                self._objects[Bucket].pop(obj["Key"], None)
+        return {"Deleted": [{"Key": obj["Key"]} for obj in Delete["Objects"]]}
+
+    def get_paginator(self, operation):
+        if operation != "list_objects_v2":
+            raise NotImplementedError(f"S3 paginator {operation}")
+        return self
+
+    def paginate(self, Bucket, Prefix="", **_):
+        self._call("ListObjectsV2")
+        with self._lock:
+            contents = [{"Key": key, "Size": len(data), "ETag": f'"{etag}"', "LastModified": modified}
+                        for key, (data, etag, modified, _) in sorted(self._objects[Bucket].items())
+                        if key.startswith(Prefix)]
+        yield {"Contents": contents, "KeyCount": len(contents)} if contents else {"KeyCount": 0}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600, **_):
+        return f"http://fake-s3.local/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}"
+
+    def object_count(self, bucket):
+        with self._lock:
+            return len(self._objects.get(bucket, {}))
+
+
+# ---------- SQS ----------
+class FakeSQS(_Service):
+    """
+    Queues are named by the last path segment of their URL. Messages become
+    visible after their delay times `delay_scale`; received messages are
+    in flight until acknowledged or failed back onto the queue, and go to the
+    dead letters after `max_receive_count` receives.
+    """
+
+    def __init__(self, aws, delay_scale=1.0, max_receive_count=5):
+        super().__init__(aws, "sqs")
+        self.delay_scale = delay_scale
+        self.max_receive_count = max_receive_count
+        self._cond = threading.Condition()
+        self._queues = collections.defaultdict(list)  # name -> [message]
+        self._in_flight = {}  # receipt handle -> (queue name, message)
+        self._fan_out = {}  # queue name -> target queue names
+        self.dead_letters = collections.defaultdict(list)
+        self.sent = collections.Counter()
+
+    @staticmethod
+    def queue_name(queue_url):
+        return queue_url.rstrip("/").rsplit("/", 1)[-1]
+
+    def _enqueue(self, queue_url, body, delay_seconds=0, attributes=None):
+        name = self.queue_name(queue_url)
+        message_id = str(uuid.uuid4())
+        with self._cond:
+            for target in self._fan_out.get(name, [name]):
+                self._queues[target].append({
+                    "messageId": message_id, "body": body, "attributes": attributes or {},
+                    "sent_at": time.time(), "receive_count": 0,
+                    "visible_at": time.monotonic() + delay_seconds * self.delay_scale,
+                })
+                self.sent[target] += 1
+            self._cond.notify_all()
+        return message_id
+
+    def fan_out(self, queue_name, targets):
+        """Delivers every message sent to queue_name to each target queue instead (SNS-style)."""
+        self._fan_out[queue_name] = list(targets)
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, MessageAttributes=None, **_):
+        self._call("SendMessage")
+        return {"MessageId": self._enqueue(QueueUrl, MessageBody, DelaySeconds, MessageAttributes)}
+
+    def send_message_batch(self, QueueUrl, Entries, **_):
+        self._call("SendMessageBatch")
+        if len(Entries) > 10:
+            raise ClientError("AWS.SimpleQueueService.TooManyEntriesInBatchRequest",
+                              "Maximum number of entries per request are 10.", "SendMessageBatch")
+        successful = [{"Id": entry["Id"], "MessageId": self._enqueue(QueueUrl, entry["MessageBody"],
+                                                                    entry.get("DelaySeconds", 0),
+                                                                    entry.get("MessageAttributes"))}
+                      for entry in Entries]
+        return {"Successful": successful, "Failed": []}
+
+    def receive(self, queue_name, max_messages=10, wait_seconds=0.0):
+        """Visible messages as Lambda SQS event records (waits up to wait_seconds for the first)."""
+        deadline = time.monotonic() + wait_seconds
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                queue = self._queues.get(queue_name, [])
+                ready = [m for m in queue if m["visible_at"] <= now][:max_messages]
+                if ready or now >= deadline:
+                    break
+                upcoming = min((m["visible_at"] for m in queue), default=deadline)
+                self._cond.wait(max(0.001, min(deadline, upcoming) - now))
+            records = []
+            for message in ready:
+                queue.remove(message)
+                message["receive_count"] += 1
+                handle = f"{queue_name}:{message['messageId']}:{message['receive_count']}"
+                self._in_flight[handle] = (queue_name, message)
+                records.append({
+                    "messageId": message["messageId"], "receiptHandle": handle, "body": message["body"],
+                    "attributes": {"ApproximateReceiveCount": str(message["receive_count"]),
+                                   "SentTimestamp": str(int(message["sent_at"] * 1000))},
+                    "messageAttributes": message["attributes"], "eventSource": "aws:sqs",
+                    "eventSourceARN": f"arn:aws:sqs:us-east-1:000000000000:{queue_name}",
+                })
+            return records
+
+    def ack(self, receipt_handle):
+        with self._cond:
+            self._in_flight.pop(receipt_handle, None)
+            self._cond.notify_all()
+
+    def fail(self, receipt_handle, visibility_timeout=30):
+        """Returns a message to its queue after the (scaled) visibility timeout, or dead-letters it."""
+        with self._cond:
+            queue_name, message = self._in_flight.pop(receipt_handle)
+            if message["receive_count"] >= self.max_receive_count:
+                self.dead_letters[queue_name].append(message)
+            else:
+                message["visible_at"] = time.monotonic() + visibility_timeout * self.delay_scale
+                self._queues[queue_name].append(message)
+            self._cond.notify_all()
+
+    def pending(self, queue_name=None):
+        """Messages queued (visible or delayed) plus in flight, for one queue or all."""
+        with self._cond:
+            queued = sum(len(q) for name, q in self._queues.items() if queue_name in (None, name))
+            in_flight = sum(1 for name, _ in self._in_flight.values() if queue_name in (None, name))
+            return queued + in_flight
+
+
+# ---------- DynamoDB ----------
+_TOKEN_RE = re.compile(r"\s*(?:(<>|<=|>=|=|<|>|\(|\)|,|\+|-)|([#:]?[A-Za-z_][A-Za-z0-9_.]*))")
+_KEYWORDS = {"AND", "OR", "NOT", "BETWEEN", "IN", "SET", "ADD", "REMOVE", "DELETE"}
+
+
+def _tokenize(expression):
+    tokens, pos = [], 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _TOKEN_RE.match(expression, pos)
+        if not match or match.end() == pos:
+            raise ValueError(f"Cannot parse expression at {expression[pos:]!r}")
+        symbol, word = match.groups()
+        if word and word.upper() in _KEYWORDS:
+            tokens.append(word.upper())
+        else:
+            tokens.append(symbol or word)
+        pos = match.end()
+    return tokens
+
+
+class _Expression:
+    """Recursive-descent evaluator for condition and update expressions."""
+
+    def __init__(self, expression, names, values):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+        self._check = None  # parsed condition, reused for every item a query checks
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and token != expected:
+            raise ValueError(f"Expected {expected!r}, found {token!r}")
+        self.pos += 1
+        return token
+
+    def name(self, token):
+        return self.names[token] if token.startswith("#") else token
+
+    # --- operands ---
+    def operand(self):
+        """Returns a function item -> value (_MISSING if the attribute is absent)."""
+        token = self.take()
+        if token.startswith(":"):
+            value = self.values[token]
+            return lambda item: value
+        if self.peek() == "(":
+            return self.function(token)
+        attr = self.name(token)
+        return lambda item: item.get(attr, _MISSING)
+
+    def path(self):
+        return self.name(self.take())
+
+    def function(self, fn):
+        self.take("(")
+        args = [self.operand()]
+        while self.peek() == ",":
+            self.take(",")
+            args.append(self.operand())
+        self.take(")")
+        if fn == "if_not_exists":
+            return lambda item: args[0](item) if args[0](item) is not _MISSING else args[1](item)
+        if fn == "list_append":
+            return lambda item: list(args[0](item)) + list(args[1](item))
+        if fn == "size":
+            return lambda item: Decimal(len(args[0](item))) if args[0](item) is not _MISSING else _MISSING
+        if fn == "attribute_exists":
+            return lambda item: args[0](item) is not _MISSING
+        if fn == "attribute_not_exists":
+            return lambda item: args[0](item) is _MISSING
+        if fn == "begins_with":
+            return lambda item: _begins_with(args[0](item), args[1](item))
+        if fn == "contains":
+            return lambda item: _contains(args[0](item), args[1](item))
+        raise NotImplementedError(f"DynamoDB function {fn}")
+
+    # --- conditions ---
+    def condition(self):
+        left = self.conjunction()
+        while self.peek() == "OR":
+            self.take()
+            right, first = self.conjunction(), left
+            left = lambda item, a=first, b=right: a(item) or b(item)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.peek() == "AND":
+            self.take()
+            right, first = self.negation(), left
+            left = lambda item, a=first, b=right: a(item) and b(item)
+        return left
+
+    def negation(self):
+        if self.peek() == "NOT":
+            self.take()
+            inner = self.negation()
+            return lambda item: not inner(item)
+        if self.peek() == "(":
+            self.take("(")
+            inner = self.condition()
+            self.take(")")
+            return inner
+        left = self.operand()
+        op = self.peek()
+        if op in ("=", "<>", "<", "<=", ">", ">="):
+            self.take()
+            right = self.operand()
+            return lambda item: _compare(op, left(item), right(item))
+        if op == "BETWEEN":
+            self.take()
+            low = self.operand()
+            self.take("AND")
+            high = self.operand()
+            return lambda item: _compare(">=", left(item), low(item)) and _compare("<=", left(item), high(item))
+        if op == "IN":
+            self.take()
+            self.take("(")
+            options = [self.operand()]
+            while self.peek() == ",":
+                self.take(",")
+                options.append(self.operand())
+            self.take(")")
+            return lambda item: any(_compare("=", left(item), option(item)) for option in options)
+        return lambda item: bool(left(item))  # a function such as attribute_exists(...)
+
+    def evaluate_condition(self, item):
+        if self._check is None:
+            self._check = self.condition()
+            if self.peek() is not None:
+                raise ValueError(f"Unexpected {self.peek()!r} in condition")
+        return self._check(item)
+
+    # --- updates ---
+    def apply_update(self, item):
+        """Returns a copy of item with the update applied."""
+        item = dict(item)
+        while self.peek() is not None:
+            clause = self.take()
+            while True:
+                if clause == "SET":
+                    attr = self.path()
+                    self.take("=")
+                    value = self.operand()
+                    if self.peek() in ("+", "-"):
+                        sign = self.take()
+                        other, first = self.operand(), value
+                        value = (lambda it, a=first, b=other: a(it) + b(it)) if sign == "+" else \
+                                (lambda it, a=first, b=other: a(it) - b(it))
+                    item[attr] = value(item)
+                elif clause == "ADD":
+                    attr = self.path()
+                    amount = self.operand()(item)
+                    current = item.get(attr)
+                    if isinstance(amount, set):
+                        item[attr] = (current or set()) | amount
+                    else:
+                        item[attr] = (current or Decimal(0)) + amount
+                elif clause == "REMOVE":
+                    item.pop(self.path(), None)
+                elif clause == "DELETE":
+                    attr = self.path()
+                    remaining = (item.get(attr) or set()) - self.operand()(item)
+                    if remaining:
+                        item[attr] = remaining
+                    else:
+                        item.pop(attr, None)
+                else:
+                    raise ValueError(f"Unknown update clause {clause!r}")
+                if self.peek() != ",":
+                    break
+                self.take(",")
+        return item
+
+
+class _Missing:
+    def __repr__(self):
+        return "<missing>"
+
+
+_MISSING = _Missing()
+
+
+def _compare(op, left, right):
+    if left is _MISSING or right is _MISSING:
+        return op == "<>" and (left is _MISSING) != (right is _MISSING)
+    try:
+        return {"=": left == right, "<>": left != right}[op] if op in ("=", "<>") else \
+            {"<": lambda: left < right, "<=": lambda: left <= right,
+             ">": lambda: left > right, ">=": lambda: left >= right}[op]()
+    except TypeError:
+        return False  # DynamoDB comparisons across types are false
+
+
+def _begins_with(value, prefix):
+    return isinstance(value, (str, bytes)) and isinstance(prefix, type(value)) and value.startswith(prefix)
+
+
+def _contains(value, operand):
+    if value is _MISSING:
+        return False
+    if isinstance(value, str):
+        return isinstance(operand, str) and operand in value
+    return operand in value
+
+
+def _evaluate_conditions(condition, item):
+    """Evaluates a boto3.dynamodb.conditions object against an item."""
+    expression = condition.get_expression()
+    op, values = expression["operator"], expression["values"]
+    if op == "AND":
+        return _evaluate_conditions(values[0], item) and _evaluate_conditions(values[1], item)
+    if op == "OR":
+        return _evaluate_conditions(values[0], item) or _evaluate_conditions(values[1], item)
+    if op == "NOT":
+        return not _evaluate_conditions(values[0], item)
+    resolved = [item.get(v.name, _MISSING) if hasattr(v, "name") and not isinstance(v, str) else _to_dynamo(v)
+                for v in values]
+    if op in ("=", "<>", "<", "<=", ">", ">="):
+        return _compare(op, resolved[0], resolved[1])
+    if op == "BETWEEN":
+        return _compare(">=", resolved[0], resolved[1]) and _compare("<=", resolved[0], resolved[2])
+    if op == "begins_with":
+        return _begins_with(resolved[0], resolved[1])
+    if op == "IN":
+        return any(_compare("=", resolved[0], option) for option in resolved[1])
+    if op == "attribute_exists":
+        return resolved[0] is not _MISSING
+    if op == "attribute_not_exists":
+        return resolved[0] is _MISSING
+    if op == "contains":
+        return _contains(resolved[0], resolved[1])
+    raise NotImplementedError(f"Condition operator {op}")
+
+
+def _condition_attributes(condition):
+    """Attribute names a boto3 condition refers to."""
+    names = set()
+    for value in condition.get_expression()["values"]:
+        if hasattr(value, "get_expression"):
+            names |= _condition_attributes(value)
+        elif hasattr(value, "name") and not isinstance(value, str):
+            names.add(value.name)
+    return names
+
+
+def _to_dynamo(value):
+    """Converts a value the way boto3's serializer accepts it, returning what a read would give back."""
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, bytearray, Decimal)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, dict):
+        return {k: _to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_dynamo(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        if not value:
+            raise ValueError("An empty set is not a valid DynamoDB value.")
+        return {_to_dynamo(v) for v in value}
+    raise TypeError(f"Unsupported type {type(value)} for value {value!r}")
+
+
+class _BatchWriter:
+    def __init__(self, table):
+        self._table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def put_item(self, Item):
+        self._table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self._table.delete_item(Key=Key)
+
+
+class FakeTable(_Service):
+    def __init__(self, aws, name, keys, meta):
+        super().__init__(aws, "dynamodb")
+        self.name = self.table_name = name
+        self.hash_key, self.range_key = keys
+        self.meta = meta
+        self._lock = threading.RLock()
+        self._items = {}  # primary key tuple -> item
+
+    def _key(self, key):
+        try:
+            return (key[self.hash_key], key[self.range_key]) if self.range_key else (key[self.hash_key],)
+        except KeyError as e:
+            raise ClientError("ValidationException", f"Missing key attribute {e} for {self.name}") from None
+
+    def _check(self, item, condition, names, values, operation):
+        if condition is None:
+            return
+        if isinstance(condition, str):
+            passed = _Expression(condition, names, values).evaluate_condition(item)
+        else:
+            passed = _evaluate_conditions(condition, item)
+        if not passed:
+            raise self.meta.client.exceptions.ConditionalCheckFailedException(
+                "The conditional request failed", operation)
+
+    @staticmethod
+    def _project(item, projection, names):
+        if not projection:
+            return copy.deepcopy(item)
+        attrs = [(names or {}).get(a.strip(), a.strip()) for a in projection.split(",")]
+        return {a: copy.deepcopy(item[a]) for a in attrs if a in item}
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **_):
+        self._call("GetItem")
+        with self._lock:
+            item = self._items.get(self._key(_to_dynamo(Key)))
+            return {"Item": self._project(item, ProjectionExpression, ExpressionAttributeNames)} if item else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **_):
+        self._call("PutItem")
+        item = _to_dynamo(Item)
+        values = _to_dynamo(ExpressionAttributeValues or {})
+        with self._lock:
+            key = self._key(item)
+            self._check(self._items.get(key, {}), ConditionExpression, ExpressionAttributeNames, values, "PutItem")
+            self._items[key] = item
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues="NONE", **_):
+        self._call("UpdateItem")
+        key_attrs = _to_dynamo(Key)
+        values = _to_dynamo(ExpressionAttributeValues or {})
+        with self._lock:
+            key = self._key(key_attrs)
+            old = self._items.get(key)
+            self._check(old or {}, ConditionExpression, ExpressionAttributeNames, values, "UpdateItem")
+            new = _Expression(UpdateExpression, ExpressionAttributeNames, values).apply_update(old or key_attrs)
+            self._items[key] = new
+        if ReturnValues == "ALL_NEW":
+            return {"Attributes": copy.deepcopy(new)}
+        if ReturnValues == "ALL_OLD":
+            return {"Attributes": copy.deepcopy(old)} if old else {}
+        if ReturnValues in ("UPDATED_NEW", "UPDATED_OLD"):
+            source = new if ReturnValues == "UPDATED_NEW" else (old or {})
+            changed = {a for a in set(new) | set(old or {}) if new.get(a) != (old or {}).get(a)}
+            return {"Attributes": {a: copy.deepcopy(source[a]) for a in changed if a in source}}
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **_):
+        self._call("DeleteItem")
+        values = _to_dynamo(ExpressionAttributeValues or {})
+        with self._lock:
+            key = self._key(_to_dynamo(Key))
+            self._check(self._items.get(key, {}), ConditionExpression, ExpressionAttributeNames, values,
+                        "DeleteItem")
+            self._items.pop(key, None)
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None, ScanIndexForward=True,
+              Limit=None, ExclusiveStartKey=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, **_):
+        self._call("Query")
+        hash_key, range_key = INDEX_KEYS[IndexName] if IndexName else (self.hash_key, self.range_key)
+        if isinstance(KeyConditionExpression, str):
+            key_check = _Expression(KeyConditionExpression, ExpressionAttributeNames,
+                                    _to_dynamo(ExpressionAttributeValues or {})).evaluate_condition
+        else:
+            unknown = _condition_attributes(KeyConditionExpression) - {hash_key, range_key}
+            if unknown:
+                raise ClientError("ValidationException", f"Query key condition not supported by schema: {unknown}")
+            key_check = lambda item: _evaluate_conditions(KeyConditionExpression, item)
+        with self._lock:
+            matches = [item for item in self._items.values()
+                       if hash_key in item and (range_key is None or range_key in item) and key_check(item)]
+            matches.sort(key=lambda item: (item.get(range_key, ""), self._key(item)) if range_key
+                         else self._key(item), reverse=not ScanIndexForward)
+            if ExclusiveStartKey:
+                start = self._key(_to_dynamo(ExclusiveStartKey))
+                position = next((i for i, item in enumerate(matches) if self._key(item) == start), None)
+                matches = matches[position + 1:] if position is not None else []
+            page = matches[:Limit] if Limit else matches
+            more = Limit is not None and len(matches) > len(page)
+            if FilterExpression is not None:
+                if isinstance(FilterExpression, str):
+                    check = _Expression(FilterExpression, ExpressionAttributeNames,
+                                        _to_dynamo(ExpressionAttributeValues or {})).evaluate_condition
+                else:
+                    check = lambda item: _evaluate_conditions(FilterExpression, item)
+                items = [item for item in page if check(item)]
+            else:
+                items = page
+            response = {"Items": [self._project(item, ProjectionExpression, ExpressionAttributeNames)
+                                  for item in items],
+                        "Count": len(items), "ScannedCount": len(page)}
+            if more and page:
+                last = page[-1]
+                key_attrs = {self.hash_key, self.range_key, hash_key, range_key} - {None}
+                response["LastEvaluatedKey"] = {a: copy.deepcopy(last[a]) for a in key_attrs}
+            return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+    def items(self):
+        """Snapshot of every item (for reports)."""
+        with self._lock:
+            return copy.deepcopy(list(self._items.values()))
+
+
+class _Meta:
+    def __init__(self, client):
+        self.client = client
+
+
+class _DynamoClient:
+    def __init__(self):
+        self.exceptions = _Exceptions("ConditionalCheckFailedException", "ResourceNotFoundException",
+                                      "ProvisionedThroughputExceededException", "TransactionCanceledException")
+
+
+class FakeDynamoDB:
+    def __init__(self, aws, table_keys=None):
+        self.aws = aws
+        self.table_keys = dict(TABLE_KEYS, **(table_keys or {}))
+        self.meta = _Meta(_DynamoClient())
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def Table(self, name):
+        with self._lock:
+            if name not in self._tables:
+                if name not in self.table_keys:
+                    raise ClientError("ResourceNotFoundException", f"Requested resource not found: {name}")
+                self._tables[name] = FakeTable(self.aws, name, self.table_keys[name], self.meta)
+            return self._tables[name]
+
+
+# ---------- Lambda ----------
+class FakeLambda(_Service):
+    """Async ("Event") invokes are handed to `dispatch(function_name, payload)`, set by the caller."""
+
+    def __init__(self, aws):
+        super().__init__(aws, "lambda")
+        self.dispatch = None
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b"{}", **_):
+        self._call("Invoke")
+        if self.dispatch is None:
+            raise ClientError("ResourceNotFoundException", f"Function not found: {FunctionName}", "Invoke")
+        payload = json.loads(Payload or "{}")
+        result = self.dispatch(FunctionName, payload, InvocationType == "Event")
+        if InvocationType == "Event":
+            return {"StatusCode": 202}
+        return {"StatusCode": 200, "Payload": _Body(json.dumps(result).encode("utf-8"))}
+
+
+class _ApiGatewayManagement(_Service):
+    """Every connection is gone: the benchmark opens no WebSockets."""
+
+    def __init__(self, aws):
+        super().__init__(aws, "apigatewaymanagementapi")
+        self.exceptions = _Exceptions("GoneException")
+
+    def post_to_connection(self, ConnectionId, Data, **_):
+        self._call("PostToConnection")
+        raise self.exceptions.GoneException("Connection is gone", "PostToConnection")
+
+
+class FakeAWS:
+    """One account's worth of fakes; install() points boto3.client/boto3.resource at them."""
+
+    def __init__(self, latency_ms=0.0, delay_scale=1.0, max_receive_count=5, table_keys=None):
+        self.latency_ms = latency_ms
+        self._counter_lock = threading.Lock()
+        self.calls = collections.Counter()  # (service, operation) -> calls
+        self.s3 = FakeS3(self)
+        self.sqs = FakeSQS(self, delay_scale=delay_scale, max_receive_count=max_receive_count)
+        self.dynamodb = FakeDynamoDB(self, table_keys)
+        self.lambda_ = FakeLambda(self)
+        self.apigateway = _ApiGatewayManagement(self)
+        self._installed = None
+
+    def count(self, service, operation):
+        with self._counter_lock:
+            self.calls[(service, operation)] += 1
+
+    def client(self, service, *args, **kwargs):
+        clients = {"s3": self.s3, "sqs": self.sqs, "lambda": self.lambda_, "dynamodb": self.dynamodb.meta.client,
+                   "apigatewaymanagementapi": self.apigateway}
+        if service not in clients:
+            raise NotImplementedError(f"No fake for boto3.client({service!r})")
+        return clients[service]
+
+    def resource(self, service, *args, **kwargs):
+        if service != "dynamodb":
+            raise NotImplementedError(f"No fake for boto3.resource({service!r})")
+        return self.dynamodb
+
+    def install(self):
+        self._installed = (boto3.client, boto3.resource)
+        boto3.client, boto3.resource = self.client, self.resource
+        return self
+
+    def uninstall(self):
+        if self._installed:
+            boto3.client, boto3.resource = self._installed
+            self._installed = None
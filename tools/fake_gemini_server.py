@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the parts of the Gemini REST API the lambdas use:
+generateContent and cachedContents (create / get / delete).
+
+Responses are canned, but usageMetadata is filled in the same way as the real
+API (promptTokenCount includes cachedContentTokenCount), so token accounting
+and context caching can be exercised without a key or network access.
+For load tests, generateContent can be slowed down (latency_ms, jitter_ms),
+answer a share of requests with 429 (rate_429) and return responses of a
+realistic length (response_words).
+
+Run standalone:
+    python tools/fake_gemini_server.py --port 8089
+    export GEMINI_API_BASE=http://127.0.0.1:8089/v1beta GEMINI_API_KEY=fake
+
+or in-process:
+    server, base_url = start_server()
+    ...
+    server.shutdown()
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GENERATE_RE = re.compile(r"^/v1beta/models/([^/:]+):generateContent$")
+CACHE_RE = re.compile(r"^/v1beta/(cachedContents/[^/]+)$")
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token)."""
+    return len(text) // 4 + 1 if text else 0
+
+
+def _text_of(contents):
+    return "".join(part.get("text", "") for content in contents for part in content.get("parts", []))
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # many summarizer threads connect at once under load
+
+    def __init__(self, address, min_cache_tokens=0, latency_ms=0.0, jitter_ms=0.0, rate_429=0.0,
+                 response_words=0):
+        super().__init__(address, FakeGeminiHandler)
+        self.min_cache_tokens = min_cache_tokens
+        self.latency_ms = latency_ms          # added to every generateContent answer
+        self.jitter_ms = jitter_ms            # plus a uniform random 0..jitter_ms
+        self.rate_429 = rate_429              # share of generateContent requests answered with 429
+        self.response_words = response_words  # pad responses to this many words (0: short canned text)
+        self.lock = threading.Lock()
+        self.caches = {}  # name -> {"model", "tokens"}
+        self.stats = {"generate_calls": 0, "throttled": 0, "caches_created": 0, "prompt_tokens": 0,
+                      "cached_tokens": 0, "output_tokens": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1beta"
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    server: FakeGeminiServer
+
+    def log_message(self, format, *args):
+        pass  # keep test output quiet
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, message):
+        self._send(status, {"error": {"code": status, "message": message}})
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        match = GENERATE_RE.match(path)
+        if match:
+            return self._generate(match.group(1), self._read_json())
+        if path == "/v1beta/cachedContents":
+            return self._create_cache(self._read_json())
+        self._error(404, f"Unknown path {path}")
+
+    def do_GET(self):
+        match = CACHE_RE.match(self.path.split("?", 1)[0])
+        with self.server.lock:
+            cache = self.server.caches.get(match.group(1)) if match else None
+        if not cache:
+            return self._error(404, "Cached content not found")
+        self._send(200, {"name": match.group(1), "model": cache["model"],
+                         "usageMetadata": {"totalTokenCount": cache["tokens"]}})
+
+    def do_DELETE(self):
+        match = CACHE_RE.match(self.path.split("?", 1)[0])
+        with self.server.lock:
+            found = match and self.server.caches.pop(match.group(1), None)
+        if not found:
+            return self._error(404, "Cached content not found")
+        self._send(200, {})
+
+    def _create_cache(self, payload):
+        tokens = estimate_tokens(_text_of(payload.get("contents", [])))
+        if tokens < self.server.min_cache_tokens:
+            return self._error(400, f"Cached content is too small: {tokens} < {self.server.min_cache_tokens} tokens")
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        with self.server.lock:
+            self.server.caches[name] = {"model": payload.get("model", ""), "tokens": tokens}
+            self.server.stats["caches_created"] += 1
+        self._send(200, {"name": name, "model": payload.get("model", ""),
+                         "usageMetadata": {"totalTokenCount": tokens}})
+
+    def _generate(self, model, payload):
+        server = self.server
+        if server.latency_ms or server.jitter_ms:
+            time.sleep((server.latency_ms + random.uniform(0, server.jitter_ms)) / 1000)
+        if server.rate_429 and random.random() < server.rate_429:
+            with server.lock:
+                server.stats["throttled"] += 1
+            return self._error(429, "Resource has been exhausted (e.g. check quota).")
+
+        cached_tokens = 0
+        cache_name = payload.get("cachedContent")
+        if cache_name:
+            with self.server.lock:
+                cache = self.server.caches.get(cache_name)
+            if not cache:
+                return self._error(404, f"Cached content {cache_name} not found")
+            if cache["model"] != f"models/{model}":
+                return self._error(400, "Cached content was created for a different model")
+            cached_tokens = cache["tokens"]
+
+        prompt = _text_of(payload.get("contents", []))
+        text = f"[{model}] Stand-in response to {len(prompt)} characters of prompt."
+        if server.response_words:
+            words = text.split()
+            text = " ".join(words + ["lorem"] * max(0, server.response_words - len(words)))
+        usage = {
+            "promptTokenCount": estimate_tokens(prompt) + cached_tokens,
+            "cachedContentTokenCount": cached_tokens,
+            "candidatesTokenCount": estimate_tokens(text),
+        }
+        with self.server.lock:
+            stats = self.server.stats
+            stats["generate_calls"] += 1
+            stats["prompt_tokens"] += usage["promptTokenCount"] - cached_tokens
+            stats["cached_tokens"] += cached_tokens
+            stats["output_tokens"] += usage["candidatesTokenCount"]
+        if not cached_tokens:
+            del usage["cachedContentTokenCount"]  # the real API omits it when nothing is cached
+        self._send(200, {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+            "usageMetadata": usage,
+            "modelVersion": model,
+        })
+
+
+def start_server(host="127.0.0.1", port=0, **options):
+    """Starts the stand-in on a background thread and returns (server, base_url)."""
+    server = FakeGeminiServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini REST API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--min-cache-tokens", type=int, default=0,
+                        help="Reject cachedContents smaller than this, like the real API does")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Delay before every generateContent answer")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Extra random delay of up to this much")
+    parser.add_argument("--rate-429", type=float, default=0, help="Share of generateContent requests answered 429")
+    parser.add_argument("--response-words", type=int, default=0, help="Pad responses to this many words")
+    args = parser.parse_args()
+
+    server = FakeGeminiServer((args.host, args.port), min_cache_tokens=args.min_cache_tokens,
+                              latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_429=args.rate_429,
+                              response_words=args.response_words)
+    print(f"Fake Gemini listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the API Gateway WebSocket management API that
+bookProgressNotifier pushes through (POST/GET/DELETE /@connections/{id}).
+
+Instead of forwarding to real sockets it keeps every message posted to a
+connection, so tests can subscribe a fake client and read what it was sent.
+Posting to a connection that was never opened (or was closed) returns 410
+GoneException, like the real API.
+
+In-process:
+    broker, endpoint = start_broker()
+    broker.connect("conn-1")
+    # WEBSOCKET_ENDPOINT=endpoint for the notifier, plus a connections row for conn-1
+    ...
+    broker.wait_for("conn-1", lambda m: m["event"] == "COMPLETE")
+    broker.shutdown()
+
+Standalone (accepts any connection id and prints what is pushed):
+    python tools/local_progress_broker.py --port 8090
+    export WEBSOCKET_ENDPOINT=http://127.0.0.1:8090/local
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONNECTION_RE = re.compile(r"^(?:/[^@/]+)?/@connections/([^/?]+)$")
+
+
+class LocalProgressBroker(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, stage="local", accept_any=False, echo=False):
+        super().__init__(address, BrokerHandler)
+        self.stage = stage
+        self.accept_any = accept_any  # treat unknown connection ids as open instead of gone
+        self.echo = echo              # print every posted message
+        self.condition = threading.Condition()
+        self.connections = {}  # connection_id -> list of decoded messages
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/{self.stage}"
+
+    def connect(self, connection_id):
+        with self.condition:
+            self.connections.setdefault(connection_id, [])
+
+    def disconnect(self, connection_id):
+        with self.condition:
+            self.connections.pop(connection_id, None)
+
+    def messages(self, connection_id):
+        with self.condition:
+            return list(self.connections.get(connection_id, []))
+
+    def wait_for(self, connection_id, predicate=lambda message: True, timeout=10.0):
+        """Blocks until a message to connection_id matches predicate; returns it or raises TimeoutError."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for message in self.connections.get(connection_id, []):
+                    if predicate(message):
+                        return message
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No matching message for {connection_id} within {timeout}s")
+                self.condition.wait(remaining)
+
+
+class BrokerHandler(BaseHTTPRequestHandler):
+    server: LocalProgressBroker
+
+    def log_message(self, format, *args):
+        pass  # keep test output quiet
+
+    def _send(self, status, body=None, error_type=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if error_type:
+            self.send_header("x-amzn-ErrorType", error_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _connection_id(self):
+        match = CONNECTION_RE.match(self.path)
+        if not match:
+            self._send(404, {"message": f"Unknown path {self.path}"}, "NotFoundException")
+            return None
+        return match.group(1)
+
+    def _gone(self):
+        self._send(410, {"message": "Connection is gone"}, "GoneException")
+
+    def do_POST(self):
+        connection_id = self._connection_id()
+        if connection_id is None:
+            return
+        data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            message = json.loads(data)
+        except ValueError:
+            message = data.decode("utf-8", errors="replace")
+        with self.server.condition:
+            if connection_id not in self.server.connections and not self.server.accept_any:
+                return self._gone()
+            self.server.connections.setdefault(connection_id, []).append(message)
+            self.server.condition.notify_all()
+        if self.server.echo:
+            print(f"{connection_id}: {json.dumps(message)}", flush=True)
+        self._send(200)
+
+    def do_GET(self):
+        connection_id = self._connection_id()
+        if connection_id is None:
+            return
+        with self.server.condition:
+            known = connection_id in self.server.connections
+        if not known:
+            return self._gone()
+        self._send(200, {"connectedAt": None, "identity": {}, "lastActiveAt": None})
+
+    def do_DELETE(self):
+        connection_id = self._connection_id()
+        if connection_id is None:
+            return
+        with self.server.condition:
+            known = self.server.connections.pop(connection_id, None) is not None
+        if not known:
+            return self._gone()
+        self._send(204)
+
+
+def start_broker(host="127.0.0.1", port=0, **options):
+    """Starts the stand-in on a background thread and returns (broker, endpoint)."""
+    broker = LocalProgressBroker((host, port), **options)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    return broker, broker.endpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the WebSocket management API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--stage", default="local")
+    args = parser.parse_args()
+
+    broker = LocalProgressBroker((args.host, args.port), stage=args.stage, accept_any=True, echo=True)
+    print(f"Local progress broker listening on {broker.endpoint}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
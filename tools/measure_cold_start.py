@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Measures the import (init) time of every lambda handler, each in a fresh
+interpreter the way a cold start loads it, and checks it against a budget.
+
+    python tools/measure_cold_start.py                 # all handlers, 5 runs each
+    python tools/measure_cold_start.py getBookSummary --runs 20 --importtime
+
+Run it in an environment with the function's own requirements installed.
+Exits non-zero if any handler's import time is over its budget, or if a
+handler fails to import. Only the handler's own directory is put on
+sys.path, as in the deployed package, so a missing vendored module (see
+tools/vendor_common.py) fails too. Clients are created lazily
+(LazyResource), so no AWS credentials or network access are needed.
+tests/unit/test_cold_start.py runs the same check for every handler.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "lambdas")
+
+# function name -> (directory under src/lambdas, module, import budget in ms).
+# The read path is latency-sensitive, so it gets the tightest budgets.
+HANDLERS = {
+    "getBookSummary": ("get_summary_by_progress", "app", 250),
+    "getBookCharacters": ("get_character_by_progress", "app", 250),
+    "getUserBooks": ("get_user_books", "app", 250),
+    "updateReadingProgress": ("update_reading_progress", "app", 250),
+    "generatePresignedUploadUrl": ("generate_presigned_upload_url", "app", 250),
+    "deleteBook": ("delete_book", "app", 250),
+    "websocketConnections": ("websocket_connections", "app", 250),
+    "askBookQuestion": ("ask_book_question", "app", 400),
+    "bookProgressNotifier": ("book_progress_notifier", "app", 400),
+    "cleanupBook": ("cleanup_book", "app", 400),
+    "fairDispatcher": ("fair_dispatcher", "app", 400),
+    "normalize-books": ("normalize_books", "normalize_lambda", 400),
+    "bookSummaryLambda": ("book_summary_lambda", "app", 500),
+    "characterSummaryLambda": ("character_summary_lambda", "app", 500),
+}
+
+PROBE = """
+import sys, time
+sys.path.insert(0, {path!r})
+start = time.perf_counter()
+import {module}
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def measure(directory, module, runs, importtime=False):
+    """
+    Import time in ms, the fastest of `runs` fresh interpreters (the run least
+    disturbed by the rest of the machine), plus the handler's slowest imports
+    if asked.
+    """
+    path = os.path.abspath(os.path.join(LAMBDAS_DIR, directory))
+    env = {**os.environ, "AWS_REGION": os.environ.get("AWS_REGION", "us-east-1"),
+           "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1")}
+    timings, slowest = [], []
+    for run in range(runs):
+        cmd = [sys.executable]
+        if importtime and run == 0:
+            cmd += ["-X", "importtime"]
+        cmd += ["-c", PROBE.format(path=path, module=module)]
+        result = subprocess.run(cmd, capture_output=True, text=True, env=env, cwd=path)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed")
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+        if importtime and run == 0:
+            slowest = _slowest_imports(result.stderr, module)
+    return min(timings), slowest
+
+
+def _slowest_imports(stderr, module, top=8):
+    """The modules `module` imports directly, by cumulative time, from -X importtime output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # A module is listed after its own imports, which are indented one level deeper
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(cumulative) / 1000, name.strip(), depth))
+    for end, (_, name, depth) in enumerate(rows):
+        if name == module and depth == 0:
+            break
+    else:
+        return []
+    children = []
+    for ms, name, depth in reversed(rows[:end]):
+        if depth == 0:
+            break  # imported before the handler (by site)
+        if depth == 1:
+            children.append((ms, name))
+    return sorted(children, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure lambda handler import times against a budget")
+    parser.add_argument("functions", nargs="*", help=f"Subset of: {', '.join(HANDLERS)}")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--importtime", action="store_true", help="Also list the slowest imports per handler")
+    args = parser.parse_args()
+
+    unknown = set(args.functions) - set(HANDLERS)
+    if unknown:
+        parser.error(f"Unknown functions: {', '.join(sorted(unknown))}")
+
+    failed = False
+    for name in args.functions or HANDLERS:
+        directory, module, budget = HANDLERS[name]
+        try:
+            import_ms, slowest = measure(directory, module, args.runs, args.importtime)
+        except RuntimeError as e:
+            print(f"{name:28} FAILED   {e}")
+            failed = True
+            continue
+        over = import_ms > budget
+        failed |= over
+        print(f"{name:28} {import_ms:7.1f} ms  (budget {budget} ms){'  OVER BUDGET' if over else ''}")
+        for ms, imported in slowest:
+            print(f"    {ms:7.1f} ms  {imported}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
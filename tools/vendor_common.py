@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Copies the shared modules in src/common into every Python lambda package that
+imports them, directly or through another shared module.
+
+The functions are deployed as plain directory packages with no layer
+attached, so each package carries its own copy next to its handler. Edit the
+module in src/common and re-run this script; never edit a copy.
+
+    python tools/vendor_common.py            # write the copies
+    python tools/vendor_common.py --check    # exit non-zero if a copy is missing or stale
+
+tests/unit/test_vendored_common.py runs the same check.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+COMMON_DIR = os.path.abspath(os.path.join(ROOT, "src", "common"))
+LAMBDAS_DIR = os.path.abspath(os.path.join(ROOT, "src", "lambdas"))
+
+HEADER = "# Vendored from src/common/{name} by tools/vendor_common.py. Edit it there, not here.\n"
+
+
+def common_modules():
+    """Names (without .py) of the shared modules."""
+    return sorted(f[:-3] for f in os.listdir(COMMON_DIR) if f.endswith(".py"))
+
+
+def _imports(path, modules):
+    """The shared modules a source file imports at top level or inside functions."""
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    return {m for m in modules if re.search(rf"^\s*(from\s+{m}\s+import|import\s+{m}\b)", source, re.M)}
+
+
+def _closure(names, modules):
+    """names plus every shared module they import, transitively."""
+    needed, todo = set(), list(names)
+    while todo:
+        name = todo.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        todo.extend(_imports(os.path.join(COMMON_DIR, name + ".py"), modules))
+    return needed
+
+
+def plan():
+    """{lambda directory: sorted shared modules it needs}."""
+    modules = common_modules()
+    result = {}
+    for entry in sorted(os.listdir(LAMBDAS_DIR)):
+        directory = os.path.join(LAMBDAS_DIR, entry)
+        if not os.path.isdir(directory):
+            continue
+        handlers = [os.path.join(directory, f) for f in os.listdir(directory)
+                    if f.endswith(".py") and f[:-3] not in modules]
+        direct = set().union(*(_imports(h, modules) for h in handlers)) if handlers else set()
+        if direct:
+            result[directory] = sorted(_closure(direct, modules))
+    return result
+
+
+def vendored_source(name):
+    with open(os.path.join(COMMON_DIR, name + ".py"), encoding="utf-8") as f:
+        return HEADER.format(name=name + ".py") + f.read()
+
+
+def stale_copies():
+    """Paths of copies that are missing or differ from src/common."""
+    stale = []
+    for directory, names in plan().items():
+        for name in names:
+            path = os.path.join(directory, name + ".py")
+            try:
+                with open(path, encoding="utf-8") as f:
+                    current = f.read()
+            except FileNotFoundError:
+                current = None
+            if current != vendored_source(name):
+                stale.append(path)
+    return stale
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy src/common modules into the lambda packages")
+    parser.add_argument("--check", action="store_true", help="Only report missing or stale copies")
+    args = parser.parse_args()
+
+    stale = stale_copies()
+    if args.check:
+        for path in stale:
+            print(f"stale: {os.path.relpath(path, ROOT)}")
+        return 1 if stale else 0
+    for path in stale:
+        name = os.path.basename(path)[:-3]
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(vendored_source(name))
+        print(f"wrote {os.path.relpath(path, ROOT)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())